@@ -0,0 +1,202 @@
+"""Provide lazy and whole-file image readers shared by the ray apps."""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ChunkedImage:
+    """Lazily read 2D image backed by a chunked zarr array.
+
+    `uri` is a local path or an S3 URL, for example on the MinIO server
+    started by `start_server` (pass its endpoint and keys in
+    `storage_options`). It points to a zarr array or an OME-Zarr multiscale
+    group, whose pyramid `level` is used. Leading axes are reduced with
+    `index`, where `None` keeps an axis as the trailing channel axis; by
+    default the OME-Zarr "c" axis is kept and other leading axes take 0.
+    Plain (y, x, c) arrays with up to 4 channels are read as they are.
+    Slicing reads only the chunks covering the region, in parallel.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        level: int = 0,
+        index: list = None,
+        storage_options: dict = None,
+        max_workers: int = 8,
+    ):
+        import zarr
+
+        if "://" in uri:
+            import fsspec
+
+            store = fsspec.get_mapper(uri, **(storage_options or {}))
+        else:
+            store = uri
+        array = zarr.open(store, mode="r")
+        axes = None
+        coarsest = None
+        if isinstance(array, zarr.hierarchy.Group):
+            multiscales = array.attrs["multiscales"][0]
+            axes = [
+                axis["name"] if isinstance(axis, dict) else axis
+                for axis in multiscales.get("axes", [])
+            ]
+            coarsest = array[multiscales["datasets"][-1]["path"]]
+            array = array[multiscales["datasets"][level]["path"]]
+        # RGB-like arrays keep their channels last, others have them leading
+        self.channels_last = axes is None and array.ndim == 3 and array.shape[-1] <= 4
+        leading = 0 if self.channels_last else array.ndim - 2
+        if index is None:
+            if axes:
+                index = [None if axis == "c" else 0 for axis in axes[:leading]]
+            else:
+                index = [0] * (leading - 1) + [None] if leading else []
+        assert (
+            len(index) == leading
+        ), f"index needs {leading} entries for shape {array.shape}"
+        assert sum(i is None for i in index) <= 1, "index can keep one channel axis"
+        self.uri = uri
+        self.level = level
+        self.array = array
+        self._coarsest = array if coarsest is None else coarsest
+        self.index = list(index)
+        self.max_workers = max_workers
+        self.dtype = array.dtype
+        if self.channels_last:
+            self.shape = tuple(array.shape)
+        else:
+            channels = [n for n, i in zip(array.shape, index) if i is None]
+            self.shape = tuple(array.shape[-2:]) + tuple(channels)
+        self.ndim = len(self.shape)
+
+    @property
+    def key(self) -> str:
+        """Identifies the referenced data, for use in cache keys."""
+        return f"{self.uri}:{self.level}:{self.index}"
+
+    def _read_block(self, rows: slice, cols: slice, array=None) -> np.ndarray:
+        array = self.array if array is None else array
+        if self.channels_last:
+            return array[rows, cols]
+        selection = tuple(slice(None) if i is None else i for i in self.index)
+        block = array[selection + (rows, cols)]
+        return np.moveaxis(block, 0, -1) if block.ndim == 3 else block
+
+    def intensity_range(self, max_pixels: int = 1024**2) -> tuple:
+        """Return the (min, max) intensity of the whole image.
+
+        It is estimated from the coarsest OME-Zarr pyramid level, subsampled
+        to about `max_pixels` pixels, so that tiles can be normalized alike
+        without reading the full resolution.
+        """
+        shape = self._coarsest.shape
+        rows, cols = shape[:2] if self.channels_last else shape[-2:]
+        step = max(1, int(np.ceil(np.sqrt(rows * cols / max_pixels))))
+        sample = self._read_block(
+            slice(None, None, step), slice(None, None, step), self._coarsest
+        )
+        return float(sample.min()), float(sample.max())
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        (r0, r1, _), (c0, c1, _) = [
+            k.indices(n) for k, n in zip(key[:2], self.shape[:2])
+        ]
+        out = np.empty((max(r1 - r0, 0), max(c1 - c0, 0)) + self.shape[2:], self.dtype)
+        # split the region at chunk borders and read the blocks concurrently
+        chunks = self.array.chunks
+        chunk_rows, chunk_cols = chunks[:2] if self.channels_last else chunks[-2:]
+        row_edges = (
+            [r0]
+            + list(range((r0 // chunk_rows + 1) * chunk_rows, r1, chunk_rows))
+            + [r1]
+        )
+        col_edges = (
+            [c0]
+            + list(range((c0 // chunk_cols + 1) * chunk_cols, c1, chunk_cols))
+            + [c1]
+        )
+        blocks = [
+            (slice(ra, rb), slice(ca, cb))
+            for ra, rb in zip(row_edges, row_edges[1:])
+            for ca, cb in zip(col_edges, col_edges[1:])
+        ]
+
+        def read(block):
+            rows, cols = block
+            out[rows.start - r0 : rows.stop - r0, cols.start - c0 : cols.stop - c0] = (
+                self._read_block(rows, cols)
+            )
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            list(executor.map(read, blocks))
+        return out[(slice(None), slice(None)) + key[2:]]
+
+    def __array__(self, dtype=None):
+        image = self[:, :]
+        return image if dtype is None else image.astype(dtype)
+
+
+IMAGE_FILE_SUFFIXES = (".npy", ".tif", ".tiff", ".png", ".jpg", ".jpeg")
+
+
+def open_image(image):
+    """Return `image`, or open it if it is a path, URL or reference dict.
+
+    Image files are read whole with `read_image_file`, other references are
+    opened lazily as a `ChunkedImage`.
+    """
+    if isinstance(image, str):
+        image = {"uri": image}
+    if isinstance(image, dict):
+        if image["uri"].lower().endswith(IMAGE_FILE_SUFFIXES):
+            return read_image_file(**image)
+        return ChunkedImage(**image)
+    return image
+
+
+def read_image_file(uri: str, storage_options: dict = None) -> np.ndarray:
+    """Read a whole image file from a local path or URL."""
+    import fsspec
+
+    with fsspec.open(uri, "rb", **(storage_options or {})) as f:
+        data = f.read()
+    if uri.lower().endswith(".npy"):
+        return np.load(io.BytesIO(data))
+    if uri.lower().endswith((".tif", ".tiff")):
+        import tifffile
+
+        return tifffile.imread(io.BytesIO(data))
+    import cv2
+
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def check_uri(uri: str, allowed_uris: list) -> str:
+    """Return `uri` if it lies below one of the `allowed_uris` prefixes.
+
+    Local paths are resolved first, so ".." and symbolic links cannot leave
+    an allowed directory. Remote URIs with ".." segments are rejected, as
+    object stores do not resolve them. Raise `PermissionError` otherwise.
+    """
+
+    def normalize(uri):
+        if uri.startswith("file://"):
+            uri = uri[len("file://") :]
+        if "://" not in uri:
+            return os.path.realpath(uri)
+        if ".." in uri.split("://", 1)[1].split("/"):
+            raise PermissionError(f"{uri} must not contain '..'.")
+        return uri.rstrip("/")
+
+    path = normalize(uri)
+    for allowed in allowed_uris:
+        allowed = normalize(allowed)
+        if path == allowed or path.startswith(allowed.rstrip("/") + "/"):
+            return uri
+    raise PermissionError(f"{uri} is outside the allowed locations.")
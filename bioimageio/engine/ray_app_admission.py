@@ -0,0 +1,264 @@
+"""Provide admission control, fair queueing and rate limits for ray apps."""
+import asyncio
+import heapq
+import itertools
+import logging
+import sys
+import time
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger("ray_app_admission")
+logger.setLevel(logging.INFO)
+
+# Interactive calls bypass the app-wide limit, normal calls are queued
+# ahead of bulk calls
+PRIORITIES = {"interactive": 0, "normal": 1, "bulk": 2}
+
+
+class AdmissionRejected(RuntimeError):
+    """Raised when a call exceeds the concurrency and queue limits of an app."""
+
+    def __init__(self, key, reason, retry_after):
+        self.retry_after = retry_after
+        super().__init__(
+            f"{key} is over capacity ({reason}), retry after {retry_after:.1f}s"
+        )
+
+
+class TokenBucket:
+    """Allow `rate` calls per second with bursts of up to `burst` calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Limit:
+    """Concurrency and queue length limit of an app or a method."""
+
+    def __init__(self, max_concurrency=None, max_queue=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+
+    def has_slot(self) -> bool:
+        return self.max_concurrency is None or self.active < self.max_concurrency
+
+    def queue_full(self) -> bool:
+        return self.max_queue is not None and self.queued >= self.max_queue
+
+
+class AdmissionController:
+    """Bound the concurrent and queued calls of one app.
+
+    The `admission` section of the manifest sets app-wide limits and
+    per-method limits and priorities:
+
+        admission:
+          max_concurrency: 4
+          max_queue: 16
+          methods:
+            compute_embedding: {max_concurrency: 2, max_queue: 8, priority: bulk}
+            segment: {priority: interactive}
+          rate_limit: {rate: 2, burst: 10}
+          user_weights: {some-user-id: 2}
+
+    Calls that find no free slot wait in a queue ordered by priority and,
+    within a priority, by weighted fair queueing across users: each call
+    gets a virtual finish tag `max(virtual time, user's last tag) +
+    1 / weight`, so a user with many queued calls cannot hold back the
+    others. The tags are forgotten whenever the queue drains, and idle
+    users' rate-limit buckets are dropped once they are full again. Calls
+    that find the queue full, or whose user ran out of
+    rate-limit tokens, are rejected right away with a retry-after hint;
+    for full queues it is estimated from `latency(method)`, the mean
+    latency of the method.
+    """
+
+    def __init__(
+        self, app_id, config=None, latency=None, retry_after=1.0, prune_interval=60.0
+    ):
+        config = config or {}
+        self.app_id = app_id
+        self.app_limit = Limit(config.get("max_concurrency"), config.get("max_queue"))
+        self.method_limits = {}
+        self.priorities = {}
+        for method_name, method_config in (config.get("methods") or {}).items():
+            method_config = method_config or {}
+            self.method_limits[method_name] = Limit(
+                method_config.get("max_concurrency"), method_config.get("max_queue")
+            )
+            priority = method_config.get("priority", "normal")
+            assert priority in PRIORITIES, f"Unknown priority: {priority}"
+            self.priorities[method_name] = PRIORITIES[priority]
+        self.retry_after = config.get("retry_after", retry_after)
+        self.rate_limit = config.get("rate_limit")
+        self.user_weights = dict(config.get("user_weights") or {})
+        # Requests rejected by the rate limit; not kept per user, as the
+        # users' buckets come and go
+        self.throttled = 0
+        self._latency = latency
+        # heap of (priority, finish_tag, order, method_name, future, user_id)
+        self._waiters = []
+        self._order = itertools.count()
+        self._buckets = {}  # user_id -> TokenBucket
+        self._prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+        self._virtual_time = 0.0
+        self._last_tags = {}  # user_id -> finish tag of the user's last call
+
+    def _limits(self, method_name) -> list:
+        limits = []
+        if self.priorities.get(method_name) != PRIORITIES["interactive"]:
+            limits.append(self.app_limit)
+        if method_name in self.method_limits:
+            limits.append(self.method_limits[method_name])
+        return limits
+
+    def _estimate_retry_after(self, method_name, limit) -> float:
+        latency = self._latency(method_name) if self._latency else None
+        if not latency or not limit.max_concurrency:
+            return self.retry_after
+        # Time until the queue ahead of the caller drains
+        waves = (limit.queued + 1) / limit.max_concurrency
+        return max(self.retry_after, latency * waves)
+
+    def queued(self, method_name) -> int:
+        return sum(1 for waiter in self._waiters if waiter[3] == method_name)
+
+    def user_queues(self) -> dict:
+        """Number of queued calls and best queue position (0 is next) per user."""
+        queues = {}
+        for position, waiter in enumerate(sorted(self._waiters)):
+            queued, first = queues.get(waiter[5], (0, position))
+            queues[waiter[5]] = (queued + 1, first)
+        return queues
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        if now - self._pruned_at < self._prune_interval:
+            return
+        self._pruned_at = now
+        # A bucket that has refilled behaves like a new one
+        for user_id, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst:
+                del self._buckets[user_id]
+
+    def _throttle(self, method_name, user_id):
+        if not self.rate_limit:
+            return
+        self._prune_buckets()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(
+                self.rate_limit["rate"], self.rate_limit.get("burst")
+            )
+        retry_after = bucket.take()
+        if retry_after:
+            self.throttled += 1
+            reason = f"rate limit of {bucket.rate}/s for user {user_id}"
+            logger.info(f"Rejected {self.app_id}:{method_name} ({reason})")
+            raise AdmissionRejected(f"{self.app_id}:{method_name}", reason, retry_after)
+
+    def _finish_tag(self, user_id) -> float:
+        start = max(self._virtual_time, self._last_tags.get(user_id, 0.0))
+        tag = start + 1.0 / self.user_weights.get(user_id, 1)
+        self._last_tags[user_id] = tag
+        return tag
+
+    def _serve(self, tag, user_id):
+        # The virtual time follows the calls that are served
+        self._virtual_time = max(
+            self._virtual_time, tag - 1.0 / self.user_weights.get(user_id, 1)
+        )
+
+    def _drained(self):
+        # Without queued calls there is no backlog to be fair about
+        if not self._waiters:
+            self._last_tags.clear()
+
+    async def acquire(self, method_name, user_id=None):
+        self._throttle(method_name, user_id)
+        limits = self._limits(method_name)
+        if all(limit.has_slot() for limit in limits):
+            for limit in limits:
+                limit.active += 1
+            if self._waiters:
+                self._serve(self._finish_tag(user_id), user_id)
+            return
+        for limit in limits:
+            if limit.queue_full():
+                reason = (
+                    f"{limit.active} running, {limit.queued} queued"
+                    if limit is self.app_limit
+                    else f"{method_name}: {limit.active} running, {limit.queued} queued"
+                )
+                retry_after = self._estimate_retry_after(method_name, limit)
+                logger.info(f"Rejected {self.app_id}:{method_name} ({reason})")
+                raise AdmissionRejected(
+                    f"{self.app_id}:{method_name}", reason, retry_after
+                )
+        future = asyncio.get_running_loop().create_future()
+        waiter = (
+            self.priorities.get(method_name, PRIORITIES["normal"]),
+            self._finish_tag(user_id),
+            next(self._order),
+            method_name,
+            future,
+            user_id,
+        )
+        heapq.heappush(self._waiters, waiter)
+        for limit in limits:
+            limit.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before the caller went away
+                self.release(method_name)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                for limit in limits:
+                    limit.queued -= 1
+                self._drained()
+            raise
+
+    def release(self, method_name):
+        for limit in self._limits(method_name):
+            limit.active -= 1
+        self._admit_waiters()
+
+    def _admit_waiters(self):
+        # Waiters blocked by their method limit let later waiters through
+        blocked = []
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            limits = self._limits(waiter[3])
+            if waiter[4].cancelled():
+                for limit in limits:
+                    limit.queued -= 1
+            elif all(limit.has_slot() for limit in limits):
+                for limit in limits:
+                    limit.queued -= 1
+                    limit.active += 1
+                self._serve(waiter[1], waiter[5])
+                waiter[4].set_result(None)
+            else:
+                blocked.append(waiter)
+        for waiter in blocked:
+            heapq.heappush(self._waiters, waiter)
+        self._drained()
@@ -0,0 +1,196 @@
+"""Provide an idempotent result cache for ray app methods."""
+import asyncio
+import hashlib
+import logging
+import pickle
+import sys
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger("ray_app_cache")
+logger.setLevel(logging.INFO)
+
+
+def _update_hash(h, value):
+    if hasattr(value, "__array_interface__"):
+        h.update(f"array:{value.dtype.str}:{value.shape}".encode())
+        h.update(value.data if value.flags.c_contiguous else value.tobytes())
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        h.update(b"bytes:%d:" % len(value))
+        h.update(value)
+    elif isinstance(value, str):
+        h.update(b"str:%d:" % len(value))
+        h.update(value.encode())
+    elif value is None or isinstance(value, (bool, int, float)):
+        h.update(f"{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, dict):
+        h.update(b"dict:%d:" % len(value))
+        for k in sorted(value, key=str):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b"list:%d:" % len(value))
+        for item in value:
+            _update_hash(h, item)
+    else:
+        raise TypeError(f"Cannot hash {type(value).__name__}")
+
+
+def hash_arguments(args, kwargs):
+    """Content hash of the call arguments, None if they cannot be hashed.
+
+    The Hypha `context` is left out, so identical calls of different users
+    share the cached result.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        _update_hash(h, list(args))
+        _update_hash(h, {k: v for k, v in kwargs.items() if k != "context"})
+    except TypeError:
+        return None
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Size-bounded LRU cache of method results with per-method TTLs.
+
+    Results are kept in memory, or pickled to `storage` (for example
+    `s3://bioengine/result-cache` on the MinIO server) when it is set; the
+    LRU index and the size bound stay in memory either way. Entries are
+    sized by their pickled length. Concurrent identical calls are coalesced
+    into one call of the app.
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2, storage=None, storage_options=None):
+        self.max_bytes = max_bytes
+        self.storage = storage.rstrip("/") if storage else None
+        self.storage_options = storage_options or {}
+        self.nbytes = 0
+        # method_name -> Counter of hits, misses, coalesced, evictions, uncacheable
+        self.stats = defaultdict(Counter)
+        self._entries = OrderedDict()  # key -> (expires_at, nbytes, value)
+        self._pending = {}  # key -> Future of the running call
+        self._fs = None
+
+    def _get_fs(self):
+        if self._fs is None:
+            import fsspec
+
+            self._fs, _ = fsspec.core.url_to_fs(self.storage, **self.storage_options)
+        return self._fs
+
+    def _path(self, key) -> str:
+        return f"{self.storage}/{key}.pkl"
+
+    def _read(self, key):
+        with self._get_fs().open(self._path(key), "rb") as f:
+            blob = f.read()
+        return len(blob), pickle.loads(blob)
+
+    def _write(self, key, blob):
+        with self._get_fs().open(self._path(key), "wb") as f:
+            f.write(blob)
+
+    def _delete(self, key):
+        try:
+            self._get_fs().rm(self._path(key))
+        except Exception as e:
+            logger.warning(f"Failed to delete cached result {key}: {e}")
+
+    async def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] < time.time():
+            await self._evict(key)
+            entry = None
+        if self.storage is None:
+            if entry is None:
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[2]
+        # Results written before a restart are still found in the storage
+        try:
+            nbytes, (expires_at, value) = await asyncio.to_thread(self._read, key)
+        except FileNotFoundError:
+            if entry is not None:
+                self._drop(key)
+            return False, None
+        except Exception as e:
+            logger.warning(f"Failed to read cached result {key}: {e}")
+            return False, None
+        if expires_at is not None and expires_at < time.time():
+            return False, None
+        if entry is None:
+            await self._add(key, (expires_at, nbytes, None))
+        else:
+            self._entries.move_to_end(key)
+        return True, value
+
+    def _drop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    async def _evict(self, key):
+        self._drop(key)
+        if self.storage is not None:
+            await asyncio.to_thread(self._delete, key)
+
+    async def _add(self, key, entry):
+        self._entries[key] = entry
+        self.nbytes += entry[1]
+        while self.nbytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self.stats[oldest.split("/")[0]]["evictions"] += 1
+            await self._evict(oldest)
+
+    async def _put(self, key, value, ttl):
+        expires_at = time.time() + ttl if ttl else None
+        blob = pickle.dumps((expires_at, value), protocol=pickle.HIGHEST_PROTOCOL)
+        nbytes = len(blob)
+        entry = (expires_at, nbytes, value if self.storage is None else None)
+        if nbytes > self.max_bytes:
+            return
+        if self.storage is not None:
+            await asyncio.to_thread(self._write, key, blob)
+        if key in self._entries:
+            self._drop(key)
+        await self._add(key, entry)
+
+    async def call(self, method_name, func, args, kwargs, ttl=None):
+        """Return the cached result of `func(*args, **kwargs)`, calling it on a miss."""
+        stats = self.stats[method_name]
+        key = hash_arguments(args, kwargs)
+        if key is None:
+            stats["uncacheable"] += 1
+            return await func(*args, **kwargs)
+        key = f"{method_name}/{key}"
+        pending = self._pending.get(key)
+        if pending is not None:
+            stats["coalesced"] += 1
+        else:
+            pending = self._pending[key] = asyncio.ensure_future(
+                self._fill(method_name, key, func, args, kwargs, ttl)
+            )
+            # Do not warn about an error when every caller was cancelled
+            pending.add_done_callback(lambda task: task.cancelled() or task.exception())
+        # The call runs in its own task, so a cancelled caller does not fail
+        # the others waiting for the same result
+        return await asyncio.shield(pending)
+
+    async def _fill(self, method_name, key, func, args, kwargs, ttl):
+        stats = self.stats[method_name]
+        try:
+            found, value = await self._get(key)
+            if found:
+                stats["hits"] += 1
+                return value
+            stats["misses"] += 1
+            value = await func(*args, **kwargs)
+            # Stay pending until stored, so identical calls do not recompute
+            try:
+                await self._put(key, value, ttl)
+            except Exception as e:
+                logger.warning(f"Failed to cache result of {method_name}: {e}")
+            return value
+        finally:
+            del self._pending[key]
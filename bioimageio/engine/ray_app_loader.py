@@ -1,5 +1,7 @@
 """Provide ray app manager."""
+import inspect
 import re
+import time
 from ray import serve
 import logging
 import yaml
@@ -9,6 +11,7 @@ from pathlib import Path
 import urllib.request
 
 from hypha_rpc.utils import ObjectProxy
+from bioimageio.engine.ray_app_scheduler import eviction_autoscaling_policy
 
 
 logging.basicConfig(stream=sys.stdout)
@@ -68,8 +71,132 @@ def create_ray_serve_config(app_info):
     runtime_env["pip"].append(
         "https://github.com/bioimage-io/bioengine/archive/refs/heads/main.zip"
     )
+    autoscaling_config = ray_serve_config.get("autoscaling_config")
+    if autoscaling_config and "policy" not in autoscaling_config:
+        # Lets the app manager evict idle apps when GPUs run out
+        autoscaling_config["policy"] = {"policy_function": eviction_autoscaling_policy}
     return ray_serve_config
 
+def add_warmup(app_info):
+    """Return a subclass of the app class that warms up in its constructor.
+
+    The `warmup` section of the manifest lists `models` to preload with the
+    app's `_load_model` and `calls` to run once, each a `method` with
+    `kwargs`. Any `{"random": shape, "dtype": ...}` value in the kwargs is
+    replaced by a random array. Ray Serve reports a replica ready only when
+    its constructor returns, so requests never reach a cold replica.
+    Constructor and warm-up durations are recorded as Ray metrics.
+    """
+    app_class = app_info.app_class
+    app_id = app_info.id
+    warmup = app_info.warmup
+    require_context = (app_info.get("service_config") or {}).get("require_context")
+
+    def synthesize(value):
+        import numpy as np
+
+        if isinstance(value, dict) and "random" in value:
+            dtype = np.dtype(value.get("dtype", "uint8"))
+            high = np.iinfo(dtype).max if dtype.kind in "ui" else 1
+            return (np.random.rand(*value["random"]) * high).astype(dtype)
+        if isinstance(value, dict):
+            return {k: synthesize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [synthesize(v) for v in value]
+        return value
+
+    def run_call(app, call):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        kwargs = synthesize(dict(call.get("kwargs") or {}))
+        if require_context:
+            kwargs.setdefault("context", {"user": {"id": "warmup"}})
+        result = getattr(app, call["method"])(**kwargs)
+        if asyncio.iscoroutine(result):
+            # the constructor may run inside an event loop, use a fresh one
+            with ThreadPoolExecutor(1) as executor:
+                executor.submit(asyncio.run, result).result()
+
+    def record(name, description, value):
+        try:
+            from ray.util.metrics import Histogram
+
+            histogram = Histogram(
+                name,
+                description=description,
+                boundaries=[0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300],
+                tag_keys=("app",),
+            )
+            histogram.observe(value, tags={"app": app_id})
+        except Exception as e:
+            logger.warning(f"Could not record metric {name}: {e}")
+
+    class WarmedUpApp(app_class):
+        def __init__(self, *args, **kwargs):
+            start_time = time.perf_counter()
+            super().__init__(*args, **kwargs)
+            init_time = time.perf_counter() - start_time
+            for model in warmup.get("models") or []:
+                logger.info(f"Warm-up {app_id}: loading model {model}")
+                self._load_model(model)
+            for call in warmup.get("calls") or []:
+                logger.info(f"Warm-up {app_id}: calling {call['method']}")
+                run_call(self, call)
+            startup_time = time.perf_counter() - start_time
+            self._startup_stats = {
+                "init_seconds": init_time,
+                "warmup_seconds": startup_time - init_time,
+                "startup_seconds": startup_time,
+            }
+            logger.info(
+                f"Replica of {app_id} ready after {startup_time:.2f}s "
+                f"(warm-up {startup_time - init_time:.2f}s)"
+            )
+            record(
+                "bioengine_replica_startup_seconds",
+                "Time from replica construction until it is ready",
+                startup_time,
+            )
+            record(
+                "bioengine_replica_warmup_seconds",
+                "Time spent warming up a replica",
+                startup_time - init_time,
+            )
+
+    WarmedUpApp.__name__ = app_class.__name__
+    WarmedUpApp.__doc__ = app_class.__doc__
+    return WarmedUpApp
+
+def get_init_kwargs(app_info) -> dict:
+    """Constructor arguments of the app class, from `init_kwargs` in the manifest."""
+    return dict(app_info.get("init_kwargs") or {})
+
+def create_session_shards(app_info, ray_serve_config) -> list:
+    """Deploy a session-affine app as a list of single-replica shards.
+
+    The app manager pins each user to one shard, so state kept inside a
+    replica (e.g. MicroSAM embeddings) is found again by the next request.
+    """
+    shard_config = dict(ray_serve_config)
+    autoscaling_config = dict(shard_config.get("autoscaling_config") or {})
+    if autoscaling_config:
+        num_shards = autoscaling_config.get("max_replicas", 1)
+        autoscaling_config["max_replicas"] = 1
+        autoscaling_config["min_replicas"] = min(
+            autoscaling_config.get("min_replicas", 0), 1
+        )
+        shard_config["autoscaling_config"] = autoscaling_config
+    else:
+        num_shards = shard_config.get("num_replicas", 1)
+        shard_config["num_replicas"] = 1
+    return [
+        serve.deployment(name=f"{app_info.id}_{i}", **shard_config)(
+            app_info.app_class
+        ).bind(**get_init_kwargs(app_info))
+        for i in range(num_shards)
+    ]
+
 def load_all_apps() -> dict:
     current_dir = Path(os.path.dirname(os.path.realpath(__file__)))
     apps_dir = current_dir / "ray_apps"
@@ -92,14 +219,28 @@ def load_all_apps() -> dict:
     
                 app_info = load_app(str(app_file), manifest)
                 ray_serve_config = create_ray_serve_config(app_info)
+                if app_info.get("warmup"):
+                    app_info.app_class = add_warmup(app_info)
                 # runtime_env["env_vars"] = dict(os.environ)
-                app_deployment = serve.deployment(
-                    name=app_info.id, **ray_serve_config
-                )(app_info.app_class).bind()
-                app_info.app_bind = app_deployment
+                if app_info.get("session_affinity"):
+                    app_info.session_shards = create_session_shards(
+                        app_info, ray_serve_config
+                    )
+                else:
+                    app_deployment = serve.deployment(
+                        name=app_info.id, **ray_serve_config
+                    )(app_info.app_class).bind(**get_init_kwargs(app_info))
+                    app_info.app_bind = app_deployment
                 app_info.methods = [
                     m for m in dir(app_info.app_class) if not m.startswith("_")
                 ]
+                # Generator methods are streamed chunk by chunk to the caller
+                app_info.streaming_methods = [
+                    m
+                    for m in app_info.methods
+                    if inspect.isgeneratorfunction(getattr(app_info.app_class, m))
+                    or inspect.isasyncgenfunction(getattr(app_info.app_class, m))
+                ]
                 ray_apps[app_info.id] = app_info
 
     print("Loaded apps:", ray_apps.keys())
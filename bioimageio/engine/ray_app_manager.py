@@ -1,12 +1,26 @@
 """Provide ray app loader."""
 
 import asyncio
+import contextlib
+import hashlib
+import random
 from ray import serve
 import logging
 import os
 import sys
+import time
 from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from bioimageio.engine.ray_app_admission import AdmissionController, AdmissionRejected
+from bioimageio.engine.ray_app_cache import ResultCache
 from bioimageio.engine.ray_app_loader import ray_apps
+from bioimageio.engine.ray_app_metrics import RequestMetrics
+from bioimageio.engine.ray_app_scheduler import (
+    GPUScheduler,
+    RayServeCluster,
+    get_app_gpus,
+    get_deployment_names,
+)
 
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger("ray_app_launcher")
@@ -18,68 +32,234 @@ logger.setLevel(logging.INFO)
         "runtime_env": {
             "pip": [
                 "hypha-rpc",
+                "s3fs",
                 "https://github.com/bioimage-io/bioengine/archive/refs/heads/main.zip",
             ]
         }
     }
 )
 class HyphaRayAppManager:
-    def __init__(self, server_url, workspace, token, ray_apps):
-        from hypha_rpc.sync import connect_to_server
-
+    def __init__(
+        self,
+        server_url,
+        workspace,
+        token,
+        ray_apps,
+        check_interval=10.0,
+        reconnect_delay=1.0,
+        max_reconnect_delay=60.0,
+    ):
         self.server_url = server_url
         self._apps = ray_apps
-        self._ongoing_requests = {}  # Track ongoing requests per app and method
-        self._scale_down_flags = {}  # Flags to mark apps for scaling down
+        # Latency, errors, in-flight and payload sizes per app and method
+        self.metrics = RequestMetrics()
+        # Bound concurrent and queued calls per app and method
+        self._admission = {
+            app_id: self._create_admission_controller(app_id, app_info)
+            for app_id, app_info in ray_apps.items()
+        }
+        # Reuse results of identical calls to methods declared as cacheable
+        self._result_caches = {
+            app_id: self._create_result_cache(app_info["result_cache"])
+            for app_id, app_info in ray_apps.items()
+            if app_info.get("result_cache")
+        }
+        # Evict idle apps when a requested app does not fit on the GPUs
+        self._scheduler = GPUScheduler(
+            self._create_cluster(),
+            {
+                deployment: get_app_gpus(app_info)
+                for app_id, app_info in ray_apps.items()
+                for deployment in get_deployment_names(app_id, app_info)
+            },
+        )
+        self._workspace = workspace
+        self._check_interval = check_interval
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._hypha_server = None
+        self.connection_stats = {
+            "connected": False,
+            "connects": 0,
+            "failures": 0,
+            "connect_seconds": None,
+            "register_seconds": None,
+        }
 
         assert server_url, "Server URL is required"
-        self._hypha_server = connect_to_server(
-            {"server_url": server_url, "token": token, "workspace": workspace}
+        self._services = self._create_services()
+        self._start_connection(workspace, token)
+
+    def _create_cluster(self):
+        return RayServeCluster()
+
+    def _create_admission_controller(self, app_id, app_info):
+        return AdmissionController(
+            app_id,
+            app_info.get("admission"),
+            latency=lambda method_name: self.metrics.mean_latency(app_id, method_name),
         )
 
-        def create_service_function(app_id, method_name, app_bind):
-            key = f"{app_id}:{method_name}"
-            self._ongoing_requests[key] = 0  # Initialize counter
-            self._scale_down_flags[app_id] = False  # Initialize scale down flag
+    def _create_result_cache(self, config):
+        return ResultCache(
+            config.get("max_bytes", 256 * 1024**2),
+            config.get("storage"),
+            config.get("storage_options"),
+        )
 
-            async def service_function(*args, **kwargs):
-                # Mark other apps to scale down if they are not the current app
-                self.mark_apps_for_scaling_down(app_id)
+    def _get_session_id(self, kwargs):
+        # Requests are pinned per user, taken from the Hypha context
+        context = kwargs.get("context") or {}
+        user = context.get("user") or {}
+        return user.get("id")
 
-                # Track the start of a request
-                self._ongoing_requests[key] += 1
-                logger.info(
-                    f"Starting request for {key}, ongoing: {self._ongoing_requests[key]}"
-                )
+    def _get_deployment(self, app_id, kwargs):
+        # Return the deployment name and handle a request is routed to
+        app_info = self._apps[app_id]
+        shards = app_info.get("session_shards")
+        if not shards:
+            return app_id, app_info["app_bind"]
+        session_id = self._get_session_id(kwargs)
+        if not session_id:
+            shard_index = random.randrange(len(shards))
+        else:
+            # Rendezvous hashing keeps most sessions in place if the shards change
+            shard_index = max(
+                range(len(shards)),
+                key=lambda i: hashlib.sha1(f"{session_id}:{i}".encode()).digest(),
+            )
+        return f"{app_id}_{shard_index}", shards[shard_index]
 
-                try:
-                    method = getattr(app_bind, method_name)
-                    results = await method.remote(*args, **kwargs)
-                    return results
-                except Exception as e:
-                    # Log the error and raise it
-                    logger.error(f"Error in {key}: {str(e)}")
-                    raise
-                finally:
-                    # Track the end of a request
-                    self._ongoing_requests[key] -= 1
-                    logger.info(
-                        f"Completed request for {key}, ongoing: {self._ongoing_requests[key]}"
+    def _create_service_function(self, app_id, method_name):
+        key = f"{app_id}:{method_name}"
+        admission = self._admission[app_id]
+        result_cache = self._result_caches.get(app_id)
+        # Methods listed under result_cache.methods in the manifest are cached
+        cache_config = None
+        if result_cache is not None:
+            cached_methods = self._apps[app_id]["result_cache"].get("methods") or {}
+            if method_name in cached_methods:
+                cache_config = cached_methods[method_name] or {}
+
+        @contextlib.asynccontextmanager
+        async def admitted(kwargs):
+            # Wait for a free slot, or fail fast if the queue is full
+            await admission.acquire(method_name, self._get_session_id(kwargs))
+            deployment = None
+            try:
+                deployment, app_handle = self._get_deployment(app_id, kwargs)
+                # Make room on the GPUs if the shard has no running replica
+                await self._scheduler.acquire(deployment)
+                yield app_handle
+            finally:
+                if deployment is not None:
+                    self._scheduler.release(deployment)
+                admission.release(method_name)
+
+        async def call_app(*args, **kwargs):
+            async with admitted(kwargs) as app_handle:
+                method = getattr(app_handle, method_name)
+                return await method.remote(*args, **kwargs)
+
+        if method_name in (self._apps[app_id].get("streaming_methods") or []):
+            if cache_config is not None:
+                logger.warning(f"Results of streaming method {key} are not cached")
+            return self._create_stream_function(app_id, method_name, admitted)
+
+        async def service_function(*args, **kwargs):
+            start_time = self.metrics.start(app_id, method_name, args, kwargs)
+            logger.debug(f"Starting request for {key}")
+            results = None
+            failed = False
+            rejected = False
+            try:
+                if cache_config is None:
+                    results = await call_app(*args, **kwargs)
+                else:
+                    results = await result_cache.call(
+                        method_name, call_app, args, kwargs, cache_config.get("ttl")
                     )
+                return results
+            except AdmissionRejected:
+                rejected = True
+                raise
+            except Exception as e:
+                # Log the error and raise it
+                failed = True
+                logger.error(f"Error in {key}: {str(e)}")
+                raise
+            finally:
+                # Track the end of a request
+                self.metrics.finish(
+                    app_id,
+                    method_name,
+                    start_time,
+                    results,
+                    error=failed,
+                    rejected=rejected,
+                )
+                logger.debug(f"Completed request for {key}")
 
-                    # If no ongoing requests and flag is set, scale down
-                    if (
-                        self._ongoing_requests[key] == 0
-                        and self._scale_down_flags[app_id]
-                    ):
-                        self.scale_down_if_idle(app_id)
+        service_function.__name__ = method_name
+        return service_function
 
-            service_function.__name__ = method_name
-            return service_function
+    def _create_stream_function(self, app_id, method_name, admitted):
+        key = f"{app_id}:{method_name}"
+        # Streams hold their slot until they end, unless the manifest lists
+        # them under release_after_first_chunk, e.g. streams that only watch
+        # a background job for hours
+        release_after_first_chunk = method_name in (
+            self._apps[app_id].get("release_after_first_chunk") or []
+        )
+
+        async def stream_function(*args, **kwargs):
+            start_time = self.metrics.start(app_id, method_name, args, kwargs)
+            logger.debug(f"Starting stream for {key}")
+            failed = False
+            rejected = False
+            try:
+                async with contextlib.AsyncExitStack() as admission_stack:
+                    app_handle = await admission_stack.enter_async_context(
+                        admitted(kwargs)
+                    )
+                    method = getattr(app_handle.options(stream=True), method_name)
+                    response = method.remote(*args, **kwargs)
+                    finished = False
+                    first = True
+                    try:
+                        # Forward each chunk as soon as the replica yields it
+                        async for chunk in response:
+                            self.metrics.record_chunk(
+                                app_id, method_name, start_time, chunk, first
+                            )
+                            if first and release_after_first_chunk:
+                                await admission_stack.aclose()
+                            first = False
+                            yield chunk
+                        finished = True
+                    finally:
+                        if not finished:
+                            # The caller stopped early, stop the replica too
+                            response.cancel()
+            except AdmissionRejected:
+                rejected = True
+                raise
+            except Exception as e:
+                failed = True
+                logger.error(f"Error in {key}: {str(e)}")
+                raise
+            finally:
+                self.metrics.finish(
+                    app_id, method_name, start_time, error=failed, rejected=rejected
+                )
+                logger.debug(f"Completed stream for {key}")
 
+        stream_function.__name__ = method_name
+        return stream_function
+
+    def _create_services(self):
+        services = {}
         for app_id, app_info in self._apps.items():
-            app_bind = app_info["app_bind"]
-            methods = app_info["methods"]
             app_service = {
                 "id": app_id,
                 "name": app_info["name"],
@@ -90,49 +270,170 @@ class HyphaRayAppManager:
                 svc_config = app_info["service_config"]
                 app_service["config"].update(svc_config)
 
-            for method in methods:
-                logger.info(f"Registering method {method} for app {app_id}")
-                app_service[method] = create_service_function(app_id, method, app_bind)
-            info = self._hypha_server.register_service(app_service, {"overwrite": True})
+            for method in app_info["methods"]:
+                app_service[method] = self._create_service_function(app_id, method)
+            services[app_id] = app_service
+
+        services["ray-apps"] = {
+            "id": "ray-apps",
+            "name": "Ray Apps",
+            "description": "Apps served by the BioEngine Ray cluster",
+            "config": {"visibility": "public"},
+            "apps": {
+                app_id: app_info["methods"] for app_id, app_info in self._apps.items()
+            },
+        }
+        return services
+
+    def _start_connection(self, workspace, token):
+        # The constructor runs inside the replica's event loop
+        self._connection_task = asyncio.get_running_loop().create_task(
+            self._maintain_connection(workspace, token)
+        )
+
+    async def _connect(self, workspace, token):
+        from hypha_rpc import connect_to_server
+
+        return await connect_to_server(
+            {"server_url": self.server_url, "token": token, "workspace": workspace}
+        )
+
+    async def _register_services(self):
+        async def register(service):
+            info = await self._hypha_server.register_service(
+                service, {"overwrite": True}
+            )
             logger.info(
-                f"Added service {app_id} with id {info.id}, use it at {self.server_url}/{workspace}/services/{info.id.split('/')[1]}"
+                f"Added service {service['id']} with id {info.id}, use it at {self.server_url}/{self._workspace}/services/{info.id.split('/')[1]}"
             )
 
-        apps = {}
-        for app_id, app_info in self._apps.items():
-            apps[app_id] = app_info["methods"]
+        await asyncio.gather(*[register(s) for s in self._services.values()])
 
-        info = self._hypha_server.register_service(
-            {
-                "id": "ray-apps",
-                "name": app_info["name"],
-                "description": app_info["description"],
-                "config": {"visibility": "public"},
-                "apps": apps,
-            },
-            {"overwrite": True},
-        )
-        logger.info(f"Registered Ray Apps service with id {info.id}")
+    async def _wait_until_disconnected(self):
+        while True:
+            await asyncio.sleep(self._check_interval)
+            await asyncio.wait_for(
+                self._hypha_server.echo("ping"), timeout=self._check_interval
+            )
 
-    def mark_apps_for_scaling_down(self, current_app_id):
-        # Iterate through all apps to set scale down flags
-        for app_id, app_info in self._apps.items():
-            if app_id != current_app_id:  # Skip the current app
-                for method_name in app_info["methods"]:
-                    key = f"{app_id}:{method_name}"
-                    if self._ongoing_requests.get(key, 0) > 0:
-                        self._scale_down_flags[app_id] = True
-                        logger.info(
-                            f"Marked {app_id} for scaling down after completion"
-                        )
-
-    def scale_down_if_idle(self, app_id):
-        pass
-        # deployment_handle = serve.get_deployment_handle(app_id)
-        # deployment_handle.options(num_replicas=0).deploy()
-        # logger.info(f"Scaled down deployment {app_id} due to inactivity")
+    async def _maintain_connection(self, workspace, token):
+        """Connect to Hypha, register the services and reconnect on failures."""
+        delay = self._reconnect_delay
+        while True:
+            try:
+                start_time = time.perf_counter()
+                self._hypha_server = await self._connect(workspace, token)
+                connected_time = time.perf_counter()
+                await self._register_services()
+                registered_time = time.perf_counter()
+                self.connection_stats.update(
+                    connected=True,
+                    connects=self.connection_stats["connects"] + 1,
+                    connect_seconds=connected_time - start_time,
+                    register_seconds=registered_time - connected_time,
+                )
+                logger.info(
+                    f"Connected to {self.server_url} in {connected_time - start_time:.2f}s, "
+                    f"registered {len(self._services)} services in {registered_time - connected_time:.2f}s"
+                )
+                delay = self._reconnect_delay
+                await self._wait_until_disconnected()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.connection_stats["failures"] += 1
+                logger.warning(
+                    f"Lost connection to {self.server_url} ({e}), reconnecting in {delay:.1f}s"
+                )
+            self.connection_stats["connected"] = False
+            if self._hypha_server is not None:
+                try:
+                    await self._hypha_server.disconnect()
+                except Exception:
+                    pass
+                self._hypha_server = None
+            # Back off exponentially, with jitter so replicas do not reconnect in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self._max_reconnect_delay)
+
+    def render_metrics(self) -> str:
+        """Render request and connection metrics in Prometheus text format."""
+        self.metrics.set_gauge(
+            "bioengine_hypha_connected",
+            int(self.connection_stats["connected"]),
+            "Whether the manager is connected to the Hypha server.",
+        )
+        self.metrics.set_gauge(
+            "bioengine_hypha_connects",
+            self.connection_stats["connects"],
+            "Successful connections to the Hypha server.",
+        )
+        self.metrics.set_gauge(
+            "bioengine_hypha_connect_failures",
+            self.connection_stats["failures"],
+            "Failed connection attempts to the Hypha server.",
+        )
+        for app_id, admission in self._admission.items():
+            for method_name in self._apps[app_id]["methods"]:
+                self.metrics.set_gauge(
+                    "bioengine_requests_queued",
+                    admission.queued(method_name),
+                    "Requests waiting for admission.",
+                    app=app_id,
+                    method=method_name,
+                )
+        # Users drop out of the queue gauges once they have nothing queued
+        self.metrics.clear_gauge("bioengine_user_requests_queued")
+        self.metrics.clear_gauge("bioengine_user_queue_position")
+        for app_id, admission in self._admission.items():
+            for user_id, (queued, position) in admission.user_queues().items():
+                self.metrics.set_gauge(
+                    "bioengine_user_requests_queued",
+                    queued,
+                    "Requests of a user waiting for admission.",
+                    app=app_id,
+                    user=user_id,
+                )
+                self.metrics.set_gauge(
+                    "bioengine_user_queue_position",
+                    position,
+                    "Queue position of the next request of a user, 0 is next.",
+                    app=app_id,
+                    user=user_id,
+                )
+            self.metrics.set_gauge(
+                "bioengine_requests_throttled_total",
+                admission.throttled,
+                "Requests rejected by the per-user rate limit.",
+                kind="counter",
+                app=app_id,
+            )
+        for app_id, result_cache in self._result_caches.items():
+            for method_name, stats in result_cache.stats.items():
+                for name in ("hits", "misses", "coalesced", "evictions"):
+                    self.metrics.set_gauge(
+                        f"bioengine_result_cache_{name}_total",
+                        stats[name],
+                        f"Result cache {name}.",
+                        kind="counter",
+                        app=app_id,
+                        method=method_name,
+                    )
+            self.metrics.set_gauge(
+                "bioengine_result_cache_bytes",
+                result_cache.nbytes,
+                "Size of the cached results.",
+                app=app_id,
+            )
+        return self.metrics.render()
 
     async def __call__(self, request: Request):
+        # Serve metrics for Prometheus at /metrics
+        if request.url.path.rstrip("/").endswith("/metrics"):
+            return PlainTextResponse(
+                self.render_metrics(),
+                media_type="text/plain; version=0.0.4",
+            )
         # Return a JSON object with the services
         services = {}
         for app_id, app_info in self._apps.items():
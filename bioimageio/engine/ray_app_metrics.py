@@ -0,0 +1,225 @@
+"""Provide request metrics for ray apps in Prometheus text format."""
+import bisect
+import time
+from collections import deque
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def escape_label_value(value) -> str:
+    """Escape a label value as the Prometheus text format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def payload_nbytes(value, depth=3) -> int:
+    """Estimate the size of an RPC payload without serializing it."""
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value)
+    if depth == 0:
+        return 0
+    if isinstance(value, dict):
+        return sum(
+            payload_nbytes(v, depth - 1) for k, v in value.items() if k != "context"
+        )
+    if isinstance(value, (list, tuple)):
+        return sum(payload_nbytes(v, depth - 1) for v in value)
+    return 0
+
+
+class MethodStats:
+    """Counters, latency histogram and recent latencies of one method."""
+
+    def __init__(self, window: int):
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.recent = deque(maxlen=window)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.chunks = 0
+        self.first_chunk_count = 0
+        self.first_chunk_sum = 0.0
+
+
+class RequestMetrics:
+    """Collect per app and method request metrics.
+
+    Recording a request costs a few counter updates and one bisect; the
+    quantiles are computed from the last `window` latencies when the
+    metrics are rendered.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.methods = {}  # (app_id, method) -> MethodStats
+        self.gauges = {}  # name -> (kind, help, {labels: value})
+
+    def _stats(self, app_id, method) -> MethodStats:
+        stats = self.methods.get((app_id, method))
+        if stats is None:
+            stats = self.methods[(app_id, method)] = MethodStats(self.window)
+        return stats
+
+    def start(self, app_id, method, args=(), kwargs=None) -> float:
+        stats = self._stats(app_id, method)
+        stats.in_flight += 1
+        stats.request_bytes += payload_nbytes(args) + payload_nbytes(kwargs or {})
+        return time.perf_counter()
+
+    def finish(
+        self, app_id, method, start_time, result=None, error=False, rejected=False
+    ):
+        latency = time.perf_counter() - start_time
+        stats = self._stats(app_id, method)
+        stats.in_flight -= 1
+        if rejected:
+            # Rejected calls never ran and do not count towards the latency
+            stats.rejected += 1
+            return
+        stats.requests += 1
+        if error:
+            stats.errors += 1
+        else:
+            stats.response_bytes += payload_nbytes(result)
+        stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        stats.latency_sum += latency
+        stats.recent.append(latency)
+
+    def record_chunk(self, app_id, method, start_time, chunk, first=False):
+        """Record one chunk of a streaming response."""
+        stats = self._stats(app_id, method)
+        if first:
+            stats.first_chunk_count += 1
+            stats.first_chunk_sum += time.perf_counter() - start_time
+        stats.chunks += 1
+        stats.response_bytes += payload_nbytes(chunk)
+
+    def set_gauge(self, name, value, help_text="", kind="gauge", **labels):
+        _, _, values = self.gauges.setdefault(name, (kind, help_text, {}))
+        values[tuple(sorted(labels.items()))] = value
+
+    def clear_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def mean_latency(self, app_id, method):
+        recent = self._stats(app_id, method).recent
+        return sum(recent) / len(recent) if recent else None
+
+    def quantiles(self, app_id, method) -> dict:
+        recent = sorted(self._stats(app_id, method).recent)
+        if not recent:
+            return {q: float("nan") for q in QUANTILES}
+        return {
+            q: recent[min(int(q * len(recent)), len(recent) - 1)] for q in QUANTILES
+        }
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(
+                    f'{k}="{escape_label_value(v)}"' for k, v in labels.items()
+                )
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(f"{name}{suffix}{label_text} {value}")
+
+        items = sorted(self.methods.items())
+        labels = {key: {"app": key[0], "method": key[1]} for key, _ in items}
+        metric(
+            "bioengine_requests_total",
+            "counter",
+            "Completed requests.",
+            [("", labels[key], s.requests) for key, s in items],
+        )
+        metric(
+            "bioengine_request_errors_total",
+            "counter",
+            "Requests that raised an error.",
+            [("", labels[key], s.errors) for key, s in items],
+        )
+        metric(
+            "bioengine_requests_rejected_total",
+            "counter",
+            "Requests rejected by admission control.",
+            [("", labels[key], s.rejected) for key, s in items],
+        )
+        metric(
+            "bioengine_requests_in_flight",
+            "gauge",
+            "Requests currently being processed.",
+            [("", labels[key], s.in_flight) for key, s in items],
+        )
+        histogram = []
+        for key, s in items:
+            count = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), s.buckets):
+                count += bucket
+                histogram.append(("_bucket", {**labels[key], "le": bound}, count))
+            histogram.append(("_sum", labels[key], s.latency_sum))
+            histogram.append(("_count", labels[key], count))
+        metric(
+            "bioengine_request_duration_seconds",
+            "histogram",
+            "Request latency.",
+            histogram,
+        )
+        summary = []
+        for key, s in items:
+            for q, value in self.quantiles(*key).items():
+                summary.append(("", {**labels[key], "quantile": q}, value))
+            summary.append(("_sum", labels[key], sum(s.recent)))
+            summary.append(("_count", labels[key], len(s.recent)))
+        metric(
+            "bioengine_request_latency_seconds",
+            "summary",
+            f"Latency quantiles over the last {self.window} requests.",
+            summary,
+        )
+        for name, help_text, attribute in (
+            ("bioengine_request_bytes_total", "Request payload size.", "request_bytes"),
+            (
+                "bioengine_response_bytes_total",
+                "Response payload size.",
+                "response_bytes",
+            ),
+        ):
+            metric(
+                name,
+                "counter",
+                help_text,
+                [("", labels[key], getattr(s, attribute)) for key, s in items],
+            )
+        streams = [(key, s) for key, s in items if s.chunks]
+        metric(
+            "bioengine_stream_chunks_total",
+            "counter",
+            "Chunks sent by streaming methods.",
+            [("", labels[key], s.chunks) for key, s in streams],
+        )
+        first_chunk = []
+        for key, s in streams:
+            first_chunk.append(("_sum", labels[key], s.first_chunk_sum))
+            first_chunk.append(("_count", labels[key], s.first_chunk_count))
+        metric(
+            "bioengine_stream_first_chunk_seconds",
+            "summary",
+            "Time until the first chunk of a streaming method.",
+            first_chunk,
+        )
+        for name, (kind, help_text, values) in sorted(self.gauges.items()):
+            samples = [("", dict(labels), value) for labels, value in values.items()]
+            metric(name, kind, help_text, samples)
+        return "\n".join(lines) + "\n"
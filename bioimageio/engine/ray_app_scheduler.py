@@ -0,0 +1,193 @@
+"""Provide GPU-aware placement and eviction for ray apps."""
+import asyncio
+import logging
+import sys
+import time
+from collections import deque
+
+logging.basicConfig(stream=sys.stdout)
+logger = logging.getLogger("ray_app_scheduler")
+logger.setLevel(logging.INFO)
+
+
+def get_app_gpus(app_info) -> float:
+    """GPUs reserved by one replica of an app."""
+    ray_serve_config = app_info.get("ray_serve_config") or {}
+    ray_actor_options = ray_serve_config.get("ray_actor_options") or {}
+    return ray_actor_options.get("num_gpus", 0) or 0
+
+
+def get_deployment_names(app_id, app_info) -> list:
+    """Serve deployments of an app, one per session shard if it has shards."""
+    shards = app_info.get("session_shards")
+    if shards:
+        return [f"{app_id}_{i}" for i in range(len(shards))]
+    return [app_id]
+
+
+def eviction_key(app_name, deployment) -> str:
+    return f"bioengine_evicted:{app_name}:{deployment}"
+
+
+def eviction_autoscaling_policy(ctx):
+    """Serve autoscaling policy that scales evicted deployments to zero.
+
+    Follows Serve's default queue length policy, except that a deployment
+    flagged by `RayServeCluster.scale_down` is scaled to zero once no
+    requests are left in its look-back window; Serve still applies the
+    `downscale_delay_s` of the manifest. Scaling down while requests are
+    counted would only trigger Serve's cold start right after. Serve
+    pickles the policy by value for its controller.
+    """
+    from ray.experimental.internal_kv import _internal_kv_get
+    from ray.serve.autoscaling_policy import replica_queue_length_autoscaling_policy
+
+    if not ctx.total_num_requests and _internal_kv_get(
+        eviction_key(ctx.app_name, ctx.deployment_name)
+    ):
+        return 0, ctx.policy_state
+    return replica_queue_length_autoscaling_policy(ctx)
+
+
+class RayServeCluster:
+    """Read GPU capacity of the running Serve cluster and evict deployments.
+
+    Evicted deployments are flagged in the Ray internal KV store, where
+    `eviction_autoscaling_policy` scales them to zero, the
+    same way Serve scales idle deployments down.
+    """
+
+    def _app_name(self) -> str:
+        from ray import serve
+
+        return serve.get_replica_context().app_name
+
+    def free_gpus(self) -> float:
+        import ray
+
+        return ray.available_resources().get("GPU", 0)
+
+    def running_deployments(self) -> set:
+        from ray import serve
+
+        deployments = serve.status().applications[self._app_name()].deployments
+        return {
+            name
+            for name, status in deployments.items()
+            if status.replica_states.get("RUNNING", 0)
+        }
+
+    def scale_down(self, deployment):
+        from ray.experimental.internal_kv import _internal_kv_put
+
+        _internal_kv_put(eviction_key(self._app_name(), deployment), b"1")
+
+    def cancel_scale_down(self, deployment):
+        from ray.experimental.internal_kv import _internal_kv_del
+
+        _internal_kv_del(eviction_key(self._app_name(), deployment))
+
+
+class GPUScheduler:
+    """Track deployment usage and evict idle ones when a request cannot be placed.
+
+    Every request is wrapped in `acquire` and `release` with the deployment
+    (or session shard) it is routed to. When that deployment has no running
+    replica and the cluster lacks the GPUs to start one, the least recently
+    used deployments without in-flight requests are scaled down until it
+    fits. The running deployments are read from the cluster at most every
+    `state_ttl` seconds, so requests to a running deployment return without
+    waiting for the cluster or the lock. Decisions are logged with their
+    reason and kept in `decisions`.
+    """
+
+    def __init__(self, cluster, deployment_gpus: dict, state_ttl: float = 5.0):
+        self.cluster = cluster
+        self.deployment_gpus = deployment_gpus
+        self.state_ttl = state_ttl
+        self.in_flight = {name: 0 for name in deployment_gpus}
+        self.last_used = {name: 0.0 for name in deployment_gpus}
+        self.decisions = deque(maxlen=100)
+        self._running = set()
+        self._refreshed_at = None
+        self._evicted = set()
+        self._lock = asyncio.Lock()
+
+    def _decide(self, action, deployment, reason):
+        self.decisions.append(
+            {"time": time.time(), "action": action, "app": deployment, "reason": reason}
+        )
+        logger.info(f"{action} {deployment}: {reason}")
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._refreshed_at is not None
+            and time.monotonic() - self._refreshed_at < self.state_ttl
+        )
+
+    async def acquire(self, deployment):
+        self.in_flight[deployment] += 1
+        self.last_used[deployment] = time.monotonic()
+        needed = self.deployment_gpus.get(deployment, 0)
+        if not needed:
+            return
+        if deployment in self._running and self._is_fresh():
+            return
+        async with self._lock:
+            if not self._is_fresh():
+                self._running = await asyncio.to_thread(
+                    self.cluster.running_deployments
+                )
+                self._refreshed_at = time.monotonic()
+            if deployment in self._evicted:
+                # Let the autoscaler start the deployment again
+                await asyncio.to_thread(self.cluster.cancel_scale_down, deployment)
+                self._evicted.discard(deployment)
+            if deployment in self._running:
+                return
+            free = await asyncio.to_thread(self.cluster.free_gpus)
+            if free < needed:
+                candidates = sorted(
+                    (
+                        other
+                        for other in self._running
+                        if other != deployment
+                        and self.deployment_gpus.get(other)
+                        and not self.in_flight[other]
+                    ),
+                    key=self.last_used.get,
+                )
+                for other in candidates:
+                    if free >= needed:
+                        break
+                    idle_time = time.monotonic() - self.last_used[other]
+                    try:
+                        await asyncio.to_thread(self.cluster.scale_down, other)
+                    except Exception as e:
+                        logger.warning(f"Failed to scale down {other}: {e}")
+                        continue
+                    self._running.discard(other)
+                    self._evicted.add(other)
+                    # The GPUs are released once the autoscaler stops the replica
+                    free += self.deployment_gpus[other]
+                    self._decide(
+                        "scale down",
+                        other,
+                        f"least recently used idle app ({idle_time:.0f}s idle), "
+                        f"frees {self.deployment_gpus[other]} GPU(s) for {deployment}",
+                    )
+            if free >= needed:
+                self._running.add(deployment)
+                self._decide(
+                    "scale up", deployment, f"needs {needed} GPU(s), {free} available"
+                )
+            else:
+                self._decide(
+                    "wait",
+                    deployment,
+                    f"needs {needed} GPU(s), {free} available and no idle app to evict",
+                )
+
+    def release(self, deployment):
+        self.in_flight[deployment] -= 1
+        self.last_used[deployment] = time.monotonic()
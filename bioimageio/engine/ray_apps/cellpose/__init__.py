@@ -1,52 +1,1022 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from hypha_rpc import api
 import numpy as np
 
+from bioimageio.engine.image_io import check_uri, open_image
+
+
+def encode_mask(mask: np.ndarray, encoding: str = "array"):
+    """Encode a label mask for the response.
+
+    - "array": the mask as a numpy array of the smallest unsigned integer type
+    - "rle": run-length encoding of the flattened mask,
+      `{"shape", "dtype", "values", "lengths"}`
+    - "compressed": zlib-compressed mask bytes, `{"shape", "dtype", "data"}`
+    - "list": nested Python lists (the previous response format)
+    """
+    mask = np.asarray(mask)
+    dtype = np.uint16 if mask.size == 0 or mask.max() < 2**16 else np.uint32
+    mask = np.ascontiguousarray(mask, dtype=dtype)
+    if encoding == "array":
+        return mask
+    if encoding == "rle":
+        flat = mask.ravel()
+        starts = np.flatnonzero(np.diff(flat)) + 1
+        starts = np.concatenate([[0], starts]) if flat.size else starts
+        lengths = np.diff(np.concatenate([starts, [flat.size]]))
+        return {
+            "shape": list(mask.shape),
+            "dtype": mask.dtype.name,
+            "values": flat[starts],
+            "lengths": lengths.astype(np.uint32),
+        }
+    if encoding == "compressed":
+        return {
+            "shape": list(mask.shape),
+            "dtype": mask.dtype.name,
+            "data": zlib.compress(mask.tobytes(), 1),
+        }
+    if encoding == "list":
+        return mask.tolist()
+    raise ValueError(
+        f"Invalid mask encoding {encoding}, use 'array', 'rle', 'compressed' or 'list'."
+    )
+
+
+def decode_mask(encoded) -> np.ndarray:
+    """Decode a mask returned by `encode_mask` into a numpy array."""
+    if isinstance(encoded, np.ndarray):
+        return encoded
+    if isinstance(encoded, list):
+        return np.array(encoded)
+    if "data" in encoded:
+        data = zlib.decompress(encoded["data"])
+        return np.frombuffer(data, dtype=encoded["dtype"]).reshape(encoded["shape"])
+    values = np.asarray(encoded["values"], dtype=encoded["dtype"])
+    return np.repeat(values, encoded["lengths"]).reshape(encoded["shape"])
+
+
+def _parameter_nbytes(obj, seen=None, depth=3) -> int:
+    """Sum the parameter bytes of the torch modules reachable from `obj`."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if callable(getattr(obj, "parameters", None)):
+        return sum(p.numel() * p.element_size() for p in obj.parameters())
+    if depth == 0 or not hasattr(obj, "__dict__"):
+        return 0
+    return sum(_parameter_nbytes(v, seen, depth - 1) for v in vars(obj).values())
+
+
+class ModelCache:
+    """LRU cache of loaded models, bounded by count and parameter memory.
+
+    Concurrent requests for a model that is not loaded yet wait for a single
+    load instead of each loading their own copy.
+    """
+
+    def __init__(self, load_model, max_models: int = 3, max_bytes: int = None):
+        self.load_model = load_model
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._models = OrderedDict()  # key -> (model, nbytes)
+        self._loading = {}  # key -> Future of the ongoing load
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "loads": 0,
+            "load_time": 0.0,
+        }
+
+    def _evict(self):
+        while len(self._models) > 1 and (
+            len(self._models) > self.max_models
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            key, (_, nbytes) = self._models.popitem(last=False)
+            self.nbytes -= nbytes
+            self.stats["evictions"] += 1
+            print(f"Evicted model: {key}")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._models[key][0]
+            future = self._loading.get(key)
+            owner = future is None
+            if owner:
+                self.stats["misses"] += 1
+                future = self._loading[key] = Future()
+            else:
+                self.stats["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            start_time = time.perf_counter()
+            model = self.load_model(key)
+            load_time = time.perf_counter() - start_time
+            with self._lock:
+                nbytes = _parameter_nbytes(model)
+                self._models[key] = (model, nbytes)
+                self.nbytes += nbytes
+                self.stats["loads"] += 1
+                self.stats["load_time"] += load_time
+                self._evict()
+            future.set_result(model)
+            return model
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            requests = (
+                self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+            )
+            return {
+                **self.stats,
+                "hit_rate": self.stats["hits"] / requests if requests else 0.0,
+                "models": list(self._models.keys()),
+                "nbytes": self.nbytes,
+            }
+
+
+class PredictBatcher:
+    """Collect concurrent requests for a short window and run them together.
+
+    Requests are grouped by a key; requests with the same key are merged into
+    one call of `run_batch(key, items)`, which must return one result per item.
+    Batches run one at a time on a worker thread, so requests arriving while
+    the device is busy accumulate into the next batch.
+    """
+
+    def __init__(self, run_batch, max_batch_size: int = 16, batch_wait_timeout: float = 0.01):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_wait_timeout = batch_wait_timeout
+        self._pending = {}  # key -> (requests, timer handle)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {
+            "batches": 0,
+            "requests": 0,
+            "items": 0,
+            "max_batch_size": 0,
+            "queue_wait": 0.0,
+            "max_queue_wait": 0.0,
+        }
+
+    async def submit(self, key, items: list):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if key not in self._pending:
+            timer = loop.call_later(self.batch_wait_timeout, self._flush, key)
+            self._pending[key] = ([], timer)
+        requests, _ = self._pending[key]
+        requests.append((items, future, time.perf_counter()))
+        if sum(len(request[0]) for request in requests) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        requests, timer = self._pending.pop(key, (None, None))
+        if requests:
+            timer.cancel()
+            asyncio.ensure_future(self._run(key, requests))
+
+    async def _run(self, key, requests):
+        loop = asyncio.get_running_loop()
+        items = [item for request in requests for item in request[0]]
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self._timed_run_batch, key, items, requests
+            )
+        except Exception as e:
+            for _, future, _ in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        offset = 0
+        for request_items, future, _ in requests:
+            if not future.done():
+                future.set_result(results[offset : offset + len(request_items)])
+            offset += len(request_items)
+
+    def _timed_run_batch(self, key, items, requests):
+        # queue wait is measured up to the moment the batch reaches the device
+        now = time.perf_counter()
+        waits = [now - enqueued_at for _, _, enqueued_at in requests]
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(requests)
+        self.stats["items"] += len(items)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(items))
+        self.stats["queue_wait"] += sum(waits)
+        self.stats["max_queue_wait"] = max(self.stats["max_queue_wait"], max(waits))
+        return self.run_batch(key, items)
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        batches, requests = stats["batches"], stats["requests"]
+        stats["mean_batch_size"] = stats["items"] / batches if batches else 0.0
+        stats["mean_queue_wait"] = stats.pop("queue_wait") / requests if requests else 0.0
+        return stats
+
+
+def tile_starts(length: int, tile_size: int, tile_overlap: int) -> list:
+    """Start offsets of overlapping tiles covering `length` pixels."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - tile_overlap))
+    starts.append(length - tile_size)
+    return starts
+
+
+class TiledLabelStitcher:
+    """Stitch per-tile label images into one label image on disk.
+
+    Each tile owns a core region, the tile minus half of the overlap with
+    its neighbours, and only the core is written to the chunked output
+    array. When a tile arrives, its labels are matched against the cores
+    already written inside its extent; labels with an IoU above
+    `match_threshold` are merged. Tiles can arrive in any order, and memory
+    is bounded by the tile size. `finish` rewrites the output chunk by chunk
+    with consecutive label ids.
+    """
+
+    def __init__(self, path: str, shape: tuple, tile_size: int = 1024, tile_overlap: int = 128, match_threshold: float = 0.5):
+        import zarr
+
+        assert tile_overlap < tile_size, "tile_overlap must be smaller than tile_size"
+        self.path = path
+        self.shape = tuple(shape[:2])
+        self.tile_size = tile_size
+        self.match_threshold = match_threshold
+        self.starts = [tile_starts(n, tile_size, tile_overlap) for n in self.shape]
+        # core edges lie in the middle of the overlap between consecutive tiles
+        self.core_edges = [
+            [0] + [(a + b + tile_size) // 2 for a, b in zip(starts, starts[1:])] + [n]
+            for starts, n in zip(self.starts, self.shape)
+        ]
+        chunks = min(tile_size, self.shape[0]), min(tile_size, self.shape[1])
+        self.labels = zarr.open(path, mode="w", shape=self.shape, chunks=chunks, dtype="uint32")
+        self.done = set()
+        self.next_label = 1
+        self._parent = {}
+        self._written = set()
+        self._lock = threading.Lock()
+
+    @property
+    def tiles(self) -> list:
+        """Tile bounds as [top, left, bottom, right], in row-major order."""
+        return [
+            [top, left, min(top + self.tile_size, self.shape[0]), min(left + self.tile_size, self.shape[1])]
+            for top in self.starts[0]
+            for left in self.starts[1]
+        ]
+
+    def _find(self, label):
+        root = label
+        while self._parent.get(root, root) != root:
+            root = self._parent[root]
+        while label != root:
+            self._parent[label], label = root, self._parent.get(label, label)
+        return root
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a != b:
+            self._parent[max(a, b)] = min(a, b)
+
+    def _core(self, i: int, j: int) -> tuple:
+        rows, cols = self.core_edges
+        return rows[i], cols[j], rows[i + 1], cols[j + 1]
+
+    def add_tile(self, mask: np.ndarray, top: int, left: int):
+        i, j = self.starts[0].index(top), self.starts[1].index(left)
+        bottom, right = top + mask.shape[0], left + mask.shape[1]
+        assert (top, left, bottom, right) == tuple(self.tiles[i * len(self.starts[1]) + j]), "mask does not match the tile shape"
+        with self._lock:
+            if (i, j) in self.done:
+                return
+            # give the tile labels ids that are unique across the whole image
+            mask = mask.astype(np.int64)
+            count = int(mask.max())
+            mask[mask > 0] += self.next_label - 1
+            self.next_label += count
+
+            # match against the cores of finished neighbours inside this tile
+            existing = self.labels[top:bottom, left:right]
+            compared = np.zeros(mask.shape, dtype=bool)
+            for ni, nj in self.done:
+                r0, c0, r1, c1 = self._core(ni, nj)
+                r0, c0 = max(r0, top) - top, max(c0, left) - left
+                r1, c1 = min(r1, bottom) - top, min(c1, right) - left
+                if r0 < r1 and c0 < c1:
+                    compared[r0:r1, c0:c1] = True
+            if compared.any():
+                new, old = mask[compared], existing[compared].astype(np.int64)
+                both = (new > 0) & (old > 0)
+                pairs, intersection = np.unique(np.stack([new[both], old[both]]), axis=1, return_counts=True)
+                new_ids, new_area = np.unique(new[new > 0], return_counts=True)
+                old_ids, old_area = np.unique(old[old > 0], return_counts=True)
+                new_area = dict(zip(new_ids.tolist(), new_area.tolist()))
+                old_area = dict(zip(old_ids.tolist(), old_area.tolist()))
+                for (a, b), n in zip(pairs.T.tolist(), intersection.tolist()):
+                    if n / (new_area[a] + old_area[b] - n) > self.match_threshold:
+                        self._union(a, b)
+
+            r0, c0, r1, c1 = self._core(i, j)
+            core = mask[r0 - top : r1 - top, c0 - left : c1 - left]
+            self.labels[r0:r1, c0:c1] = core
+            self._written.update(np.unique(core[core > 0]).tolist())
+            self.done.add((i, j))
+
+    def finish(self) -> dict:
+        """Merge matched labels and renumber them consecutively."""
+        with self._lock:
+            assert len(self.done) == len(self.tiles), f"{len(self.tiles) - len(self.done)} tiles are missing"
+            roots = {label: self._find(label) for label in self._written}
+            new_ids = {root: i for i, root in enumerate(sorted(set(roots.values())), 1)}
+            lookup = np.zeros(self.next_label, dtype=np.uint32)
+            for label, root in roots.items():
+                lookup[label] = new_ids[root]
+            rows, cols = self.labels.chunks
+            for r in range(0, self.shape[0], rows):
+                for c in range(0, self.shape[1], cols):
+                    chunk = self.labels[r : r + rows, c : c + cols]
+                    self.labels[r : r + rows, c : c + cols] = lookup[chunk]
+            return {
+                "path": self.path,
+                "shape": list(self.shape),
+                "chunks": list(self.labels.chunks),
+                "num_labels": len(new_ids),
+            }
+
+
+def _read_manifest(manifest, storage_options: dict = None) -> list:
+    # A manifest is a list of inputs, or the URL of a JSON list or a text file
+    # with one input per line
+    if isinstance(manifest, str):
+        import fsspec
+
+        with fsspec.open(manifest, "r", **(storage_options or {})) as f:
+            text = f.read()
+        if manifest.lower().endswith(".json"):
+            manifest = json.loads(text)
+        else:
+            manifest = [line.strip() for line in text.splitlines() if line.strip()]
+    return [{"uri": item} if isinstance(item, str) else dict(item) for item in manifest]
+
+
+def _output_name(item: dict) -> str:
+    if item.get("output"):
+        # Outputs are plain file names in the output directory of the job
+        name = item["output"]
+        if not isinstance(name, str) or "/" in name or "\\" in name or name in (".", ".."):
+            raise ValueError(f"Output name {name!r} must be a plain file name.")
+        return name
+    # The input name keeps outputs readable, the hash keeps them unique
+    stem = os.path.basename(item["uri"].rstrip("/")).split(".")[0]
+    return f"{stem}-{hashlib.sha1(item['uri'].encode()).hexdigest()[:8]}.npy"
+
+
+def _uris_from_env(name: str) -> list:
+    return [uri.strip() for uri in os.environ.get(name, "").split(",") if uri.strip()]
+
+
+class CellposeTrainer:
+    """Fine-tune a Cellpose network with periodic checkpoints.
+
+    Runs in a thread of the replica, or as a Ray actor so that concurrent
+    jobs are scheduled on the free GPUs of the cluster. The loss of every
+    epoch is kept in `losses` for `get_progress`.
+    """
+
+    def __init__(self, job_id: str, training_dir: str, use_gpu: bool = False):
+        self.job_id = job_id
+        self.checkpoint_dir = os.path.join(training_dir, job_id)
+        self.use_gpu = use_gpu
+        self.status = "queued"
+        self.error = None
+        self.epoch = 0
+        self.losses = []
+        self.checkpoints = []
+        self.model_path = None
+        self._cancelled = False
+
+    def _create_net(self, model_type: str):
+        from cellpose import models
+
+        return models.CellposeModel(gpu=self.use_gpu, model_type=model_type).net
+
+    def _compute_flows(self, labels: list, device) -> list:
+        from cellpose import dynamics
+
+        # Flows are computed per label image, in parallel
+        with ThreadPoolExecutor(min(len(labels), os.cpu_count() or 1)) as executor:
+            return list(
+                executor.map(
+                    lambda label: dynamics.labels_to_flows([label], device=device)[0],
+                    labels,
+                )
+            )
+
+    def run(self, images: list, labels: list, config: dict) -> dict:
+        import torch
+        from cellpose import models, transforms, utils
+        # `train_seg` has no hook to report epochs or to stop, so the loop is
+        # rebuilt from the private `_reshape_norm` and `_loss_fn_seg` helpers;
+        # they are only stable within cellpose 3.0.x, pinned in the manifest
+        from cellpose import train as cellpose_train
+
+        if self._cancelled:
+            self.status = "cancelled"
+            return self.get_progress()
+        self.status = "running"
+        try:
+            n_epochs = config.get("n_epochs", 100)
+            batch_size = config.get("batch_size", 8)
+            learning_rate = config.get("learning_rate", 0.005)
+            save_every = config.get("save_every", 10)
+            bsize = config.get("bsize", 224)
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+            net = self._create_net(config.get("model_type", "cyto3"))
+            device = net.device
+            flows = self._compute_flows([np.asarray(label) for label in labels], device)
+            normalize_params = {**models.normalize_default, "normalize": True}
+            data = cellpose_train._reshape_norm(
+                [np.asarray(image) for image in images],
+                channels=config.get("channels", [0, 0]),
+                normalize_params=normalize_params,
+            )
+            diam_train = np.array([utils.diameters(flow[0])[0] for flow in flows])
+            diam_train[diam_train < 5] = 5.0
+            net.diam_labels.data = torch.Tensor([diam_train.mean()]).to(device)
+            optimizer = torch.optim.AdamW(
+                net.parameters(),
+                lr=learning_rate,
+                weight_decay=config.get("weight_decay", 1e-5),
+            )
+
+            rng = np.random.default_rng(config.get("seed", 0))
+            start_time = time.time()
+            for epoch in range(n_epochs):
+                if self._cancelled:
+                    self.status = "cancelled"
+                    return self.get_progress()
+                # warm up the learning rate over the first epochs like Cellpose
+                for param_group in optimizer.param_groups:
+                    param_group["lr"] = learning_rate * min(1.0, (epoch + 1) / 10)
+                net.train()
+                epoch_loss = 0.0
+                order = rng.permutation(len(data))
+                for k in range(0, len(data), batch_size):
+                    inds = order[k : k + batch_size]
+                    imgi, lbl = transforms.random_rotate_and_resize(
+                        [data[i] for i in inds],
+                        Y=[flows[i][1:] for i in inds],
+                        rescale=diam_train[inds] / net.diam_mean.item(),
+                        scale_range=0.5,
+                        xy=(bsize, bsize),
+                    )[:2]
+                    y = net(torch.from_numpy(imgi).to(device))[0]
+                    loss = cellpose_train._loss_fn_seg(lbl, y, device)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    epoch_loss += loss.item() * len(imgi)
+                self.epoch = epoch + 1
+                self.losses.append(
+                    {
+                        "epoch": self.epoch,
+                        "loss": epoch_loss / len(data),
+                        "time": time.time() - start_time,
+                    }
+                )
+                if self.epoch % save_every == 0 and self.epoch < n_epochs:
+                    path = os.path.join(self.checkpoint_dir, f"epoch_{self.epoch}.pth")
+                    net.save_model(path)
+                    self.checkpoints.append(path)
+            self.model_path = os.path.join(self.checkpoint_dir, "model.pth")
+            net.save_model(self.model_path)
+            self.status = "completed"
+        except Exception as e:
+            print(f"Training job {self.job_id} failed: {e}")
+            self.status = "failed"
+            self.error = str(e)
+        return self.get_progress()
+
+    def cancel(self):
+        self._cancelled = True
+
+    def get_progress(self, since: int = 0) -> dict:
+        return {
+            "status": self.status,
+            "error": self.error,
+            "epoch": self.epoch,
+            "losses": self.losses[since:],
+            "checkpoints": list(self.checkpoints),
+            "model_path": self.model_path,
+        }
+
+
 class CellposeModel:
-    def __init__(self):
+    def __init__(self, max_models: int = 3, max_model_bytes: int = None, max_batch_size: int = 16, batch_wait_timeout: float = 0.01, training_dir: str = None, max_training_jobs: int = 2, training_job_ttl: float = 24 * 3600, output_dir: str = None, tiled_prediction_ttl: float = 3600, readable_uris: list = None, writable_uris: list = None, dataset_job_ttl: float = 24 * 3600):
         from cellpose import core
         # Check if GPU is available
         self.use_GPU = core.use_gpu()
         print('>>> GPU activated? %d' % self.use_GPU)
-        
-        # Initialize model caching attributes
-        self.cached_model_type = None
-        self.model = None
 
-    def _load_model(self, model_type):
+        # Keep several models loaded, so alternating model types do not reload
+        self.models = ModelCache(self._create_model, max_models, max_model_bytes)
+        # Merge concurrent predict calls into one `eval` per compatible group
+        self.batcher = PredictBatcher(self._predict_batch, max_batch_size, batch_wait_timeout)
+        # Outputs are only written below this directory, never to client paths
+        self.output_dir = output_dir or os.environ.get("CELLPOSE_OUTPUT_DIR") or tempfile.mkdtemp(prefix="cellpose-")
+        # Ongoing tiled predictions, see `start_tiled_prediction`; predictions
+        # without a tile for `tiled_prediction_ttl` seconds are abandoned
+        self.tiled_predictions = {}
+        self.tiled_prediction_ttl = tiled_prediction_ttl
+        # Image references and dataset outputs must lie below these URI
+        # prefixes, e.g. a bucket on the MinIO server
+        self.readable_uris = readable_uris or _uris_from_env("CELLPOSE_READABLE_URIS")
+        self.writable_uris = writable_uris or _uris_from_env("CELLPOSE_WRITABLE_URIS") or [os.path.join(self.output_dir, "datasets")]
+        # Dataset inference jobs, see `submit_dataset_job`; finished jobs are
+        # forgotten after `dataset_job_ttl` seconds
+        self.dataset_jobs = {}
+        self.dataset_job_ttl = dataset_job_ttl
+        # Fine-tuning jobs, see `train`
+        self.training_dir = training_dir or os.environ.get(
+            "CELLPOSE_TRAINING_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "bioengine", "cellpose", "training"),
+        )
+        self.training_jobs = {}
+        # Finished training jobs are forgotten after `training_job_ttl` seconds
+        self.training_job_ttl = training_job_ttl
+        self._training_executor = ThreadPoolExecutor(max_workers=max_training_jobs)
+
+    def _create_model(self, model_type):
         from cellpose import models
-        if self.model is None or model_type != self.cached_model_type:
-            print(f'Loading model: {model_type}')
-            self.model = models.Cellpose(gpu=self.use_GPU, model_type=model_type)
-            self.cached_model_type = model_type
-        else:
-            print(f'Reusing cached model: {model_type}')
-        return self.model
+        print(f'Loading model: {model_type}')
+        return models.Cellpose(gpu=self.use_GPU, model_type=model_type)
+
+    def _load_model(self, model_type):
+        return self.models.get(model_type)
+
+    def get_model_cache_stats(self, context=None) -> dict:
+        """Return load-time and hit-rate metrics of the model cache."""
+        return self.models.get_stats()
 
-    def predict(self, images: list[np.ndarray], channels=None, diameter=None, flow_threshold=None, model_type='cyto3'):
-        """Run segmentation on the provided images using the specified model type."""
-        # Load the model, utilizing caching
+    def _predict_batch(self, key, items):
+        model_type, diameter, flow_threshold, _ = key
+        images = [image for image, _ in items]
+        channels = [list(image_channels) for _, image_channels in items]
         model = self._load_model(model_type)
+        masks, flows, styles, diams = model.eval(images, diameter=diameter, flow_threshold=flow_threshold, channels=channels)
+        diams = np.broadcast_to(np.asarray(diams, dtype=float), (len(images),))
+        return list(zip(masks, diams.tolist()))
+
+    def get_batching_stats(self, context=None) -> dict:
+        """Return batch-size and queue-wait statistics of the predict batcher."""
+        return self.batcher.get_stats()
 
+    def _open_image(self, image):
+        # Only references below `readable_uris` are read, not any server file
+        if isinstance(image, (str, dict)):
+            check_uri(image if isinstance(image, str) else image["uri"], self.readable_uris)
+        return open_image(image)
+
+    async def predict(self, images: list[np.ndarray], channels=None, diameter=None, flow_threshold=None, model_type='cyto3', mask_encoding='array', context=None):
+        """Run segmentation on the provided images using the specified model type.
+
+        Each image is an array or a reference to a chunked array, see
+        `ChunkedImage`. Concurrent calls with the same model type, channels,
+        diameter and flow threshold are batched into a single `eval`. Masks are returned as typed
+        numpy arrays by default, see `encode_mask` for the other
+        `mask_encoding` options.
+        """
+        # Open and read the referenced images in parallel, off the event loop
+        loop = asyncio.get_running_loop()
+        images = await asyncio.gather(*(
+            loop.run_in_executor(None, lambda image=image: np.asarray(self._open_image(image)))
+            for image in images
+        ))
         if channels is None:
             # Default channels if not provided
             channels = [[2, 3]] * len(images)
-        
-        # Perform segmentation using the model
-        masks, flows, styles, diams = model.eval(images, diameter=diameter, flow_threshold=flow_threshold, channels=channels)
-        
+        elif len(channels) == 2 and np.isscalar(channels[0]):
+            channels = [channels] * len(images)
+        channels = [tuple(image_channels) for image_channels in channels]
+        channels_key = channels[0] if len(set(channels)) == 1 else tuple(channels)
+
+        # Perform segmentation together with other pending requests
+        key = (model_type, diameter, flow_threshold, channels_key)
+        results = await self.batcher.submit(key, list(zip(images, channels)))
+
         # Prepare the response with masks and diameters
         results = {
-            'masks': [mask.tolist() for mask in masks],  # Converting numpy arrays to lists for JSON serialization
-            'diameters': diams  # List of estimated diameters for each image
+            'masks': [encode_mask(mask, mask_encoding) for mask, _ in results],
+            'diameters': [diam for _, diam in results]  # List of estimated diameters for each image
         }
 
         return results
 
-    def train(self, images, labels, config):
-        """Train the model using the provided images and labels."""
-        # This method would handle the training process.
-        # Currently, returning a placeholder response.
-        raise NotImplementedError("Training functionality not implemented yet")
+    async def predict_stream(self, images: list[np.ndarray], channels=None, diameter=None, flow_threshold=None, model_type='cyto3', mask_encoding='array', context=None):
+        """Like `predict`, but yield each mask as soon as it is ready.
+
+        Yields dicts with the image `index`, its `mask` and `diameter` in
+        completion order. At most one batch of images is read at a time, so
+        long image lists do not have to fit in memory.
+        """
+        loop = asyncio.get_running_loop()
+        if channels is None:
+            channels = [[2, 3]] * len(images)
+        elif len(channels) == 2 and np.isscalar(channels[0]):
+            channels = [channels] * len(images)
+        slots = asyncio.Semaphore(self.batcher.max_batch_size)
+
+        async def predict_one(index):
+            async with slots:
+                image = await loop.run_in_executor(None, lambda: np.asarray(self._open_image(images[index])))
+                image_channels = tuple(channels[index])
+                key = (model_type, diameter, flow_threshold, image_channels)
+                (mask, diam), = await self.batcher.submit(key, [(image, image_channels)])
+            return {'index': index, 'mask': encode_mask(mask, mask_encoding), 'diameter': diam}
+
+        tasks = [asyncio.ensure_future(predict_one(index)) for index in range(len(images))]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _expire_tiled_predictions(self):
+        expired_before = time.time() - self.tiled_prediction_ttl
+        for prediction_id, prediction in list(self.tiled_predictions.items()):
+            if prediction["last_used"] < expired_before:
+                self._discard_tiled_prediction(prediction_id)
+
+    def _discard_tiled_prediction(self, prediction_id):
+        prediction = self.tiled_predictions.pop(prediction_id)
+        shutil.rmtree(os.path.dirname(prediction["stitcher"].path), ignore_errors=True)
+
+    def _get_tiled_prediction(self, prediction_id):
+        prediction = self.tiled_predictions.get(prediction_id)
+        if prediction is None:
+            raise ValueError(f"Tiled prediction {prediction_id} not found.")
+        prediction["last_used"] = time.time()
+        return prediction
+
+    def start_tiled_prediction(self, shape, tile_size=1024, tile_overlap=128, channels=None, diameter=None, flow_threshold=None, model_type='cyto3', context=None):
+        """Start a tiled prediction for an image too large to send at once.
+
+        Send each of the returned tiles with `predict_tile`, then call
+        `finish_tiled_prediction`. Labels are stitched across the tile seams
+        into a chunked zarr array in the output directory of the app. Set
+        `diameter` to avoid a different diameter estimate per tile.
+        Predictions that receive no tile for `tiled_prediction_ttl` seconds
+        are discarded with their output.
+        """
+        self._expire_tiled_predictions()
+        if channels is None:
+            channels = [2, 3]
+        prediction_id = str(uuid.uuid4())
+        output_path = os.path.join(self.output_dir, "tiled", prediction_id, "labels.zarr")
+        stitcher = TiledLabelStitcher(output_path, shape, tile_size, tile_overlap)
+        self.tiled_predictions[prediction_id] = {
+            "stitcher": stitcher,
+            "key": (model_type, diameter, flow_threshold, tuple(channels)),
+            "last_used": time.time(),
+        }
+        return {"id": prediction_id, "path": output_path, "tiles": stitcher.tiles}
+
+    async def predict_tile(self, prediction_id, tile: np.ndarray, top: int, left: int, context=None):
+        """Segment one tile of a tiled prediction and stitch it into the output."""
+        prediction = self._get_tiled_prediction(prediction_id)
+        stitcher = prediction["stitcher"]
+        key = prediction["key"]
+        (mask, _), = await self.batcher.submit(key, [(tile, key[3])])
+        await asyncio.get_running_loop().run_in_executor(None, stitcher.add_tile, mask, top, left)
+        return {"done": len(stitcher.done), "total": len(stitcher.tiles)}
+
+    def finish_tiled_prediction(self, prediction_id, context=None):
+        """Reconcile the labels of a tiled prediction and return the output location."""
+        result = self._get_tiled_prediction(prediction_id)["stitcher"].finish()
+        del self.tiled_predictions[prediction_id]
+        return result
+
+    async def predict_chunked(self, image, tile_size=1024, tile_overlap=128, channels=None, diameter=None, flow_threshold=None, model_type='cyto3', prefetch=2, context=None):
+        """Run a tiled prediction on a chunked array stored on the server side.
+
+        `image` references a chunked array, see `ChunkedImage`. Tiles are
+        read as they are needed, up to `prefetch` ahead of the prediction, so
+        only a few tiles are in memory at a time. Returns the location of the
+        stitched labels like `finish_tiled_prediction`.
+        """
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(None, self._open_image, image)
+        info = self.start_tiled_prediction(image.shape, tile_size, tile_overlap, channels, diameter, flow_threshold, model_type)
+        tiles = asyncio.Semaphore(prefetch + 1)
+
+        async def predict(top, left, bottom, right):
+            async with tiles:
+                tile = await loop.run_in_executor(None, image.__getitem__, (slice(top, bottom), slice(left, right)))
+                await self.predict_tile(info["id"], tile, top, left)
+
+        try:
+            await asyncio.gather(*[predict(*bounds) for bounds in info["tiles"]])
+        except Exception:
+            self._discard_tiled_prediction(info["id"])
+            raise
+        return self.finish_tiled_prediction(info["id"])
+
+    def _get_dataset_workers(self) -> list:
+        # Fan out over all shards of this app when running in Ray Serve
+        try:
+            from ray import serve
+
+            replica_context = serve.get_replica_context()
+            app_name = replica_context.app_name
+            deployment = replica_context.deployment
+        except Exception:
+            return [self.predict]
+        base_name = deployment.rsplit("_", 1)[0]
+        names = [
+            name
+            for name in serve.status().applications[app_name].deployments
+            if name == deployment or (name.startswith(base_name + "_") and name[len(base_name) + 1 :].isdigit())
+        ]
+        return [serve.get_deployment_handle(name, app_name).predict.remote for name in sorted(names)]
+
+    async def _run_dataset_job(self, job, items, output_uri, storage_options, predict_kwargs, max_in_flight):
+        import fsspec
+
+        loop = asyncio.get_running_loop()
+        fs, output_path = fsspec.core.url_to_fs(output_uri, **(storage_options or {}))
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        try:
+            # Outputs that already exist are from a previous run of the job
+            await loop.run_in_executor(None, lambda: fs.makedirs(output_path, exist_ok=True))
+            prefix = output_path.rstrip("/") + "/"
+            existing = {path[len(prefix):] for path in await loop.run_in_executor(None, fs.find, output_path)}
+            pending = [item for item in items if _output_name(item) not in existing]
+            job["skipped"] = len(items) - len(pending)
+
+            workers = self._get_dataset_workers()
+            in_flight = [0] * len(workers)
+            slots = asyncio.Semaphore(max_in_flight)
+
+            async def process(item):
+                async with slots:
+                    # Send each item to the least busy worker
+                    worker = in_flight.index(min(in_flight))
+                    in_flight[worker] += 1
+                    job["in_flight"] += 1
+                    try:
+                        reference = {k: v for k, v in item.items() if k != "output"}
+                        result = await workers[worker]([reference], **predict_kwargs)
+                        buffer = io.BytesIO()
+                        np.save(buffer, result["masks"][0])
+                        path = f"{output_path}/{_output_name(item)}"
+                        await loop.run_in_executor(None, fs.pipe, path + ".part", buffer.getvalue())
+                        await loop.run_in_executor(None, fs.mv, path + ".part", path)
+                        job["completed"] += 1
+                    except Exception as e:
+                        job["failed"] += 1
+                        if len(job["errors"]) < 20:
+                            job["errors"].append({"uri": item["uri"], "error": str(e)})
+                    finally:
+                        in_flight[worker] -= 1
+                        job["in_flight"] -= 1
+
+            await asyncio.gather(*[process(item) for item in pending])
+            # Failed items are listed in "errors" and retried by a resubmission
+            job["status"] = "completed"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+        except Exception as e:
+            print(f"Dataset job {job['id']} failed: {e}")
+            job["status"] = "failed"
+            job["errors"].append({"uri": None, "error": str(e)})
+        finally:
+            job["finished_at"] = time.time()
+
+    def _expire_dataset_jobs(self):
+        expired_before = time.time() - self.dataset_job_ttl
+        for job_id, job in list(self.dataset_jobs.items()):
+            if job["finished_at"] is not None and job["finished_at"] < expired_before:
+                del self.dataset_jobs[job_id]
+
+    async def submit_dataset_job(self, manifest, output_uri, channels=None, diameter=None, flow_threshold=None, model_type='cyto3', storage_options=None, max_in_flight=8, context=None):
+        """Segment a dataset in the background and write the masks to `output_uri`.
+
+        `manifest` is a list of image URIs or reference dicts (see
+        `open_image`), or the URL of a JSON list or a text file with one URI
+        per line. Items may set an "output" file name. Masks are written as
+        `.npy` files, locally or to object storage such as the MinIO server.
+        The manifest and the images must lie below `readable_uris`, and
+        `output_uri` below `writable_uris`.
+        At most `max_in_flight` items are processed at once, spread over the
+        replicas of this app. Submitting the same job again skips the items
+        whose output already exists. Returns the job id for
+        `get_dataset_job`.
+        """
+        self._expire_dataset_jobs()
+        check_uri(output_uri, self.writable_uris)
+        if isinstance(manifest, str):
+            check_uri(manifest, self.readable_uris)
+        loop = asyncio.get_running_loop()
+        items = await loop.run_in_executor(None, _read_manifest, manifest, storage_options)
+        for item in items:
+            check_uri(item["uri"], self.readable_uris)
+            _output_name(item)
+        job_id = str(uuid.uuid4())
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "output_uri": output_uri,
+            "total": len(items),
+            "completed": 0,
+            "skipped": 0,
+            "failed": 0,
+            "in_flight": 0,
+            "errors": [],
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        predict_kwargs = {
+            "channels": channels,
+            "diameter": diameter,
+            "flow_threshold": flow_threshold,
+            "model_type": model_type,
+        }
+        job["task"] = asyncio.ensure_future(
+            self._run_dataset_job(job, items, output_uri, storage_options, predict_kwargs, max_in_flight)
+        )
+        self.dataset_jobs[job_id] = job
+        return job_id
+
+    def get_dataset_job(self, job_id, context=None):
+        """Return the progress and throughput (items per second) of a dataset job."""
+        job = self.dataset_jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Dataset job {job_id} not found.")
+        status = {k: v for k, v in job.items() if k != "task"}
+        if job["started_at"]:
+            elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+            status["elapsed"] = elapsed
+            status["throughput"] = job["completed"] / elapsed if elapsed > 0 else 0.0
+        return status
+
+    def cancel_dataset_job(self, job_id, context=None):
+        """Cancel a dataset job, finished items keep their outputs."""
+        job = self.dataset_jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Dataset job {job_id} not found.")
+        if job["status"] == "queued":
+            job["status"] = "cancelled"
+        return job["task"].cancel()
+
+    def _start_training(self, job_id, images, labels, config):
+        import ray
+
+        if not ray.is_initialized():
+            trainer = CellposeTrainer(job_id, self.training_dir, self.use_GPU)
+            future = self._training_executor.submit(trainer.run, images, labels, config)
+            return trainer, future
+        # Each job gets its own actor, so Ray places concurrent jobs on free GPUs
+        num_gpus = config.get("num_gpus", 1 if self.use_GPU else 0)
+        actor_class = ray.remote(num_gpus=num_gpus, max_concurrency=2)(CellposeTrainer)
+        trainer = actor_class.remote(job_id, self.training_dir, num_gpus > 0)
+        return trainer, trainer.run.remote(images, labels, config).future()
+
+    def _training_finished(self, job_id, future):
+        """Keep the final progress of a job and free the GPU of its actor."""
+        import ray
+
+        job = self.training_jobs.get(job_id)
+        if job is None:
+            return
+        try:
+            progress = future.result()
+        except Exception as e:
+            status = "cancelled" if job["cancelled"] else "failed"
+            progress = {"status": status, "error": None if job["cancelled"] else str(e), "epoch": None, "losses": [], "checkpoints": [], "model_path": None}
+        trainer = job["trainer"]
+        if not isinstance(trainer, CellposeTrainer):
+            # ray.kill would block the Ray thread that runs this callback
+            self._training_executor.submit(ray.kill, trainer)
+        job.update(trainer=None, progress=progress, finished_at=time.time())
+
+    def _expire_training_jobs(self):
+        expired_before = time.time() - self.training_job_ttl
+        for job_id, job in list(self.training_jobs.items()):
+            if job["finished_at"] is not None and job["finished_at"] < expired_before:
+                del self.training_jobs[job_id]
+
+    def train(self, images, labels, config=None, context=None):
+        """Fine-tune a Cellpose model in the background and return the job id.
+
+        `labels` are label images matching `images`. `config` may set
+        model_type (the pretrained starting point), channels, n_epochs,
+        batch_size, learning_rate, weight_decay, save_every (checkpoint
+        interval in epochs), bsize and num_gpus. Follow the job with
+        `get_training_job`.
+        """
+        if len(images) != len(labels):
+            raise ValueError("images and labels must have the same length")
+        self._expire_training_jobs()
+        job_id = str(uuid.uuid4())
+        trainer, result = self._start_training(job_id, images, labels, dict(config or {}))
+        self.training_jobs[job_id] = {
+            "trainer": trainer,
+            "progress": None,
+            "cancelled": False,
+            "submitted_at": time.time(),
+            "finished_at": None,
+        }
+        result.add_done_callback(lambda future: self._training_finished(job_id, future))
+        return job_id
+
+    async def get_training_job(self, job_id, since=0, context=None):
+        """Return the status of a training job and the epoch losses after `since`.
+
+        Pass the number of losses received so far as `since` to stream the
+        loss updates of a running job.
+        """
+        job = self.training_jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Training job {job_id} not found.")
+        trainer = job["trainer"]
+        if trainer is None:
+            progress = {**job["progress"], "losses": job["progress"]["losses"][since:]}
+        elif isinstance(trainer, CellposeTrainer):
+            progress = trainer.get_progress(since)
+        else:
+            progress = await trainer.get_progress.remote(since)
+        return {"id": job_id, "submitted_at": job["submitted_at"], **progress}
+
+    async def watch_training_job(self, job_id, since=0, interval=1.0, context=None):
+        """Yield the progress of a training job whenever new epoch losses arrive.
+
+        Each update is a `get_training_job` result with the losses since the
+        previous update. The stream ends with the update of the finished job.
+        """
+        while True:
+            progress = await self.get_training_job(job_id, since)
+            finished = progress['status'] not in ('queued', 'running')
+            if progress['losses'] or finished:
+                since += len(progress['losses'])
+                yield progress
+            if finished:
+                return
+            await asyncio.sleep(interval)
+
+    async def cancel_training_job(self, job_id, context=None):
+        """Stop a training job after its current epoch, False if it already finished."""
+        import ray
+
+        job = self.training_jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"Training job {job_id} not found.")
+        trainer = job["trainer"]
+        if trainer is None:
+            return False
+        job["cancelled"] = True
+        if isinstance(trainer, CellposeTrainer):
+            trainer.cancel()
+            return True
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(trainer.cancel.remote().future()), timeout=10)
+        except asyncio.TimeoutError:
+            # The actor is still waiting for a GPU and will never start
+            ray.kill(trainer)
+        return True
 
 # Export the CellposeModel class using Hypha RPC API
 api.export(CellposeModel)
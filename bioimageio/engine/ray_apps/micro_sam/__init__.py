@@ -1,13 +1,364 @@
-import io
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from typing import Union
 from hypha_rpc import api
 import numpy as np
 
+from bioimageio.engine.image_io import ChunkedImage, open_image
+
+
+def _is_array(value) -> bool:
+    return isinstance(value, np.ndarray) or (
+        hasattr(value, "element_size") and hasattr(value, "numel")
+    )
+
+
+def _array_nbytes(value) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return value.numel() * value.element_size()
+
+
+class EmbeddingCache:
+    """LRU cache for embeddings, bounded by the bytes held in memory.
+
+    When the memory budget is exceeded, the least recently used entries are
+    spilled to memory-mapped files in `spill_dir` and reloaded transparently
+    on the next access. Entries expire `ttl` seconds after their last access,
+    whether they are in memory or spilled. `close` removes the spilled files,
+    and the spill directory too if the cache created it.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        spill_dir: str = None,
+        max_spill_bytes: int = None,
+    ):
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="micro_sam_embeddings_")
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # A temporary spill directory is removed on close, or at exit at last
+        self._remove_spill_dir = weakref.finalize(
+            self, shutil.rmtree, self.spill_dir, ignore_errors=True
+        )
+        if spill_dir is not None:
+            self._remove_spill_dir.detach()
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        # Both dicts are kept in least-recently-used order
+        self._memory = OrderedDict()  # key -> (entry, nbytes, last_access)
+        self._spilled = OrderedDict()  # key -> (entry, files, nbytes, last_access)
+        self._lock = threading.RLock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "spills": 0,
+            "reloads": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    def _entry_nbytes(self, entry: dict) -> int:
+        return sum(_array_nbytes(v) for v in entry.values() if _is_array(v))
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        for store in (self._memory, self._spilled):
+            expired = []
+            for key, item in store.items():
+                if item[-1] > deadline:
+                    break
+                expired.append(key)
+            for key in expired:
+                self._remove(key)
+                self.stats["expirations"] += 1
+
+    def _remove(self, key):
+        if key in self._memory:
+            _, nbytes, _ = self._memory.pop(key)
+            self.memory_bytes -= nbytes
+            return True
+        if key in self._spilled:
+            _, files, nbytes, _ = self._spilled.pop(key)
+            self.spilled_bytes -= nbytes
+            for path, _ in files.values():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            return True
+        return False
+
+    def _spill(self, key, entry: dict, nbytes: int, last_access: float):
+        if self.max_spill_bytes is not None:
+            while self._spilled and self.spilled_bytes + nbytes > self.max_spill_bytes:
+                self._remove(next(iter(self._spilled)))
+                self.stats["evictions"] += 1
+            if nbytes > self.max_spill_bytes:
+                self.stats["evictions"] += 1
+                return
+        metadata = {}
+        files = {}
+        for name, value in entry.items():
+            if not _is_array(value):
+                metadata[name] = value
+                continue
+            if isinstance(value, np.ndarray):
+                array, device = value, None
+            else:
+                array, device = value.detach().cpu().numpy(), str(value.device)
+            path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.npy")
+            mmap = np.lib.format.open_memmap(
+                path, mode="w+", dtype=array.dtype, shape=array.shape
+            )
+            mmap[...] = array
+            mmap.flush()
+            del mmap
+            files[name] = (path, device)
+        self._spilled[key] = (metadata, files, nbytes, last_access)
+        self.spilled_bytes += nbytes
+        self.stats["spills"] += 1
+
+    def _reload(self, key) -> dict:
+        metadata, files, nbytes, _ = self._spilled[key]
+        entry = dict(metadata)
+        for name, (path, device) in files.items():
+            array = np.array(np.load(path, mmap_mode="r"))
+            if device is None:
+                entry[name] = array
+            else:
+                import torch
+
+                entry[name] = torch.from_numpy(array).to(device)
+        self._remove(key)
+        self.stats["reloads"] += 1
+        return entry
+
+    def _enforce_budget(self):
+        # Always keep the most recently used entry in memory
+        while self.memory_bytes > self.max_bytes and len(self._memory) > 1:
+            key, (entry, nbytes, last_access) = self._memory.popitem(last=False)
+            self.memory_bytes -= nbytes
+            self._spill(key, entry, nbytes, last_access)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            self._expire()
+            return key in self._memory or key in self._spilled
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire()
+            return len(self._memory) + len(self._spilled)
+
+    def __setitem__(self, key, entry: dict):
+        with self._lock:
+            self._remove(key)
+            nbytes = self._entry_nbytes(entry)
+            self._memory[key] = (entry, nbytes, time.monotonic())
+            self.memory_bytes += nbytes
+            self._expire()
+            self._enforce_budget()
+
+    def __delitem__(self, key):
+        with self._lock:
+            if not self._remove(key):
+                raise KeyError(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._expire()
+            if key in self._memory:
+                entry, nbytes, _ = self._memory.pop(key)
+                self.stats["hits"] += 1
+            elif key in self._spilled:
+                nbytes = self._spilled[key][2]
+                entry = self._reload(key)
+                self.memory_bytes += nbytes
+            else:
+                self.stats["misses"] += 1
+                return default
+            self._memory[key] = (entry, nbytes, time.monotonic())
+            self._enforce_budget()
+            return entry
+
+    def close(self):
+        with self._lock:
+            for key in list(self._memory) + list(self._spilled):
+                self._remove(key)
+        self._remove_spill_dir()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._expire()
+            return {
+                **self.stats,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self.memory_bytes,
+                "spilled_entries": len(self._spilled),
+                "spilled_bytes": self.spilled_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def _find_rdf_sha256(rdf, file_name: str) -> str:
+    # Weights and attachments of a bioimage.io RDF list their file as
+    # "source" (or "uri" in older specs) next to its "sha256"
+    nodes = [rdf]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, dict):
+            source = node.get("source") or node.get("uri")
+            if (
+                isinstance(source, str)
+                and node.get("sha256")
+                and os.path.basename(source.split("?")[0]) == file_name
+            ):
+                return node["sha256"]
+            nodes.extend(node.values())
+        elif isinstance(node, list):
+            nodes.extend(node)
+    raise ValueError(f"The model description lists no SHA-256 for {file_name}.")
+
+
+class ModelWeightStore:
+    """On-disk store of model checkpoints shared by all replicas on a node.
+
+    Checkpoints are streamed to disk in chunks on first use and verified
+    against their full SHA-256 digest. The hex string in torch hub file names
+    such as `sam_vit_b_01ec64.pth` is an MD5 prefix, not a SHA-256 one, so
+    only complete digests are accepted. A file lock makes concurrent replicas
+    wait for a single download.
+    """
+
+    def __init__(self, cache_dir: str = None, chunk_size: int = 8 * 1024**2):
+        self.cache_dir = cache_dir or os.environ.get(
+            "MICRO_SAM_WEIGHTS_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "bioengine", "micro_sam"),
+        )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.chunk_size = chunk_size
+        self.logger = getLogger(__name__)
+
+    def _read_info(self, path: str):
+        try:
+            with open(f"{path}.json", "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _check_digest(self, sha256: str = None):
+        if sha256 is not None and len(sha256) != 64:
+            raise ValueError(f"Expected a full SHA-256 digest, got {sha256!r}")
+
+    def _is_valid(self, path: str, url: str, sha256: str = None) -> bool:
+        info = self._read_info(path)
+        if info is None or info["url"] != url or not os.path.isfile(path):
+            return False
+        if os.path.getsize(path) != info["size"]:
+            return False
+        return sha256 is None or info["sha256"] == sha256
+
+    def _download(self, url: str, path: str, sha256: str = None):
+        import requests
+
+        part_file = f"{path}.{uuid.uuid4().hex}.part"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with requests.get(url, stream=True, timeout=60) as response:
+                if response.status_code != 200:
+                    raise RuntimeError(f"Failed to download model from {url}")
+                with open(part_file, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            checksum = digest.hexdigest()
+            if sha256 is not None and checksum != sha256:
+                raise RuntimeError(
+                    f"Checksum mismatch for {url}: expected {sha256}, got {checksum}"
+                )
+            os.replace(part_file, path)
+        finally:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+        with open(f"{path}.json", "w") as f:
+            json.dump({"url": url, "sha256": checksum, "size": size}, f)
+
+    def get(self, name: str, url: str, sha256: str = None) -> str:
+        """Return the local path of the checkpoint, downloading it if needed."""
+        import fcntl
+
+        self._check_digest(sha256)
+        suffix = os.path.splitext(url.split("?")[0])[1]
+        path = os.path.join(self.cache_dir, f"{name}{suffix}")
+        if self._is_valid(path, url, sha256):
+            return path
+        with open(f"{path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another replica may have finished the download meanwhile
+                if not self._is_valid(path, url, sha256):
+                    self.logger.info(f"Downloading {url} to {path}...")
+                    start_time = time.time()
+                    self._download(url, path, sha256)
+                    self.logger.info(
+                        f"Downloaded {url} in {time.time() - start_time:.1f}s"
+                    )
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return path
+
+
 class MicroSAM:
-    def __init__(self, model_timeout: int = 3600, embedding_timeout: int = 600):
+    def __init__(
+        self,
+        model_timeout: int = 3600,
+        embedding_timeout: int = 600,
+        embedding_memory_budget: int = None,
+        embedding_spill_dir: str = None,
+        embedding_max_spill_bytes: int = None,
+        weights_dir: str = None,
+        embedding_codec: str = None,
+        embedding_workers: int = 1,
+        embedding_job_ttl: int = 600,
+    ):
         from cachetools import TTLCache
 
+        # Set in the manifest's init_kwargs, or per node in the environment
+        if embedding_memory_budget is None:
+            embedding_memory_budget = int(
+                os.environ.get("MICRO_SAM_EMBEDDING_MEMORY_BUDGET", 1024**3)
+            )
+        if embedding_max_spill_bytes is None and os.environ.get(
+            "MICRO_SAM_EMBEDDING_MAX_SPILL_BYTES"
+        ):
+            embedding_max_spill_bytes = int(
+                os.environ["MICRO_SAM_EMBEDDING_MAX_SPILL_BYTES"]
+            )
+        if embedding_codec is None:
+            embedding_codec = os.environ.get("MICRO_SAM_EMBEDDING_CODEC") or None
+        if embedding_codec not in (None, "float16", "int8"):
+            raise ValueError(
+                f"Invalid embedding codec {embedding_codec}, use 'float16' or 'int8'."
+            )
+
         # Set up logger
         self.logger = getLogger(__name__)
         self.logger.setLevel("INFO")
@@ -17,17 +368,73 @@ class MicroSAM:
             "vit_b_lm": "https://uk1s3.embassy.ebi.ac.uk/public-datasets/bioimage.io/diplomatic-bug/1/files/vit_b.pt",
             "vit_b_em_organelles": "https://uk1s3.embassy.ebi.ac.uk/public-datasets/bioimage.io/noisy-ox/1/files/vit_b.pt",
         }
+        # Full SHA-256 digests of the published model checkpoints; those of
+        # the bioimage.io models are read from their resource descriptions
+        self.model_checksums = {
+            "vit_b": "ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912",
+        }
+        self.model_rdfs = {
+            "vit_b_lm": "https://uk1s3.embassy.ebi.ac.uk/public-datasets/bioimage.io/diplomatic-bug/1/files/rdf.yaml",
+            "vit_b_em_organelles": "https://uk1s3.embassy.ebi.ac.uk/public-datasets/bioimage.io/noisy-ox/1/files/rdf.yaml",
+        }
+        self.weights = ModelWeightStore(weights_dir)
         # Set up cache with per-item time-to-live
         self.models = TTLCache(
             maxsize=len(self.model_urls), ttl=model_timeout
         )  # TODO: what if multiple users download the same model?
-        self.embeddings = TTLCache(maxsize=np.inf, ttl=embedding_timeout)
+        # Keep one warm predictor per model, embeddings are swapped in per call
+        self.predictors = TTLCache(maxsize=len(self.model_urls), ttl=model_timeout)
+        self._predictors_lock = threading.Lock()
+        # Models load under their own lock, so a download blocks only its model
+        self._model_locks = {name: threading.Lock() for name in self.model_urls}
+        # Embeddings are bounded by their size in memory and spill to disk
+        self.embeddings = EmbeddingCache(
+            max_bytes=embedding_memory_budget,
+            ttl=embedding_timeout,
+            spill_dir=embedding_spill_dir,
+            max_spill_bytes=embedding_max_spill_bytes,
+        )
+        # Optionally store embeddings in reduced precision to fit more users
+        self.embedding_codec = embedding_codec
+        # Embeddings are keyed by image content, users hold pointers to them
+        self.user_embeddings = {}  # user_id -> embedding key
+        self._embedding_users = {}  # embedding key -> set of user_ids
+        self._embedding_tiles = {}  # tiled embedding key -> set of tile keys
+        self._embedding_lock = threading.RLock()
+        # Embedding jobs run on a bounded pool, so encodes cannot starve segment;
+        # finished jobs are forgotten after `embedding_job_ttl` seconds
+        self.jobs = {}
+        self.embedding_job_ttl = embedding_job_ttl
+        self._job_executor = ThreadPoolExecutor(
+            max_workers=embedding_workers, thread_name_prefix="micro_sam_embedding"
+        )
+
+    def __del__(self):
+        # Ray Serve calls this when the replica shuts down
+        if hasattr(self, "embeddings"):
+            self.embeddings.close()
+
+    def _get_checksum(self, model_name: str) -> str:
+        # Never trust the first download, every checkpoint has a known digest
+        if model_name not in self.model_checksums:
+            import requests
+            import yaml
+
+            response = requests.get(self.model_rdfs[model_name], timeout=60)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"Failed to download the description of model {model_name}"
+                )
+            file_name = os.path.basename(self.model_urls[model_name].split("?")[0])
+            self.model_checksums[model_name] = _find_rdf_sha256(
+                yaml.safe_load(response.text), file_name
+            )
+        return self.model_checksums[model_name]
 
     def _load_model(self, model_name: str):
         import torch
-        import requests
         from segment_anything import sam_model_registry
-    
+
         if model_name not in self.model_urls:
             raise ValueError(
                 f"Model {model_name} not found. Available models: {list(self.model_urls.keys())}"
@@ -36,20 +443,24 @@ class MicroSAM:
         if model_name in self.models:
             return self.models[model_name]
 
-        # Download model if not in cache (takes approx. 4 seconds)
+        # Download the checkpoint to the local weight store if not there yet
         model_url = self.model_urls[model_name]
-        self.logger.info(f"Loading model {model_name} from {model_url}...")
-        response = requests.get(model_url)
-        if response.status_code != 200:
-            raise RuntimeError(f"Failed to download model from {model_url}")
-        buffer = io.BytesIO(response.content)
+        model_path = self.weights.get(
+            model_name, model_url, self._get_checksum(model_name)
+        )
+        self.logger.info(f"Loading model {model_name} from {model_path}...")
 
-        # Load model state
+        # Load model state, memory-mapped from the local file where possible
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        ckpt = torch.load(buffer, map_location=device)
+        try:
+            ckpt = torch.load(model_path, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # Legacy (non-zip) checkpoints cannot be memory-mapped
+            ckpt = torch.load(model_path, map_location="cpu")
         model_type = model_name[:5]
         sam = sam_model_registry[model_type]()
         sam.load_state_dict(ckpt)
+        sam.to(device)
 
         # Cache the model
         self.logger.info(f"Caching model {model_name} (device={device})...")
@@ -57,13 +468,67 @@ class MicroSAM:
 
         return sam
 
-    def _to_image(self, input_):
-        
+    def _get_predictor(self, model_name: str):
+        from segment_anything import SamPredictor
+
+        with self._predictors_lock:
+            pooled = self.predictors.get(model_name)
+        if pooled is not None:
+            return pooled
+        # Unknown model names get a throwaway lock, `_load_model` rejects them
+        with self._model_locks.get(model_name) or threading.Lock():
+            with self._predictors_lock:
+                pooled = self.predictors.get(model_name)
+            if pooled is None:
+                sam = self._load_model(model_name)
+                # The lock guards the predictor state while a user's embedding is set
+                pooled = (SamPredictor(sam), threading.Lock())
+                with self._predictors_lock:
+                    self.predictors[model_name] = pooled
+        return pooled
+
+    def _encode_features(self, embedding: dict) -> dict:
+        import torch
+
+        features = embedding["features"]
+        if self.embedding_codec == "float16":
+            embedding["features"] = features.to(torch.float16)
+        elif self.embedding_codec == "int8":
+            # Symmetric quantization with one scale per channel
+            scale = features.abs().amax(dim=(-2, -1), keepdim=True) / 127
+            scale = torch.clamp(scale, min=torch.finfo(features.dtype).tiny)
+            embedding["features"] = torch.round(features / scale).to(torch.int8)
+            embedding["scale"] = scale
+        else:
+            return embedding
+        embedding["codec"] = self.embedding_codec
+        return embedding
+
+    def _decode_features(self, embedding: dict):
+        import torch
+
+        codec = embedding.get("codec")
+        if codec == "float16":
+            return embedding["features"].to(torch.float32)
+        if codec == "int8":
+            return embedding["features"].to(torch.float32) * embedding["scale"]
+        return embedding["features"]
+
+    def _set_predictor_embedding(self, predictor, embedding: dict):
+        predictor.original_size = embedding["original_size"]
+        predictor.input_size = embedding["input_size"]
+        predictor.features = self._decode_features(embedding)
+        predictor.is_image_set = embedding["is_image_set"]
+
+    def _to_image(self, input_, intensity_range: tuple = None):
+
         # we require the input to be uint8
         if input_.dtype != np.dtype("uint8"):
-            # first normalize the input to [0, 1]
-            input_ = input_.astype("float32") - input_.min()
-            input_ = input_ / input_.max()
+            # first normalize the input to [0, 1], by the range of the whole
+            # image if the input is one tile of it
+            low, high = intensity_range or (input_.min(), input_.max())
+            input_ = input_.astype("float32") - low
+            input_ = np.clip(input_ / max(high - low, 1e-6), 0, 1)
             # then bring to [0, 255] and cast to uint8
             input_ = (input_ * 255).astype("uint8")
         if input_.ndim == 2:
@@ -76,62 +541,534 @@ class MicroSAM:
             )
         return image
 
+    def _embedding_key(self, model_name: str, image: np.ndarray) -> str:
+        # Hash the normalized image, so identical uploads share one embedding
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(model_name.encode())
+        digest.update(str(image.shape).encode())
+        if isinstance(image, ChunkedImage):
+            # Chunked images are keyed by reference, without reading the data
+            digest.update(image.key.encode())
+        else:
+            digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def _set_user_embedding(self, user_id: str, key: str):
+        with self._embedding_lock:
+            previous_key = self.user_embeddings.get(user_id)
+            if previous_key == key:
+                return
+            if previous_key is not None:
+                self._release_user_embedding(user_id)
+            self.user_embeddings[user_id] = key
+            self._embedding_users.setdefault(key, set()).add(user_id)
+
+    def _release_user_embedding(self, user_id: str):
+        with self._embedding_lock:
+            key = self.user_embeddings.pop(user_id, None)
+            if key is None:
+                return
+            users = self._embedding_users.get(key, set())
+            users.discard(user_id)
+            if not users:
+                # Last pointer dropped, free the shared entry
+                self._embedding_users.pop(key, None)
+                for tile_key in self._embedding_tiles.pop(key, ()):
+                    if tile_key in self.embeddings:
+                        del self.embeddings[tile_key]
+                if key in self.embeddings:
+                    del self.embeddings[key]
+
+    def _get_user_embedding(self, user_id: str):
+        with self._embedding_lock:
+            key = self.user_embeddings.get(user_id)
+            if key is None:
+                return None
+            embedding = self.embeddings.get(key)
+            if embedding is None:
+                # The shared entry expired, drop the dangling pointer
+                self._release_user_embedding(user_id)
+            return embedding
+
+    def _prune_user_embeddings(self):
+        with self._embedding_lock:
+            for user_id, key in list(self.user_embeddings.items()):
+                if key not in self.embeddings:
+                    self._release_user_embedding(user_id)
+
+    def _compute_predictor_embedding(self, model_name: str, image: np.ndarray) -> dict:
+        from segment_anything import SamPredictor
+
+        sam = self._get_predictor(model_name)[0].model
+        # Use a separate predictor, so encoding does not block segment calls
+        predictor = SamPredictor(sam)
+        predictor.set_image(image)
+        return self._encode_features(
+            {
+                "model_name": model_name,
+                "original_size": predictor.original_size,
+                "input_size": predictor.input_size,
+                "features": predictor.features,  # embedding
+                "is_image_set": predictor.is_image_set,
+            }
+        )
+
     def compute_embedding(
-        self, model_name: str, image: np.ndarray, context: dict = None
+        self,
+        model_name: str,
+        image: np.ndarray,
+        tiled: bool = False,
+        tile_size: int = 1024,
+        tile_overlap: int = 128,
+        context: dict = None,
     ) -> bool:
-        from segment_anything import SamPredictor
+        """Compute the image embedding for the user.
 
+        With `tiled=True` the image is split into overlapping tiles of
+        `tile_size` pixels whose embeddings are computed lazily, only for the
+        tiles that `segment` is prompted in. `image` can also reference a
+        chunked array (see `ChunkedImage`); tiled embeddings then read only
+        the prompted tiles.
+        """
         user_id = context["user"].get("id")
         if not user_id:
             self.logger.info("User ID not found in context.")
             return False
-        sam = self._load_model(model_name)
+        if tiled and not 0 <= tile_overlap < tile_size:
+            raise ValueError("tile_overlap must be smaller than tile_size.")
+        self._prune_user_embeddings()
+        image = open_image(image)
+        if not (tiled and isinstance(image, ChunkedImage)):
+            image = self._to_image(np.asarray(image))
+        key = self._embedding_key(model_name, image)
+        if tiled:
+            key = f"{key}:tiled:{tile_size}:{tile_overlap}"
+        if key in self.embeddings:
+            self.logger.info(f"User {user_id} - reusing cached embedding {key}...")
+            self._set_user_embedding(user_id, key)
+            return True
+        if tiled:
+            # Tile embeddings are computed on demand in `segment`
+            self.logger.info(f"User {user_id} - caching image for tiled embedding...")
+            self.embeddings[key] = {
+                "model_name": model_name,
+                "key": key,
+                "image": image,
+                "tile_size": tile_size,
+                "tile_overlap": tile_overlap,
+                # Tiles of chunked images are normalized alike, see `_to_image`
+                "intensity_range": (
+                    image.intensity_range()
+                    if isinstance(image, ChunkedImage) and image.dtype != np.uint8
+                    else None
+                ),
+            }
+            self._set_user_embedding(user_id, key)
+            return True
         self.logger.info(f"User {user_id} - computing embedding...")
-        predictor = SamPredictor(sam)
-        predictor.set_image(self._to_image(image))
+        predictor_dict = self._compute_predictor_embedding(model_name, image)
         # Save computed predictor values
         self.logger.info(f"User {user_id} - caching embedding...")
-        predictor_dict = {
-            "model_name": model_name,
-            "original_size": predictor.original_size,
-            "input_size": predictor.input_size,
-            "features": predictor.features,  # embedding
-            "is_image_set": predictor.is_image_set,
-        }
-        self.embeddings[user_id] = predictor_dict
+        self.embeddings[key] = predictor_dict
+        self._set_user_embedding(user_id, key)
         return True
 
+    def _run_embedding_job(self, job: dict, args: tuple, context: dict):
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        try:
+            if self.compute_embedding(*args, context=context):
+                job["status"] = "completed"
+            else:
+                job["status"] = "failed"
+                job["error"] = "User ID not found in context."
+        except Exception as e:
+            self.logger.error(f"Embedding job {job['id']} failed: {str(e)}")
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = time.time()
+
+    def _expire_jobs(self):
+        expired_before = time.time() - self.embedding_job_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job["finished_at"] is not None and job["finished_at"] < expired_before:
+                del self.jobs[job_id]
+
+    def _get_job(self, job_id: str, user_id: str) -> dict:
+        job = self.jobs.get(job_id)
+        if job is None or job["user_id"] != user_id:
+            raise ValueError(f"Embedding job {job_id} not found.")
+        return job
+
+    def _job_status(self, job: dict) -> dict:
+        status = {k: v for k, v in job.items() if k not in ("user_id", "future")}
+        if job["status"] == "queued":
+            status["queue_position"] = sum(
+                1
+                for other in list(self.jobs.values())
+                if other["status"] == "queued"
+                and other["submitted_at"] < job["submitted_at"]
+            )
+        return status
+
+    def submit_embedding(
+        self,
+        model_name: str,
+        image: np.ndarray,
+        tiled: bool = False,
+        tile_size: int = 1024,
+        tile_overlap: int = 128,
+        context: dict = None,
+    ) -> str:
+        """Queue `compute_embedding` as a background job and return its id.
+
+        Poll the job with `get_embedding_job` or wait for it with
+        `wait_embedding_job`.
+        """
+        user_id = context["user"].get("id")
+        if not user_id:
+            raise ValueError("User ID not found in context.")
+        if model_name not in self.model_urls:
+            raise ValueError(
+                f"Model {model_name} not found. Available models: {list(self.model_urls.keys())}"
+            )
+        self._expire_jobs()
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "user_id": user_id,
+            "status": "queued",
+            "error": None,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        self.jobs[job_id] = job
+        job["future"] = self._job_executor.submit(
+            self._run_embedding_job,
+            job,
+            (model_name, image, tiled, tile_size, tile_overlap),
+            context,
+        )
+        self.logger.info(f"User {user_id} - submitted embedding job {job_id}...")
+        return job_id
+
+    def get_embedding_job(self, job_id: str, context: dict = None) -> dict:
+        """Return the status of an embedding job."""
+        user_id = context["user"].get("id")
+        return self._job_status(self._get_job(job_id, user_id))
+
+    async def wait_embedding_job(
+        self, job_id: str, timeout: float = None, context: dict = None
+    ) -> dict:
+        """Wait until an embedding job finishes, or `timeout` seconds passed."""
+        user_id = context["user"].get("id")
+        job = self._get_job(job_id, user_id)
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(job["future"])), timeout
+            )
+        except asyncio.TimeoutError:
+            pass
+        return self._job_status(job)
+
+    def get_cache_stats(self, context: dict = None) -> dict:
+        """Return hit, miss, spill and reload counters of the embedding cache."""
+        stats = self.embeddings.get_stats()
+        stats["users"] = len(self.user_embeddings)
+        return stats
+
     def reset_embedding(self, context: dict = None) -> bool:
         user_id = context["user"].get("id")
-        if user_id not in self.embeddings:
+        key = self.user_embeddings.get(user_id)
+        if key is None or key not in self.embeddings:
             self.logger.info(f"User {user_id} not found in cache.")
+            self._release_user_embedding(user_id)
             return False
         else:
             self.logger.info(f"User {user_id} - resetting embedding...")
-            del self.embeddings[user_id]
+            self._release_user_embedding(user_id)
             return True
 
+    def _tile_starts(self, length: int, tile_size: int, tile_overlap: int) -> list:
+        if length <= tile_size:
+            return [0]
+        starts = list(range(0, length - tile_size, tile_size - tile_overlap))
+        starts.append(length - tile_size)
+        return starts
+
+    def _tile_of_point(self, starts: list, tile_size: int, position: float) -> int:
+        # Route the point to the tile where it is farthest from the borders
+        centers = np.array(starts) + tile_size / 2
+        return int(np.argmin(np.abs(centers - position)))
+
+    def _get_tile_embedding(self, embedding: dict, tile_bounds: tuple) -> dict:
+        key = embedding["key"]
+        (r0, r1), (c0, c1) = tile_bounds
+        tile_key = f"{key}:{r0}:{c0}"
+        tile_embedding = self.embeddings.get(tile_key)
+        if tile_embedding is None:
+            self.logger.info(f"Computing embedding for tile {tile_key}...")
+            # Chunked images are read and normalized one tile at a time
+            tile = self._to_image(
+                np.ascontiguousarray(embedding["image"][r0:r1, c0:c1]),
+                embedding.get("intensity_range"),
+            )
+            tile_embedding = self._compute_predictor_embedding(
+                embedding["model_name"], tile
+            )
+            self.embeddings[tile_key] = tile_embedding
+            with self._embedding_lock:
+                self._embedding_tiles.setdefault(key, set()).add(tile_key)
+        return tile_embedding
+
+    def _predict_mask(
+        self, embedding: dict, point_coordinates: np.ndarray, point_labels: np.ndarray
+    ) -> np.ndarray:
+        predictor, predictor_lock = self._get_predictor(embedding["model_name"])
+        with predictor_lock:
+            # Swap the pre-computed embedding into the warm predictor
+            self._set_predictor_embedding(predictor, embedding)
+            mask, scores, logits = predictor.predict(
+                point_coords=point_coordinates[
+                    :, ::-1
+                ],  # SAM has reversed XY conventions
+                point_labels=point_labels,
+                multimask_output=False,
+            )
+        return mask[0]
+
+    def _parse_prompt(self, prompt: dict) -> dict:
+        point_coordinates = np.asarray(
+            prompt.get("point_coordinates", []), dtype=np.float32
+        ).reshape(-1, 2)
+        point_labels = np.asarray(prompt.get("point_labels", []), dtype=np.int32)
+        if len(point_coordinates) != len(point_labels):
+            raise ValueError("Each point needs exactly one label.")
+        box = prompt.get("box")
+        if box is not None:
+            box = np.asarray(box, dtype=np.float32).reshape(4)
+        if not len(point_coordinates) and box is None:
+            raise ValueError("Each prompt needs at least one point or a box.")
+        return {
+            "point_coordinates": point_coordinates,
+            "point_labels": point_labels,
+            "box": box,
+        }
+
+    def _predict_masks_batched(self, embedding: dict, prompts: list) -> list:
+        import torch
+
+        predictor, predictor_lock = self._get_predictor(embedding["model_name"])
+        masks = [None] * len(prompts)
+        with predictor_lock:
+            self._set_predictor_embedding(predictor, embedding)
+            # SAM takes boxes for all or none of the batch, so decode in two groups
+            for with_box in (False, True):
+                indices = [
+                    i
+                    for i, prompt in enumerate(prompts)
+                    if (prompt["box"] is not None) == with_box
+                ]
+                if not indices:
+                    continue
+                point_coords, point_labels, boxes = None, None, None
+                n_points = max(len(prompts[i]["point_labels"]) for i in indices)
+                if n_points:
+                    # Pad shorter point lists with SAM's "not a point" label -1
+                    coords = np.zeros((len(indices), n_points, 2), dtype=np.float32)
+                    labels = np.full((len(indices), n_points), -1, dtype=np.int32)
+                    for b, i in enumerate(indices):
+                        n = len(prompts[i]["point_labels"])
+                        # SAM has reversed XY conventions
+                        coords[b, :n] = prompts[i]["point_coordinates"][:, ::-1]
+                        labels[b, :n] = prompts[i]["point_labels"]
+                    coords = predictor.transform.apply_coords(
+                        coords, predictor.original_size
+                    )
+                    point_coords = torch.as_tensor(coords, device=predictor.device)
+                    point_labels = torch.as_tensor(labels, device=predictor.device)
+                if with_box:
+                    # Boxes are given as (row_min, col_min, row_max, col_max)
+                    box = np.stack([prompts[i]["box"] for i in indices])[
+                        :, [1, 0, 3, 2]
+                    ]
+                    box = predictor.transform.apply_boxes(box, predictor.original_size)
+                    boxes = torch.as_tensor(box, device=predictor.device)
+                batch_masks, _, _ = predictor.predict_torch(
+                    point_coords, point_labels, boxes=boxes, multimask_output=False
+                )
+                batch_masks = batch_masks[:, 0].cpu().numpy()
+                for b, i in enumerate(indices):
+                    masks[i] = batch_masks[b]
+        return masks
+
+    def _segment_tiled(
+        self,
+        embedding: dict,
+        point_coordinates: np.ndarray,
+        point_labels: np.ndarray,
+        max_tiles: int,
+    ):
+        """Segment one object in a tiled image, following it across tile borders.
+
+        Positive prompts in tiles the object does not reach start their own
+        search, up to `max_tiles` tiles in total. Returns the mask cropped to
+        the visited tiles and the crop offset.
+        """
+        tile_size = embedding["tile_size"]
+        height, width = embedding["image"].shape[:2]
+        if not len(point_coordinates):
+            raise ValueError("Tiled embeddings need at least one point prompt.")
+        outside = ~np.all(
+            (point_coordinates >= 0) & (point_coordinates < [height, width]), axis=1
+        )
+        if outside.any():
+            raise ValueError(
+                f"Points {point_coordinates[outside].tolist()} are outside the "
+                f"image of shape ({height}, {width}), give them as (row, column)."
+            )
+        row_starts = self._tile_starts(height, tile_size, embedding["tile_overlap"])
+        col_starts = self._tile_starts(width, tile_size, embedding["tile_overlap"])
+
+        def bounds(tile):
+            r0, c0 = row_starts[tile[0]], col_starts[tile[1]]
+            return (r0, min(r0 + tile_size, height)), (c0, min(c0 + tile_size, width))
+
+        def inside(tile, points):
+            (r0, r1), (c0, c1) = bounds(tile)
+            return (
+                (points[:, 0] >= r0)
+                & (points[:, 0] < r1)
+                & (points[:, 1] >= c0)
+                & (points[:, 1] < c1)
+            )
+
+        def points_in(tile):
+            (r0, _), (c0, _) = bounds(tile)
+            selected = inside(tile, point_coordinates)
+            return point_coordinates[selected] - [r0, c0], point_labels[selected]
+
+        def unvisited(points):
+            visited = np.zeros(len(points), dtype=bool)
+            for tile in tile_masks:
+                visited |= inside(tile, points)
+            return points[~visited]
+
+        # Every positive prompt must end up in a visited tile
+        positive = np.flatnonzero(point_labels > 0)
+        seeds = point_coordinates[positive if len(positive) else [0]]
+        tile_masks = {}
+        queue = []
+        while len(tile_masks) < max_tiles:
+            if not queue:
+                remaining = unvisited(seeds)
+                if not len(remaining):
+                    break
+                seed_tile = (
+                    self._tile_of_point(row_starts, tile_size, remaining[0][0]),
+                    self._tile_of_point(col_starts, tile_size, remaining[0][1]),
+                )
+                queue.append((seed_tile, *points_in(seed_tile)))
+            tile, coordinates, labels = queue.pop(0)
+            if tile in tile_masks or not len(coordinates):
+                continue
+            tile_embedding = self._get_tile_embedding(embedding, bounds(tile))
+            mask = self._predict_mask(
+                tile_embedding,
+                coordinates.astype(np.float32),
+                labels.astype(np.float32),
+            )
+            tile_masks[tile] = mask
+            # Continue into neighbouring tiles the mask touches the border of
+            borders = {
+                (-1, 0): mask[0, :],
+                (1, 0): mask[-1, :],
+                (0, -1): mask[:, 0],
+                (0, 1): mask[:, -1],
+            }
+            for (dr, dc), border in borders.items():
+                neighbour = (tile[0] + dr, tile[1] + dc)
+                if (
+                    not border.any()
+                    or neighbour in tile_masks
+                    or not 0 <= neighbour[0] < len(row_starts)
+                    or not 0 <= neighbour[1] < len(col_starts)
+                ):
+                    continue
+                # Prompt the neighbour with a mask pixel from the shared overlap
+                (r0, r1), (c0, c1) = bounds(tile)
+                (nr0, nr1), (nc0, nc1) = bounds(neighbour)
+                overlap = mask[
+                    max(r0, nr0) - r0 : min(r1, nr1) - r0,
+                    max(c0, nc0) - c0 : min(c1, nc1) - c0,
+                ]
+                rows, cols = np.nonzero(overlap)
+                if not len(rows):
+                    continue
+                nearest = np.argmin(
+                    (rows - rows.mean()) ** 2 + (cols - cols.mean()) ** 2
+                )
+                carried_row = rows[nearest] + max(r0, nr0) - nr0
+                carried_col = cols[nearest] + max(c0, nc0) - nc0
+                coordinates, labels = points_in(neighbour)
+                queue.append(
+                    (
+                        neighbour,
+                        np.concatenate([coordinates, [[carried_row, carried_col]]]),
+                        np.concatenate([labels, [1]]),
+                    )
+                )
+
+        missed = unvisited(seeds)
+        if len(missed):
+            raise ValueError(
+                f"Points {missed.tolist()} are in tiles beyond max_tiles={max_tiles}, "
+                "raise max_tiles or segment them separately."
+            )
+        # Stitch the tile masks into one mask covering the visited tiles
+        tile_bounds = [bounds(tile) for tile in tile_masks]
+        top = min(b[0][0] for b in tile_bounds)
+        left = min(b[1][0] for b in tile_bounds)
+        bottom = max(b[0][1] for b in tile_bounds)
+        right = max(b[1][1] for b in tile_bounds)
+        stitched = np.zeros((bottom - top, right - left), dtype=bool)
+        for ((r0, r1), (c0, c1)), mask in zip(tile_bounds, tile_masks.values()):
+            stitched[r0 - top : r1 - top, c0 - left : c1 - left] |= mask
+        return stitched, (top, left)
+
+    def _mask_to_features(self, mask: np.ndarray, offset: tuple = (0, 0)) -> list:
+        from kaibu_utils import mask_to_features
+
+        features = mask_to_features(mask)
+        if offset == (0, 0):
+            return features
+        # Polygons are (x, y) vertex lists, shift them into the full image
+        top, left = offset
+        shift = np.array([left, top])
+        return [(np.array(feature) + shift).tolist() for feature in features]
+
     def segment(
         self,
         point_coordinates: Union[list, np.ndarray],
         point_labels: Union[list, np.ndarray],
+        max_tiles: int = 9,
         context: dict = None,
     ) -> list:
-        from kaibu_utils import mask_to_features
-        from segment_anything import SamPredictor
+        """Segment an object from point prompts given as (row, column).
+
+        For tiled embeddings, masks crossing tile borders are followed into
+        at most `max_tiles` neighbouring tiles and stitched together.
+        """
         user_id = context["user"].get("id")
-        if user_id not in self.embeddings:
+        embedding = self._get_user_embedding(user_id)
+        if embedding is None:
             self.logger.info(f"User {user_id} not found in cache.")
             return []
         self.logger.info(
-            f"User {user_id} - segmenting with model {self.embeddings[user_id]['model_name']}..."
+            f"User {user_id} - segmenting with model {embedding['model_name']}..."
         )
-        # Load the model with the pre-computed embedding
-        sam = self._load_model(self.embeddings[user_id]["model_name"])
-        predictor = SamPredictor(sam)
-        for key, value in self.embeddings[user_id].items():
-            if key != "model_name":
-                setattr(predictor, key, value)
         # Run the segmentation
         self.logger.debug(
             f"User {user_id} - point coordinates: {point_coordinates}, {point_labels}"
@@ -140,16 +1077,155 @@ class MicroSAM:
             point_coordinates = np.array(point_coordinates, dtype=np.float32)
         if isinstance(point_labels, list):
             point_labels = np.array(point_labels, dtype=np.float32)
-        mask, scores, logits = predictor.predict(
-            point_coords=point_coordinates[
-                :, ::-1
-            ],  # SAM has reversed XY conventions
-            point_labels=point_labels,
-            multimask_output=False,
-        )
+        if "image" in embedding:
+            mask, offset = self._segment_tiled(
+                embedding, point_coordinates, point_labels, max_tiles
+            )
+            self.logger.debug(f"User {user_id} - stitched mask of shape {mask.shape}")
+            return self._mask_to_features(mask, offset)
+        mask = self._predict_mask(embedding, point_coordinates, point_labels)
         self.logger.debug(f"User {user_id} - predicted mask of shape {mask.shape}")
-        features = mask_to_features(mask[0])
+        features = self._mask_to_features(mask)
         return features
 
+    def segment_batch(
+        self, prompts: list, max_tiles: int = 9, context: dict = None
+    ) -> list:
+        """Segment several objects in one call, one mask per prompt.
+
+        Each prompt is a dict with optional `point_coordinates` (row, column),
+        `point_labels` and `box` (row_min, col_min, row_max, col_max). All
+        prompts are decoded together as one batch. Returns a list with the
+        features of each mask.
+        """
+        user_id = context["user"].get("id")
+        embedding = self._get_user_embedding(user_id)
+        if embedding is None:
+            self.logger.info(f"User {user_id} not found in cache.")
+            return []
+        prompts = [self._parse_prompt(prompt) for prompt in prompts]
+        self.logger.info(
+            f"User {user_id} - segmenting {len(prompts)} objects with model {embedding['model_name']}..."
+        )
+        if "image" in embedding:
+            # Tiles are chosen per prompt, so tiled prompts are decoded one by one
+            results = []
+            for prompt in prompts:
+                if prompt["box"] is not None:
+                    raise ValueError(
+                        "Box prompts are not supported for tiled embeddings."
+                    )
+                mask, offset = self._segment_tiled(
+                    embedding,
+                    prompt["point_coordinates"],
+                    prompt["point_labels"],
+                    max_tiles,
+                )
+                results.append(self._mask_to_features(mask, offset))
+            return results
+        masks = self._predict_masks_batched(embedding, prompts)
+        return [self._mask_to_features(mask) for mask in masks]
+
+    def segment_all(
+        self,
+        points_per_side: int = 32,
+        points_per_batch: int = 64,
+        pred_iou_thresh: float = 0.88,
+        stability_score_thresh: float = 0.95,
+        box_nms_thresh: float = 0.7,
+        min_mask_area: int = 0,
+        output: str = "features",
+        context: dict = None,
+    ):
+        """Segment all objects in the image from a grid of point prompts.
+
+        Reuses the embedding from `compute_embedding` and decodes the point
+        grid in batches of `points_per_batch`. Returns the features of all
+        objects, or a label image with `output="labels"`.
+        """
+        import torch
+        from segment_anything.utils.amg import (
+            batched_mask_to_box,
+            build_point_grid,
+            calculate_stability_score,
+        )
+        from torchvision.ops.boxes import batched_nms
+
+        if output not in ("features", "labels"):
+            raise ValueError(f"Invalid output {output}, use 'features' or 'labels'.")
+        user_id = context["user"].get("id")
+        embedding = self._get_user_embedding(user_id)
+        if embedding is None:
+            self.logger.info(f"User {user_id} not found in cache.")
+            return []
+        if "image" in embedding:
+            raise ValueError(
+                "Automatic segmentation is not supported for tiled embeddings."
+            )
+        self.logger.info(
+            f"User {user_id} - segmenting all objects with model {embedding['model_name']}..."
+        )
+        height, width = embedding["original_size"]
+        # Grid points are (x, y), SAM's convention
+        grid = build_point_grid(points_per_side) * np.array([[width, height]])
+        predictor, predictor_lock = self._get_predictor(embedding["model_name"])
+        mask_threshold = predictor.model.mask_threshold
+        masks, scores = [], []
+        start_time = time.perf_counter()
+        with predictor_lock:
+            self._set_predictor_embedding(predictor, embedding)
+            for batch_start in range(0, len(grid), points_per_batch):
+                points = grid[batch_start : batch_start + points_per_batch]
+                coords = predictor.transform.apply_coords(
+                    points, predictor.original_size
+                )
+                coords = torch.as_tensor(
+                    coords[:, None, :], dtype=torch.float, device=predictor.device
+                )
+                labels = torch.ones(
+                    coords.shape[:2], dtype=torch.int, device=predictor.device
+                )
+                logits, iou_preds, _ = predictor.predict_torch(
+                    coords, labels, multimask_output=True, return_logits=True
+                )
+                # Filter all candidate masks of the batch at once
+                logits = logits.flatten(0, 1)
+                iou_preds = iou_preds.flatten()
+                stability = calculate_stability_score(logits, mask_threshold, 1.0)
+                keep = (iou_preds > pred_iou_thresh) & (
+                    stability >= stability_score_thresh
+                )
+                batch_masks = logits[keep] > mask_threshold
+                keep_area = batch_masks.flatten(1).sum(1) > min_mask_area
+                masks.append(batch_masks[keep_area])
+                scores.append(iou_preds[keep][keep_area])
+        n_decoded = len(grid) * 3
+        masks = torch.cat(masks)
+        scores = torch.cat(scores)
+        if len(masks):
+            keep = batched_nms(
+                batched_mask_to_box(masks).float(),
+                scores,
+                torch.zeros_like(scores),
+                iou_threshold=box_nms_thresh,
+            )
+            masks = masks[keep]
+        # Paint large objects first, so smaller ones stay visible on top
+        areas = masks.flatten(1).sum(1)
+        label_image = torch.zeros(
+            (height, width), dtype=torch.int32, device=masks.device
+        )
+        for label, index in enumerate(torch.argsort(areas, descending=True), start=1):
+            label_image[masks[index]] = label
+        label_image = label_image.cpu().numpy()
+        duration = time.perf_counter() - start_time
+        self.logger.info(
+            f"User {user_id} - found {len(masks)} objects in {duration:.2f}s "
+            f"({n_decoded / duration:.1f} masks/s decoded)"
+        )
+        if output == "labels":
+            return label_image.astype(np.uint16 if len(masks) < 2**16 else np.uint32)
+        return self._mask_to_features(label_image)
+
 
 api.export(MicroSAM)
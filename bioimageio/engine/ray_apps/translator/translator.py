@@ -16,5 +16,50 @@ class Translator:
 
         return translation
 
+    def translate_stream(self, text: str):
+        # Yield the translation piece by piece while it is generated
+        from threading import Event, Thread
+        import torch
+        from transformers import (
+            StoppingCriteria,
+            StoppingCriteriaList,
+            TextIteratorStreamer,
+        )
+
+        # Set when the caller goes away, so generation stops at the next token
+        stopped = Event()
+
+        class StopWhenClosed(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return torch.full(
+                    (input_ids.shape[0],),
+                    stopped.is_set(),
+                    dtype=torch.bool,
+                    device=input_ids.device,
+                )
+
+        tokenizer = self.model.tokenizer
+        params = self.model.model.config.task_specific_params or {}
+        prefix = params.get("translation_en_to_fr", {}).get("prefix", "")
+        inputs = tokenizer(prefix + text, return_tensors="pt").to(self.model.device)
+        streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+        thread = Thread(
+            target=self.model.model.generate,
+            kwargs=dict(
+                **inputs,
+                streamer=streamer,
+                max_new_tokens=512,
+                stopping_criteria=StoppingCriteriaList([StopWhenClosed()]),
+            ),
+        )
+        thread.start()
+        try:
+            for piece in streamer:
+                if piece:
+                    yield piece
+        finally:
+            stopped.set()
+            thread.join()
+
 
 api.export(Translator)
\ No newline at end of file
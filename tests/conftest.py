@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import hypha_rpc
+import numpy as np
+import pytest
+
+RAY_APPS_DIR = Path(__file__).parent.parent / "bioimageio" / "engine" / "ray_apps"
+
+
+def load_ray_app(app_id: str) -> dict:
+    """Load a ray app entrypoint with `ray_app_loader.load_app`.
+
+    Like on the server, every app is executed in the globals of the loader
+    module, which are returned, so names that clash between apps show up in
+    the tests. Nothing is registered on a Hypha server.
+    """
+    import yaml
+
+    from bioimageio.engine import ray_app_loader
+
+    app_dir = RAY_APPS_DIR / app_id
+    manifest = yaml.safe_load((app_dir / "manifest.yaml").read_text())
+    original_api = hypha_rpc.api
+    try:
+        ray_app_loader.load_app(str(app_dir / manifest["entrypoint"]), manifest)
+    finally:
+        hypha_rpc.api = original_api
+    return vars(ray_app_loader)
+
+
+@pytest.fixture(scope="module")
+def micro_sam_module():
+    pytest.importorskip("cachetools")
+    return load_ray_app("micro_sam")
+
+
+@pytest.fixture(scope="module")
+def tiny_sam():
+    """A randomly initialized SAM with a single small encoder block."""
+    pytest.importorskip("segment_anything")
+    import torch
+    from segment_anything.build_sam import _build_sam
+
+    # Fixed weights and test images, so prompted masks are never empty by chance
+    torch.manual_seed(0)
+    np.random.seed(0)
+    return _build_sam(
+        encoder_embed_dim=32,
+        encoder_depth=1,
+        encoder_num_heads=1,
+        encoder_global_attn_indexes=[],
+    )
+
+
+@pytest.fixture
+def micro_sam(micro_sam_module, tiny_sam, tmp_path):
+    app = micro_sam_module["MicroSAM"](embedding_spill_dir=str(tmp_path / "spill"))
+    app.models["vit_b"] = tiny_sam
+    return app
+
+
+def user_context(user_id: str) -> dict:
+    return {"user": {"id": user_id}}
+
+
+@pytest.fixture(scope="module")
+def cellpose_module():
+    return load_ray_app("cellpose")
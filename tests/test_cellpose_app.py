@@ -0,0 +1,554 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+import pytest
+
+
+def _random_labels(shape=(2048, 2048), n_objects=2000, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.uint16)
+    for label, (r, c) in enumerate(rng.integers(0, shape[0] - 30, (n_objects, 2)), 1):
+        labels[r : r + 30, c : c + 30] = label
+    return labels
+
+
+def _pack(obj) -> bytes:
+    """Serialize like hypha-rpc: msgpack with numpy arrays sent as raw bytes."""
+    msgpack = pytest.importorskip("msgpack")
+
+    def default(value):
+        if isinstance(value, np.ndarray):
+            return {
+                "_rtype": "ndarray",
+                "_rvalue": value.tobytes(),
+                "_rshape": list(value.shape),
+                "_rdtype": str(value.dtype),
+            }
+        raise TypeError(type(value))
+
+    return msgpack.packb(obj, default=default)
+
+
+@pytest.mark.parametrize("encoding", ["array", "rle", "compressed", "list"])
+def test_mask_encoding_roundtrip(cellpose_module, encoding):
+    labels = _random_labels((256, 256), 50)
+    encoded = cellpose_module["encode_mask"](labels, encoding)
+    np.testing.assert_array_equal(cellpose_module["decode_mask"](encoded), labels)
+
+
+def test_mask_encoding_benchmark(cellpose_module):
+    """Compare serialization time and payload size of the mask encodings."""
+    labels = _random_labels()
+    sizes, durations = {}, {}
+    for encoding in ["list", "array", "rle", "compressed"]:
+        start = time.perf_counter()
+        payload = _pack({"masks": [cellpose_module["encode_mask"](labels, encoding)]})
+        durations[encoding] = time.perf_counter() - start
+        sizes[encoding] = len(payload)
+        print(
+            f"{encoding:>10}: {durations[encoding] * 1000:8.1f} ms, "
+            f"{sizes[encoding] / 1024**2:6.2f} MB"
+        )
+    assert durations["array"] < durations["list"]
+    assert sizes["rle"] < sizes["array"]
+    assert sizes["compressed"] < sizes["array"]
+
+
+def test_model_cache_coalesces_concurrent_loads(cellpose_module):
+    from concurrent.futures import ThreadPoolExecutor
+
+    import torch
+
+    loads = []
+
+    def load_model(model_type):
+        loads.append(model_type)
+        time.sleep(0.2)
+        return torch.nn.Linear(8, 8)
+
+    cache = cellpose_module["ModelCache"](load_model, max_models=2)
+    with ThreadPoolExecutor(8) as executor:
+        models = list(executor.map(cache.get, ["cyto3"] * 8))
+    assert loads == ["cyto3"]
+    assert all(model is models[0] for model in models)
+    assert cache.get("cyto3") is models[0]
+    stats = cache.get_stats()
+    assert stats["loads"] == 1 and stats["hits"] == 1
+    assert stats["misses"] + stats["coalesced"] == 8
+    assert stats["load_time"] >= 0.2
+
+
+def test_model_cache_evicts_least_recently_used(cellpose_module):
+    import torch
+
+    loads = []
+
+    def load_model(model_type):
+        loads.append(model_type)
+        return torch.nn.Linear(16, 16)  # 272 parameters, 1088 bytes
+
+    cache = cellpose_module["ModelCache"](load_model, max_models=3, max_bytes=2500)
+    for model_type in ["cyto3", "nuclei", "cyto3", "tissuenet", "cyto3", "nuclei"]:
+        cache.get(model_type)
+    # the byte budget holds two models, so "nuclei" and "tissuenet" were evicted
+    assert loads == ["cyto3", "nuclei", "tissuenet", "nuclei"]
+    stats = cache.get_stats()
+    assert stats["models"] == ["cyto3", "nuclei"]
+    assert stats["nbytes"] == 2 * 1088
+    assert stats["evictions"] == 2
+    assert stats["hit_rate"] == 2 / 6
+
+
+def test_model_cache_load_failure_is_not_cached(cellpose_module):
+    calls = []
+
+    def load_model(model_type):
+        calls.append(model_type)
+        raise RuntimeError("download failed")
+
+    cache = cellpose_module["ModelCache"](load_model)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            cache.get("cyto3")
+    assert calls == ["cyto3", "cyto3"]
+
+
+class _FakeCellpose:
+    """Stand-in for `cellpose.models.Cellpose` that labels each image with its mean."""
+
+    def __init__(self):
+        self.calls = []
+
+    def eval(self, images, diameter=None, flow_threshold=None, channels=None):
+        self.calls.append((len(images), diameter, channels))
+        time.sleep(0.05)
+        masks = [np.full(image.shape[:2], image.mean(), dtype=np.uint16) for image in images]
+        diams = [30.0] * len(images) if diameter is None else diameter
+        return masks, None, None, diams
+
+
+@pytest.fixture
+def cellpose_app(cellpose_module):
+    pytest.importorskip("cellpose")
+    fake = _FakeCellpose()
+    app = cellpose_module["CellposeModel"](batch_wait_timeout=0.02)
+    app.models = cellpose_module["ModelCache"](lambda model_type: fake)
+    app.fake = fake
+    return app
+
+
+@pytest.mark.asyncio
+async def test_predict_batches_concurrent_requests(cellpose_app):
+    images = [np.full((64, 64), i, dtype=np.uint8) for i in range(12)]
+    calls = [cellpose_app.predict([image]) for image in images[:8]]
+    calls.append(cellpose_app.predict(images[8:], diameter=17))
+    calls.append(cellpose_app.predict([images[0]], model_type="nuclei"))
+    results = await asyncio.gather(*calls)
+
+    # the eight default requests share one eval, the others cannot join it
+    assert sorted(n for n, _, _ in cellpose_app.fake.calls) == [1, 4, 8]
+    for i, result in enumerate(results[:8]):
+        assert result["masks"][0].dtype == np.uint16
+        assert np.all(result["masks"][0] == i)
+        assert result["diameters"] == [30.0]
+    assert [int(mask[0, 0]) for mask in results[8]["masks"]] == [8, 9, 10, 11]
+    assert results[8]["diameters"] == [17.0] * 4
+
+    stats = cellpose_app.get_batching_stats()
+    assert stats["batches"] == 3 and stats["requests"] == 10
+    assert stats["max_batch_size"] == 8
+    assert stats["mean_queue_wait"] > 0
+
+
+@pytest.mark.asyncio
+async def test_predict_reads_image_references_in_parallel(cellpose_module, cellpose_app, monkeypatch):
+    def slow_open_image(image):
+        time.sleep(0.2)
+        return np.full((32, 32), image["value"], dtype=np.uint8)
+
+    monkeypatch.setitem(cellpose_module, "open_image", slow_open_image)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    start = time.perf_counter()
+    cellpose_app.readable_uris = ["memory://images"]
+    result = await cellpose_app.predict([{"uri": f"memory://images/{i}", "value": i} for i in range(4)])
+    elapsed = time.perf_counter() - start
+    ticker.cancel()
+    assert [int(mask[0, 0]) for mask in result["masks"]] == [0, 1, 2, 3]
+    # the images are read at the same time, without blocking the event loop
+    assert elapsed < 0.5
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.1
+
+
+@pytest.mark.asyncio
+async def test_predict_stream_yields_masks_as_they_finish(cellpose_app):
+    cellpose_app.batcher.max_batch_size = 2
+    images = [np.full((32, 32), i, dtype=np.uint8) for i in range(5)]
+    start = time.perf_counter()
+    results = []
+    async for result in cellpose_app.predict_stream(images, diameter=20):
+        results.append((result, time.perf_counter() - start))
+
+    assert sorted(result["index"] for result, _ in results) == list(range(5))
+    for result, _ in results:
+        assert np.all(result["mask"] == result["index"])
+        assert result["diameter"] == 20
+    # the first batch arrives long before the last one
+    assert [n for n, _, _ in cellpose_app.fake.calls] == [2, 2, 1]
+    assert results[0][1] < results[-1][1] - 0.05
+
+
+@pytest.mark.asyncio
+async def test_predict_batch_flushes_when_full(cellpose_app):
+    cellpose_app.batcher.max_batch_size = 4
+    cellpose_app.batcher.batch_wait_timeout = 10
+    images = [np.zeros((32, 32), dtype=np.uint8)] * 4
+    results = await asyncio.wait_for(
+        asyncio.gather(*[cellpose_app.predict([image]) for image in images]), 5
+    )
+    assert len(results) == 4
+    assert [n for n, _, _ in cellpose_app.fake.calls] == [4]
+
+
+@pytest.mark.asyncio
+async def test_predict_batch_error_reaches_every_caller(cellpose_app):
+    def fail(*args, **kwargs):
+        raise ValueError("bad image")
+
+    cellpose_app.fake.eval = fail
+    image = np.zeros((32, 32), dtype=np.uint8)
+    results = await asyncio.gather(
+        cellpose_app.predict([image]), cellpose_app.predict([image]), return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+class _ComponentCellpose:
+    """Stand-in for `cellpose.models.Cellpose` that labels connected components."""
+
+    def eval(self, images, diameter=None, flow_threshold=None, channels=None):
+        from scipy import ndimage
+
+        masks = [ndimage.label(image > 0)[0].astype(np.uint16) for image in images]
+        return masks, None, None, [diameter or 30.0] * len(images)
+
+
+def _random_disks(shape=(300, 340), n_objects=60, radius=9, seed=1) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows, cols = np.ogrid[: shape[0], : shape[1]]
+    image = np.zeros(shape, dtype=np.uint8)
+    centers = []
+    while len(centers) < n_objects:
+        center = rng.integers(radius, np.array(shape) - radius)
+        if all(np.hypot(*(center - other)) > 2 * radius + 2 for other in centers):
+            centers.append(center)
+            image[(rows - center[0]) ** 2 + (cols - center[1]) ** 2 <= radius**2] = 255
+    return image
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("order", ["row-major", "shuffled"])
+async def test_tiled_prediction_matches_whole_image(cellpose_module, cellpose_app, tmp_path, order):
+    import zarr
+    from scipy import ndimage
+
+    cellpose_app.models = cellpose_module["ModelCache"](lambda model_type: _ComponentCellpose())
+    image = _random_disks()
+    expected, num_labels = ndimage.label(image > 0)
+
+    cellpose_app.output_dir = str(tmp_path)
+    info = cellpose_app.start_tiled_prediction(image.shape, tile_size=96, tile_overlap=32, diameter=18)
+    assert info["path"].startswith(str(tmp_path))
+    tiles = info["tiles"]
+    assert len(tiles) == 25
+    if order == "shuffled":
+        tiles = [tiles[i] for i in np.random.default_rng(0).permutation(len(tiles))]
+    for top, left, bottom, right in tiles:
+        progress = await cellpose_app.predict_tile(info["id"], image[top:bottom, left:right], top, left)
+    assert progress == {"done": 25, "total": 25}
+    result = cellpose_app.finish_tiled_prediction(info["id"])
+
+    labels = zarr.open(result["path"], mode="r")
+    assert labels.chunks == (96, 96) and labels.dtype == np.uint32
+    labels = labels[:]
+    assert result["num_labels"] == num_labels
+    assert set(np.unique(labels)) == set(range(num_labels + 1))
+    # every object keeps a single label, and no two objects share one
+    pairs = np.unique(np.stack([expected.ravel(), labels.ravel()]), axis=1)
+    assert pairs.shape[1] == num_labels + 1
+
+
+@pytest.mark.asyncio
+async def test_predict_chunked_matches_whole_image(cellpose_module, cellpose_app, tmp_path):
+    import zarr
+    from scipy import ndimage
+
+    cellpose_app.models = cellpose_module["ModelCache"](lambda model_type: _ComponentCellpose())
+    image = _random_disks()
+    zarr.save_array(str(tmp_path / "image.zarr"), image, chunks=(50, 50))
+    expected, num_labels = ndimage.label(image > 0)
+
+    reference = {"uri": str(tmp_path / "image.zarr")}
+    cellpose_app.readable_uris = [str(tmp_path)]
+    result = await cellpose_app.predict_chunked(reference, tile_size=96, tile_overlap=32, diameter=18)
+    labels = zarr.open(result["path"], mode="r")[:]
+    assert result["num_labels"] == num_labels
+    pairs = np.unique(np.stack([expected.ravel(), labels.ravel()]), axis=1)
+    assert pairs.shape[1] == num_labels + 1
+    assert not cellpose_app.tiled_predictions
+
+    # whole images can be referenced in `predict` too
+    result = await cellpose_app.predict([reference])
+    np.testing.assert_array_equal(result["masks"][0], expected)
+
+
+def test_abandoned_tiled_predictions_expire(cellpose_app, tmp_path):
+    cellpose_app.output_dir = str(tmp_path)
+    cellpose_app.tiled_prediction_ttl = 60
+    abandoned = cellpose_app.start_tiled_prediction((200, 200), tile_size=96, tile_overlap=32)
+    assert os.path.exists(abandoned["path"])
+    cellpose_app.tiled_predictions[abandoned["id"]]["last_used"] -= 61
+
+    info = cellpose_app.start_tiled_prediction((200, 200), tile_size=96, tile_overlap=32)
+    assert list(cellpose_app.tiled_predictions) == [info["id"]]
+    assert not os.path.exists(os.path.dirname(abandoned["path"]))
+    with pytest.raises(ValueError, match="not found"):
+        cellpose_app.finish_tiled_prediction(abandoned["id"])
+
+
+async def _wait_for_dataset_job(app, job_id, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        job = app.get_dataset_job(job_id)
+        if job["status"] not in ("queued", "running"):
+            return job
+        await asyncio.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+@pytest.mark.asyncio
+async def test_dataset_job_writes_masks_and_resumes(cellpose_app, tmp_path):
+    import fsspec
+    import tifffile
+
+    uris = []
+    for i in range(12):
+        uris.append(str(tmp_path / f"image_{i}.tif"))
+        tifffile.imwrite(uris[-1], np.full((32, 32), i + 1, dtype=np.uint8))
+    (tmp_path / "manifest.txt").write_text("\n".join(uris))
+    output_uri = "memory://dataset-job/masks"
+    cellpose_app.readable_uris = [str(tmp_path)]
+    cellpose_app.writable_uris = ["memory://dataset-job"]
+
+    job_id = await cellpose_app.submit_dataset_job(str(tmp_path / "manifest.txt"), output_uri, max_in_flight=4)
+    job = await _wait_for_dataset_job(cellpose_app, job_id)
+    assert job["status"] == "completed"
+    assert (job["total"], job["completed"], job["skipped"], job["failed"]) == (12, 12, 0, 0)
+    assert job["throughput"] > 0
+    # requests in flight are batched together, but never more than four
+    assert 1 < len(cellpose_app.fake.calls) < 12
+    assert max(n for n, _, _ in cellpose_app.fake.calls) <= 4
+
+    fs = fsspec.filesystem("memory")
+    outputs = sorted(fs.find("/dataset-job/masks"))
+    assert len(outputs) == 12 and not [path for path in outputs if path.endswith(".part")]
+    with fs.open(outputs[0], "rb") as f:
+        mask = np.load(f)
+    assert mask.shape == (32, 32) and len(np.unique(mask)) == 1
+
+    # a resubmitted job only processes the items without an output
+    fs.rm(outputs[3])
+    # outputs are matched by their path in the output directory, not by name
+    fs.pipe(f"/dataset-job/masks/nested/{os.path.basename(outputs[3])}", b"")
+    calls = len(cellpose_app.fake.calls)
+    job_id = await cellpose_app.submit_dataset_job(uris, output_uri)
+    job = await _wait_for_dataset_job(cellpose_app, job_id)
+    assert (job["completed"], job["skipped"]) == (1, 11)
+    assert len(cellpose_app.fake.calls) == calls + 1
+    assert fs.exists(outputs[3])
+
+
+@pytest.mark.asyncio
+async def test_dataset_job_spreads_items_over_workers(cellpose_app, tmp_path, monkeypatch):
+    in_flight, peak, calls = [0], [0], [0, 0]
+
+    def worker(index):
+        async def predict(images, **kwargs):
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+            calls[index] += 1
+            await asyncio.sleep(0.01)
+            in_flight[0] -= 1
+            if images[0]["uri"].endswith("broken.npy"):
+                raise ValueError("cannot read image")
+            return {"masks": [np.zeros((4, 4), dtype=np.uint8)]}
+
+        return predict
+
+    monkeypatch.setattr(cellpose_app, "_get_dataset_workers", lambda: [worker(0), worker(1)])
+    manifest = [f"s3://bucket/image_{i}.npy" for i in range(40)] + ["s3://bucket/broken.npy"]
+    cellpose_app.readable_uris = ["s3://bucket"]
+    cellpose_app.writable_uris = [str(tmp_path)]
+    job_id = await cellpose_app.submit_dataset_job(manifest, str(tmp_path / "masks"), max_in_flight=6)
+    job = await _wait_for_dataset_job(cellpose_app, job_id)
+    assert (job["completed"], job["failed"]) == (40, 1)
+    assert job["errors"] == [{"uri": "s3://bucket/broken.npy", "error": "cannot read image"}]
+    assert peak[0] == 6
+    assert min(calls) >= 15
+    assert len(list((tmp_path / "masks").iterdir())) == 40
+
+
+
+@pytest.mark.asyncio
+async def test_dataset_jobs_only_use_allowed_locations(cellpose_app, tmp_path):
+    cellpose_app.readable_uris = [str(tmp_path / "images")]
+    cellpose_app.writable_uris = ["memory://masks"]
+    image = str(tmp_path / "images" / "a.npy")
+    for manifest, output_uri in [
+        ([image], str(tmp_path / "masks")),
+        ([image], "memory://masks/../other"),
+        ([str(tmp_path / "secret.npy")], "memory://masks"),
+        (str(tmp_path / "manifest.txt"), "memory://masks"),
+    ]:
+        with pytest.raises(PermissionError):
+            await cellpose_app.submit_dataset_job(manifest, output_uri)
+    with pytest.raises(ValueError, match="plain file name"):
+        await cellpose_app.submit_dataset_job([{"uri": image, "output": "../a.npy"}], "memory://masks")
+    with pytest.raises(PermissionError):
+        await cellpose_app.predict([{"uri": str(tmp_path / "secret.npy")}])
+    assert not cellpose_app.dataset_jobs
+
+
+@pytest.mark.asyncio
+async def test_finished_dataset_jobs_expire(cellpose_app, tmp_path):
+    cellpose_app.readable_uris = [str(tmp_path)]
+    cellpose_app.writable_uris = ["memory://expiring"]
+    cellpose_app.dataset_job_ttl = 60
+    np.save(tmp_path / "a.npy", np.ones((16, 16), dtype=np.uint8))
+    job_id = await cellpose_app.submit_dataset_job([str(tmp_path / "a.npy")], "memory://expiring")
+    await _wait_for_dataset_job(cellpose_app, job_id)
+
+    cellpose_app.dataset_jobs[job_id]["finished_at"] -= 61
+    new_job_id = await cellpose_app.submit_dataset_job([str(tmp_path / "a.npy")], "memory://expiring")
+    assert list(cellpose_app.dataset_jobs) == [new_job_id]
+    with pytest.raises(ValueError, match="not found"):
+        cellpose_app.get_dataset_job(job_id)
+    await _wait_for_dataset_job(cellpose_app, new_job_id)
+
+@pytest.fixture
+def tiny_trainer(cellpose_module, monkeypatch):
+    from cellpose.resnet_torch import CPnet
+
+    trainer_class = cellpose_module["CellposeTrainer"]
+    monkeypatch.setattr(trainer_class, "_create_net", lambda self, model_type: CPnet([2, 8, 16], 3, 3))
+    return trainer_class
+
+
+async def _wait_for_training_job(app, job_id, timeout=60):
+    losses = []
+    for _ in range(int(timeout / 0.05)):
+        job = await app.get_training_job(job_id, since=len(losses))
+        losses += job["losses"]
+        if job["status"] not in ("queued", "running"):
+            return job, losses
+        await asyncio.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+@pytest.mark.asyncio
+async def test_training_jobs_run_concurrently(cellpose_app, tiny_trainer, tmp_path):
+    from scipy import ndimage
+
+    cellpose_app.training_dir = str(tmp_path)
+    images = [_random_disks((96, 96), 6, seed=i) for i in range(4)]
+    labels = [ndimage.label(image > 0)[0] for image in images]
+    config = {"n_epochs": 4, "save_every": 2, "batch_size": 2, "bsize": 64}
+
+    job_ids = [cellpose_app.train(images, labels, config) for _ in range(2)]
+    results = await asyncio.gather(*[_wait_for_training_job(cellpose_app, job_id) for job_id in job_ids])
+    for job_id, (job, losses) in zip(job_ids, results):
+        assert job["status"] == "completed", job["error"]
+        # polling with `since` streams every epoch loss exactly once
+        assert [loss["epoch"] for loss in losses] == [1, 2, 3, 4]
+        assert all(np.isfinite(loss["loss"]) for loss in losses)
+        assert job["checkpoints"] == [str(tmp_path / job_id / "epoch_2.pth")]
+        assert (tmp_path / job_id / "model.pth").exists()
+
+
+@pytest.mark.asyncio
+async def test_watch_training_job_streams_losses(cellpose_app, tiny_trainer, tmp_path):
+    from scipy import ndimage
+
+    cellpose_app.training_dir = str(tmp_path)
+    images = [_random_disks((96, 96), 6, seed=i) for i in range(2)]
+    labels = [ndimage.label(image > 0)[0] for image in images]
+    job_id = cellpose_app.train(images, labels, {"n_epochs": 3, "batch_size": 2, "bsize": 64})
+    updates = [update async for update in cellpose_app.watch_training_job(job_id, interval=0.05)]
+    assert updates[-1]["status"] == "completed", updates[-1]["error"]
+    assert [loss["epoch"] for update in updates for loss in update["losses"]] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_training_job_can_be_cancelled(cellpose_app, tiny_trainer, tmp_path):
+    from scipy import ndimage
+
+    cellpose_app.training_dir = str(tmp_path)
+    images = [_random_disks((96, 96), 6, seed=i) for i in range(2)]
+    labels = [ndimage.label(image > 0)[0] for image in images]
+    job_id = cellpose_app.train(images, labels, {"n_epochs": 1000, "bsize": 64})
+    assert await cellpose_app.cancel_training_job(job_id)
+    job, _ = await _wait_for_training_job(cellpose_app, job_id)
+    assert job["status"] == "cancelled"
+    with pytest.raises(ValueError):
+        cellpose_app.train(images, labels[:1])
+
+
+@pytest.mark.asyncio
+async def test_finished_training_jobs_are_released_and_expire(cellpose_app, tiny_trainer, tmp_path):
+    from scipy import ndimage
+
+    cellpose_app.training_dir = str(tmp_path)
+    images = [_random_disks((96, 96), 6, seed=i) for i in range(2)]
+    labels = [ndimage.label(image > 0)[0] for image in images]
+    job_id = cellpose_app.train(images, labels, {"n_epochs": 2, "batch_size": 2, "bsize": 64})
+    job, losses = await _wait_for_training_job(cellpose_app, job_id)
+    while cellpose_app.training_jobs[job_id]["trainer"] is not None:
+        await asyncio.sleep(0.01)
+    # the final progress is kept without the trainer
+    assert (await cellpose_app.get_training_job(job_id, since=1))["losses"] == losses[1:]
+    assert not await cellpose_app.cancel_training_job(job_id)
+    cellpose_app.training_job_ttl = 0
+    new_job_id = cellpose_app.train(images, labels, {"n_epochs": 1, "batch_size": 2, "bsize": 64})
+    assert job_id not in cellpose_app.training_jobs
+    assert len(cellpose_app.training_jobs) == 1
+    await _wait_for_training_job(cellpose_app, new_job_id)
+
+
+@pytest.mark.asyncio
+async def test_training_actor_is_killed_when_the_job_finishes(cellpose_app, tiny_trainer, tmp_path):
+    import ray
+    from scipy import ndimage
+
+    ray.init(num_cpus=2, include_dashboard=False)
+    try:
+        cellpose_app.training_dir = str(tmp_path)
+        images = [_random_disks((96, 96), 6, seed=i) for i in range(2)]
+        labels = [ndimage.label(image > 0)[0] for image in images]
+        job_id = cellpose_app.train(images, labels, {"n_epochs": 2, "batch_size": 2, "bsize": 64, "num_gpus": 0})
+        actor = cellpose_app.training_jobs[job_id]["trainer"]
+        job, losses = await _wait_for_training_job(cellpose_app, job_id, timeout=120)
+        assert job["status"] == "completed", job["error"]
+        while cellpose_app.training_jobs[job_id]["trainer"] is not None:
+            await asyncio.sleep(0.05)
+        with pytest.raises(ray.exceptions.RayActorError):
+            await actor.get_progress.remote()
+        assert [loss["epoch"] for loss in (await cellpose_app.get_training_job(job_id))["losses"]] == [1, 2]
+    finally:
+        ray.shutdown()
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from bioimageio.engine.image_io import ChunkedImage, check_uri, open_image
+
+
+def test_chunked_image_reads_ome_zarr_levels(tmp_path):
+    import zarr
+
+    image = np.random.default_rng(0).integers(
+        0, 255, (1, 2, 3, 200, 160), dtype=np.uint8
+    )
+    root = zarr.open_group(str(tmp_path / "image.ome.zarr"), mode="w")
+    root.create_dataset("0", data=image, chunks=(1, 1, 1, 64, 64))
+    root.create_dataset("1", data=image[..., ::2, ::2], chunks=(1, 1, 1, 64, 64))
+    root.attrs["multiscales"] = [
+        {
+            "axes": [{"name": name} for name in "tczyx"],
+            "datasets": [{"path": "0"}, {"path": "1"}],
+        }
+    ]
+
+    lazy = open_image({"uri": str(tmp_path / "image.ome.zarr"), "level": 1})
+    assert lazy.shape == (100, 80, 2)
+    np.testing.assert_array_equal(
+        np.asarray(lazy), np.moveaxis(image[0, :, 0, ::2, ::2], 0, -1)
+    )
+    np.testing.assert_array_equal(
+        lazy[10:90, 70:], np.moveaxis(image[0, :, 0, 20:180:2, 140::2], 0, -1)
+    )
+
+    lazy = ChunkedImage(str(tmp_path / "image.ome.zarr"), index=[0, 1, 2])
+    np.testing.assert_array_equal(lazy[5:150, 3:77], image[0, 1, 2, 5:150, 3:77])
+
+
+def test_image_files_are_read_whole(tmp_path):
+    image = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    np.save(tmp_path / "image.npy", image)
+    np.testing.assert_array_equal(open_image(str(tmp_path / "image.npy")), image)
+    array = np.zeros((2, 2))
+    assert open_image(array) is array
+
+
+def test_chunked_image_intensity_range_reads_the_coarsest_level(tmp_path):
+    import zarr
+
+    image = np.arange(256 * 256, dtype=np.uint16).reshape(1, 256, 256)
+    root = zarr.open_group(str(tmp_path / "image.ome.zarr"), mode="w")
+    root.create_dataset("0", data=image, chunks=(1, 64, 64))
+    root.create_dataset("1", data=image[:, ::4, ::4], chunks=(1, 64, 64))
+    root.attrs["multiscales"] = [
+        {
+            "axes": [{"name": name} for name in "cyx"],
+            "datasets": [{"path": "0"}, {"path": "1"}],
+        }
+    ]
+    lazy = open_image({"uri": str(tmp_path / "image.ome.zarr")})
+    assert lazy.intensity_range() == (0, image[0, ::4, ::4].max())
+
+    plain = open_image({"uri": str(tmp_path / "image.ome.zarr" / "0")})
+    assert plain.intensity_range() == (0, image.max())
+    # large images are subsampled
+    low, high = plain.intensity_range(max_pixels=64 * 64)
+    assert low == 0 and image.max() - 256 * 4 < high < image.max()
+
+
+def test_check_uri_rejects_locations_outside_the_allowed_ones(tmp_path):
+    allowed = [str(tmp_path / "data"), "s3://bucket/data/"]
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "link").symlink_to(tmp_path)
+
+    assert check_uri(str(tmp_path / "data" / "a.tif"), allowed)
+    assert check_uri(f"file://{tmp_path}/data/b/c.npy", allowed)
+    assert check_uri("s3://bucket/data/a.tif", allowed)
+    for uri in [
+        str(tmp_path / "data" / ".." / "secret.npy"),
+        str(tmp_path / "data" / "link" / "secret.npy"),
+        str(tmp_path / "database"),
+        "s3://bucket/data/../secret.npy",
+        "s3://bucket/database/a.tif",
+        "memory://bucket/data/a.tif",
+    ]:
+        with pytest.raises(PermissionError):
+            check_uri(uri, allowed)
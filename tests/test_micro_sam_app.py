@@ -0,0 +1,643 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import user_context
+
+
+def _embedding(value: float, size: int = 1024) -> dict:
+    return {
+        "model_name": "vit_b",
+        "features": np.full(size, value, dtype=np.float32),
+    }
+
+
+def test_embedding_cache_spills_and_reloads(micro_sam_module, tmp_path):
+    EmbeddingCache = micro_sam_module["EmbeddingCache"]
+    # Budget fits two 4 KiB entries
+    cache = EmbeddingCache(max_bytes=8192, ttl=60, spill_dir=str(tmp_path))
+    for i in range(4):
+        cache[f"user{i}"] = _embedding(i)
+
+    stats = cache.get_stats()
+    assert stats["memory_bytes"] <= 8192
+    assert stats["memory_entries"] == 2
+    assert stats["spilled_entries"] == 2
+    assert stats["spills"] == 2
+    assert len(list(tmp_path.iterdir())) == 2
+
+    entry = cache.get("user0")
+    assert entry["model_name"] == "vit_b"
+    np.testing.assert_array_equal(entry["features"], np.zeros(1024, np.float32))
+
+    stats = cache.get_stats()
+    assert stats["reloads"] == 1
+    assert stats["memory_bytes"] <= 8192
+    assert cache.get("missing") is None
+    assert cache.get_stats()["misses"] == 1
+
+    del cache["user1"]
+    assert "user1" not in cache
+    assert len(cache) == 3
+
+
+def test_embedding_cache_expires_spilled_entries(micro_sam_module, tmp_path):
+    EmbeddingCache = micro_sam_module["EmbeddingCache"]
+    cache = EmbeddingCache(max_bytes=4096, ttl=0, spill_dir=str(tmp_path))
+    cache["user0"] = _embedding(0)
+    cache["user1"] = _embedding(1)
+    assert len(cache) == 0
+    assert not list(tmp_path.iterdir())
+
+
+def test_embedding_cache_close_removes_spilled_files(micro_sam_module, tmp_path):
+    EmbeddingCache = micro_sam_module["EmbeddingCache"]
+    cache = EmbeddingCache(max_bytes=4096, ttl=60, spill_dir=str(tmp_path))
+    for i in range(3):
+        cache[f"user{i}"] = _embedding(i)
+    assert len(list(tmp_path.iterdir())) == 2
+    cache.close()
+    assert len(cache) == 0
+    # a given spill directory is kept, only its files are removed
+    assert tmp_path.is_dir() and not list(tmp_path.iterdir())
+
+    # a temporary spill directory is removed entirely
+    cache = EmbeddingCache(max_bytes=4096, ttl=60)
+    cache["user0"] = _embedding(0)
+    cache["user1"] = _embedding(1)
+    spill_dir = cache.spill_dir
+    cache.close()
+    assert not os.path.exists(spill_dir)
+
+
+def test_spilled_embeddings_are_bounded(micro_sam_module, tmp_path):
+    app = micro_sam_module["MicroSAM"](
+        embedding_memory_budget=4096,
+        embedding_spill_dir=str(tmp_path / "spill"),
+        embedding_max_spill_bytes=8192,
+        weights_dir=str(tmp_path / "weights"),
+    )
+    for i in range(5):
+        app.embeddings[f"user{i}"] = _embedding(i)
+    stats = app.get_cache_stats()
+    assert stats["spilled_entries"] == 2 and stats["spilled_bytes"] <= 8192
+    assert stats["evictions"] == 2
+
+
+def test_embeddings_are_shared_across_users(micro_sam):
+    image = np.random.rand(64, 64)
+    assert micro_sam.compute_embedding("vit_b", image, context=user_context("a"))
+    assert micro_sam.compute_embedding("vit_b", image, context=user_context("b"))
+    stats = micro_sam.get_cache_stats()
+    assert stats["memory_entries"] == 1
+    assert stats["users"] == 2
+
+    assert micro_sam.segment([[32, 32]], [1], context=user_context("b"))
+    assert micro_sam.reset_embedding(context=user_context("a"))
+    assert micro_sam.get_cache_stats()["memory_entries"] == 1
+    assert micro_sam.segment([[32, 32]], [1], context=user_context("b"))
+    assert micro_sam.reset_embedding(context=user_context("b"))
+    assert micro_sam.get_cache_stats()["memory_entries"] == 0
+    assert not micro_sam.reset_embedding(context=user_context("b"))
+    assert micro_sam.segment([[32, 32]], [1], context=user_context("b")) == []
+
+
+def test_segment_click_latency(micro_sam, n_clicks: int = 10):
+    """Micro-benchmark of per-click segment latency on CPU."""
+    import time
+
+    from segment_anything import SamPredictor
+
+    context = user_context("a")
+    micro_sam.compute_embedding("vit_b", np.random.rand(256, 256), context=context)
+    embedding = micro_sam._get_user_embedding("a")
+    point_labels = np.array([1], dtype=np.float32)
+
+    def pooled_decode(point_coords):
+        predictor, lock = micro_sam._get_predictor(embedding["model_name"])
+        with lock:
+            micro_sam._set_predictor_embedding(predictor, embedding)
+            return predictor.predict(
+                point_coords=point_coords,
+                point_labels=point_labels,
+                multimask_output=False,
+            )
+
+    def rebuilt_decode(point_coords):
+        # Previous behaviour: rebuild a predictor and copy the embedding per click
+        predictor = SamPredictor(micro_sam._load_model(embedding["model_name"]))
+        for key, value in embedding.items():
+            if key != "model_name":
+                setattr(predictor, key, value)
+        return predictor.predict(
+            point_coords=point_coords,
+            point_labels=point_labels,
+            multimask_output=False,
+        )
+
+    timings = {}
+    for name, decode in [("pooled", pooled_decode), ("rebuilt", rebuilt_decode)]:
+        decode(np.array([[128, 128]], dtype=np.float32))  # warm up
+        timings[name] = []
+        for i in range(n_clicks):
+            point_coords = np.array([[128, 64 + i]], dtype=np.float32)
+            start = time.perf_counter()
+            decode(point_coords)
+            timings[name].append(time.perf_counter() - start)
+
+    timings["segment"] = []
+    for i in range(n_clicks):
+        start = time.perf_counter()
+        assert micro_sam.segment([[64 + i, 128]], [1], context=context)
+        timings["segment"].append(time.perf_counter() - start)
+
+    print(
+        f"per-click latency (median of {n_clicks}): "
+        + ", ".join(f"{k} {np.median(v) * 1000:.2f} ms" for k, v in timings.items())
+    )
+    assert len(micro_sam.predictors) == 1
+
+
+def test_loading_a_model_does_not_block_other_models(micro_sam, tiny_sam):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    downloading = threading.Event()
+    finish_download = threading.Event()
+    loads = []
+    load_model = micro_sam._load_model
+
+    def slow_load_model(model_name):
+        loads.append(model_name)
+        if model_name == "vit_b_lm":
+            downloading.set()
+            assert finish_download.wait(5)
+            return tiny_sam
+        return load_model(model_name)
+
+    micro_sam._load_model = slow_load_model
+    with ThreadPoolExecutor(3) as executor:
+        slow = [executor.submit(micro_sam._get_predictor, "vit_b_lm") for _ in range(2)]
+        assert downloading.wait(5)
+        # the cached model is served while the other one is downloading
+        assert executor.submit(micro_sam._get_predictor, "vit_b").result(timeout=1)
+        finish_download.set()
+        assert slow[0].result() is slow[1].result()
+    assert loads == ["vit_b_lm", "vit_b"]
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """Serve files from a temporary directory and count GET requests."""
+    import http.server
+    import threading
+    from functools import partial
+
+    root = tmp_path / "www"
+    root.mkdir()
+    requests_served = []
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            requests_served.append(self.path)
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(Handler, directory=str(root))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", root, requests_served
+    server.shutdown()
+
+
+def test_embedding_settings_are_read_from_the_environment(
+    micro_sam_module, tmp_path, monkeypatch
+):
+    monkeypatch.setenv("MICRO_SAM_EMBEDDING_MEMORY_BUDGET", "1000")
+    monkeypatch.setenv("MICRO_SAM_EMBEDDING_CODEC", "int8")
+    monkeypatch.setenv("MICRO_SAM_WEIGHTS_DIR", str(tmp_path / "weights"))
+    app = micro_sam_module["MicroSAM"](embedding_spill_dir=str(tmp_path / "spill"))
+    assert app.embeddings.max_bytes == 1000
+    assert app.embedding_codec == "int8"
+    assert app.weights.cache_dir == str(tmp_path / "weights")
+    # constructor arguments from the manifest take precedence
+    app = micro_sam_module["MicroSAM"](
+        embedding_codec="float16", embedding_spill_dir=str(tmp_path / "spill")
+    )
+    assert app.embedding_codec == "float16"
+    monkeypatch.setenv("MICRO_SAM_EMBEDDING_CODEC", "bfloat16")
+    with pytest.raises(ValueError, match="Invalid embedding codec"):
+        micro_sam_module["MicroSAM"](embedding_spill_dir=str(tmp_path / "spill"))
+
+
+def test_weight_store_downloads_once(micro_sam_module, http_server, tmp_path):
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    base_url, root, requests_served = http_server
+    content = np.random.bytes(3 * 1024**2 + 17)
+    (root / "vit_b.pt").write_bytes(content)
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    store = micro_sam_module["ModelWeightStore"](
+        str(tmp_path / "weights"), chunk_size=64 * 1024
+    )
+    url = f"{base_url}/vit_b.pt"
+    with ThreadPoolExecutor(4) as executor:
+        paths = list(executor.map(lambda _: store.get("vit_b", url, sha256), range(4)))
+    assert len(set(paths)) == 1
+    assert len(requests_served) == 1
+    with open(paths[0], "rb") as f:
+        assert f.read() == content
+
+    # A second store on the same directory reuses the verified file
+    other_store = micro_sam_module["ModelWeightStore"](str(tmp_path / "weights"))
+    assert other_store.get("vit_b", url, sha256) == paths[0]
+    assert len(requests_served) == 1
+
+
+def test_weight_store_rejects_bad_checksum(micro_sam_module, http_server, tmp_path):
+    base_url, root, _ = http_server
+    (root / "vit_b.pt").write_bytes(b"corrupted")
+    weights_dir = tmp_path / "weights"
+    store = micro_sam_module["ModelWeightStore"](str(weights_dir))
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        store.get("vit_b", f"{base_url}/vit_b.pt", "0" * 64)
+    # Prefixes such as the MD5 prefix in torch hub file names are refused
+    with pytest.raises(ValueError, match="full SHA-256"):
+        store.get("vit_b", f"{base_url}/vit_b.pt", "01ec64")
+    assert not (weights_dir / "vit_b.pt").exists()
+    assert not list(weights_dir.glob("*.part"))
+    with pytest.raises(RuntimeError, match="Failed to download"):
+        store.get("vit_b", f"{base_url}/missing.pt")
+
+
+def test_published_checkpoint_digests(micro_sam_module, tmp_path):
+    app = micro_sam_module["MicroSAM"](weights_dir=str(tmp_path))
+    # SHA-256 of sam_vit_b_01ec64.pth, whose name holds an MD5 prefix
+    assert app.model_checksums["vit_b"] == (
+        "ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912"
+    )
+    for name, sha256 in app.model_checksums.items():
+        assert name in app.model_urls
+        assert len(sha256) == 64 and int(sha256, 16) >= 0
+    # the other checkpoints are verified against their bioimage.io RDF
+    assert set(app.model_checksums) | set(app.model_rdfs) == set(app.model_urls)
+
+
+def test_bioimageio_checkpoint_digests_come_from_the_rdf(
+    micro_sam_module, http_server, tmp_path
+):
+    base_url, root, _ = http_server
+    sha256 = "ab" * 32
+    (root / "rdf.yaml").write_text(
+        "type: model\n"
+        "weights:\n"
+        "  pytorch_state_dict:\n"
+        "    source: https://example.com/weights.pt\n"
+        f"    sha256: {'cd' * 32}\n"
+        "attachments:\n"
+        "  - source: vit_b.pt\n"
+        f"    sha256: {sha256}\n"
+    )
+    app = micro_sam_module["MicroSAM"](weights_dir=str(tmp_path))
+    app.model_rdfs["vit_b_lm"] = f"{base_url}/rdf.yaml"
+    assert app._get_checksum("vit_b_lm") == sha256
+
+    # a checkpoint the RDF does not list is not loaded unverified
+    app.model_urls["vit_b_lm"] = f"{base_url}/other.pt"
+    del app.model_checksums["vit_b_lm"]
+    with pytest.raises(ValueError, match="no SHA-256 for other.pt"):
+        app._get_checksum("vit_b_lm")
+
+
+def test_tiled_segment_stitches_across_tiles(micro_sam, monkeypatch):
+    image = np.random.rand(300, 300)
+    context = user_context("a")
+    assert micro_sam.compute_embedding(
+        "vit_b", image, tiled=True, tile_size=128, tile_overlap=32, context=context
+    )
+    # Tile embeddings are only computed once a tile is prompted
+    assert micro_sam.get_cache_stats()["memory_entries"] == 1
+
+    rows, cols = np.mgrid[:300, :300]
+    disk = (rows - 150) ** 2 + (cols - 150) ** 2 < 60**2
+    monkeypatch.setattr(
+        micro_sam,
+        "_get_tile_embedding",
+        lambda embedding, bounds: {"bounds": bounds},
+    )
+
+    def predict_disk(tile_embedding, point_coordinates, point_labels):
+        (r0, r1), (c0, c1) = tile_embedding["bounds"]
+        r, c = point_coordinates[-1].astype(int)
+        assert disk[r0 + r, c0 + c]
+        return disk[r0:r1, c0:c1]
+
+    monkeypatch.setattr(micro_sam, "_predict_mask", predict_disk)
+    embedding = micro_sam._get_user_embedding("a")
+    mask, (top, left) = micro_sam._segment_tiled(
+        embedding, np.array([[150.0, 150.0]]), np.array([1.0]), max_tiles=9
+    )
+    stitched = np.zeros_like(disk)
+    stitched[top : top + mask.shape[0], left : left + mask.shape[1]] = mask
+    np.testing.assert_array_equal(stitched, disk)
+
+
+def test_tiled_segment_follows_prompts_the_object_does_not_reach(
+    micro_sam, monkeypatch
+):
+    context = user_context("a")
+    assert micro_sam.compute_embedding(
+        "vit_b",
+        np.random.rand(300, 300),
+        tiled=True,
+        tile_size=128,
+        tile_overlap=32,
+        context=context,
+    )
+    rows, cols = np.mgrid[:300, :300]
+    disks = ((rows - 40) ** 2 + (cols - 40) ** 2 < 20**2) | (
+        (rows - 260) ** 2 + (cols - 260) ** 2 < 20**2
+    )
+    monkeypatch.setattr(
+        micro_sam,
+        "_get_tile_embedding",
+        lambda embedding, bounds: {"bounds": bounds},
+    )
+
+    def predict_disks(tile_embedding, point_coordinates, point_labels):
+        (r0, r1), (c0, c1) = tile_embedding["bounds"]
+        return disks[r0:r1, c0:c1]
+
+    monkeypatch.setattr(micro_sam, "_predict_mask", predict_disks)
+    embedding = micro_sam._get_user_embedding("a")
+    points = np.array([[40.0, 40.0], [150.0, 40.0], [260.0, 260.0]])
+    mask, (top, left) = micro_sam._segment_tiled(
+        embedding, points, np.array([1.0, 0.0, 1.0]), max_tiles=9
+    )
+    stitched = np.zeros_like(disks)
+    stitched[top : top + mask.shape[0], left : left + mask.shape[1]] = mask
+    np.testing.assert_array_equal(stitched, disks)
+
+    # prompts beyond the tile budget are named instead of ignored
+    with pytest.raises(ValueError, match=r"\[\[260.0, 260.0\]\] are in tiles beyond"):
+        micro_sam._segment_tiled(
+            embedding, points, np.array([1.0, 0.0, 1.0]), max_tiles=1
+        )
+
+
+def test_tiled_segment_rejects_points_outside_the_image(micro_sam):
+    context = user_context("a")
+    micro_sam.compute_embedding(
+        "vit_b",
+        np.random.rand(300, 200),
+        tiled=True,
+        tile_size=128,
+        tile_overlap=32,
+        context=context,
+    )
+    with pytest.raises(ValueError, match=r"\[\[250.0, 250.0\]\] are outside"):
+        micro_sam.segment([[20, 20], [250, 250]], [1, 0], context=context)
+    with pytest.raises(ValueError, match="outside the image of shape"):
+        micro_sam.segment([[-1, 20]], [1], context=context)
+    with pytest.raises(ValueError, match="at least one point prompt"):
+        micro_sam._segment_tiled(
+            micro_sam._get_user_embedding("a"), np.zeros((0, 2)), np.zeros(0), 9
+        )
+
+
+def test_tiled_features_match_full_image(micro_sam):
+    from kaibu_utils import mask_to_features
+
+    full = np.zeros((300, 200), dtype=bool)
+    full[120:180, 90:150] = True
+    crop = full[100:228, 50:178]
+    assert micro_sam._mask_to_features(crop, (100, 50)) == (mask_to_features(full))
+
+
+def test_tiled_embedding_is_computed_lazily(micro_sam):
+    context = user_context("a")
+    micro_sam.compute_embedding(
+        "vit_b",
+        np.random.rand(300, 300),
+        tiled=True,
+        tile_size=128,
+        tile_overlap=32,
+        context=context,
+    )
+    assert micro_sam.segment([[20, 20]], [1], max_tiles=1, context=context)
+    assert micro_sam.get_cache_stats()["memory_entries"] == 2
+    assert micro_sam.reset_embedding(context=context)
+    assert micro_sam.get_cache_stats()["memory_entries"] == 0
+
+
+def test_segment_batch_matches_single_prompts(micro_sam):
+    context = user_context("a")
+    micro_sam.compute_embedding("vit_b", np.random.rand(128, 128), context=context)
+    points = [[32, 32], [64, 96], [100, 20]]
+    results = micro_sam.segment_batch(
+        [{"point_coordinates": [p], "point_labels": [1]} for p in points],
+        context=context,
+    )
+    assert results == [micro_sam.segment([p], [1], context=context) for p in points]
+
+    results = micro_sam.segment_batch(
+        [
+            {"point_coordinates": [[32, 32], [40, 40]], "point_labels": [1, 0]},
+            {"point_coordinates": [[64, 64]], "point_labels": [1]},
+            {"box": [10, 10, 60, 60]},
+            {
+                "box": [70, 70, 120, 120],
+                "point_coordinates": [[90, 90]],
+                "point_labels": [1],
+            },
+        ],
+        context=context,
+    )
+    assert len(results) == 4
+    with pytest.raises(ValueError):
+        micro_sam.segment_batch([{}], context=context)
+
+
+def test_segment_all_throughput(micro_sam, points_per_side: int = 4):
+    """Benchmark automatic segmentation in decoded masks per second on CPU."""
+    import time
+
+    context = user_context("a")
+    micro_sam.compute_embedding("vit_b", np.random.rand(128, 128), context=context)
+    start = time.perf_counter()
+    labels = micro_sam.segment_all(
+        points_per_side=points_per_side,
+        points_per_batch=16,
+        pred_iou_thresh=-np.inf,
+        stability_score_thresh=0.0,
+        output="labels",
+        context=context,
+    )
+    duration = time.perf_counter() - start
+    print(
+        f"segment_all: {points_per_side**2 * 3 / duration:.1f} masks/s decoded, "
+        f"{labels.max()} objects"
+    )
+    assert labels.shape == (128, 128)
+    assert labels.dtype == np.uint16
+    assert isinstance(micro_sam.segment_all(points_per_side=2, context=context), list)
+
+
+@pytest.mark.parametrize("codec, compression", [("float16", 2), ("int8", 4)])
+def test_embedding_codec_mask_iou(micro_sam, codec, compression):
+    """Compare masks decoded from compressed embeddings with float32 ones."""
+    image = micro_sam._to_image(np.random.rand(128, 128))
+    points = [[[r, c]] for r in (16, 64, 112) for c in (16, 64, 112)]
+    masks = {}
+    for embedding_codec in (None, codec):
+        micro_sam.embedding_codec = embedding_codec
+        embedding = micro_sam._compute_predictor_embedding("vit_b", image)
+        nbytes = micro_sam.embeddings._entry_nbytes(embedding)
+        masks[embedding_codec] = [
+            micro_sam._predict_mask(
+                embedding, np.array(p, np.float32), np.array([1], np.float32)
+            )
+            for p in points
+        ]
+        if embedding_codec is None:
+            float32_nbytes = nbytes
+    assert nbytes <= float32_nbytes / compression * 1.01
+
+    ious = [
+        (a & b).sum() / max((a | b).sum(), 1) for a, b in zip(masks[None], masks[codec])
+    ]
+    print(f"{codec}: mean mask IoU vs float32 {np.mean(ious):.4f}")
+    assert np.mean(ious) > 0.95
+
+
+def test_embedding_jobs(micro_sam):
+    import asyncio
+
+    context = user_context("a")
+    job_id = micro_sam.submit_embedding(
+        "vit_b", np.random.rand(64, 64), context=context
+    )
+    assert micro_sam.get_embedding_job(job_id, context=context)["status"] in (
+        "queued",
+        "running",
+        "completed",
+    )
+    status = asyncio.run(
+        micro_sam.wait_embedding_job(job_id, timeout=60, context=context)
+    )
+    assert status["status"] == "completed"
+    assert status["finished_at"] >= status["started_at"] >= status["submitted_at"]
+    assert micro_sam.segment([[32, 32]], [1], context=context)
+
+    with pytest.raises(ValueError):
+        micro_sam.get_embedding_job(job_id, context=user_context("b"))
+    with pytest.raises(ValueError):
+        micro_sam.submit_embedding("vit_x", np.random.rand(64, 64), context=context)
+    job_id = micro_sam.submit_embedding(
+        "vit_b", np.random.rand(64, 64, 2), context=context
+    )
+    status = asyncio.run(micro_sam.wait_embedding_job(job_id, context=context))
+    assert status["status"] == "failed"
+    assert "Invalid input image" in status["error"]
+
+
+def test_only_finished_embedding_jobs_expire(micro_sam):
+    import asyncio
+
+    context = user_context("a")
+    micro_sam.embedding_job_ttl = 60
+    finished = micro_sam.submit_embedding(
+        "vit_b", np.random.rand(64, 64), context=context
+    )
+    asyncio.run(micro_sam.wait_embedding_job(finished, timeout=60, context=context))
+    micro_sam.jobs[finished]["finished_at"] -= 61
+    # a job that waits for longer than the TTL is still kept
+    queued = micro_sam.submit_embedding(
+        "vit_b", np.random.rand(64, 64), context=context
+    )
+    micro_sam.jobs[queued]["submitted_at"] -= 3600
+
+    job_id = micro_sam.submit_embedding(
+        "vit_b", np.random.rand(64, 64), context=context
+    )
+    assert set(micro_sam.jobs) == {queued, job_id}
+    with pytest.raises(ValueError):
+        micro_sam.get_embedding_job(finished, context=context)
+    status = asyncio.run(
+        micro_sam.wait_embedding_job(queued, timeout=60, context=context)
+    )
+    assert status["status"] == "completed"
+    asyncio.run(micro_sam.wait_embedding_job(job_id, timeout=60, context=context))
+
+
+def test_chunked_image_reference_reads_prompted_tile(micro_sam, tmp_path, monkeypatch):
+    zarr = pytest.importorskip("zarr")
+
+    image = (np.random.rand(300, 300, 3) * 255).astype("uint8")
+    zarr.save_array(str(tmp_path / "image.zarr"), image, chunks=(64, 64, 3))
+    reads = []
+    read_chunk = zarr.storage.DirectoryStore.__getitem__
+    monkeypatch.setattr(
+        zarr.storage.DirectoryStore,
+        "__getitem__",
+        lambda store, key: reads.append(key) or read_chunk(store, key),
+    )
+
+    context = user_context("a")
+    reference = {"uri": str(tmp_path / "image.zarr")}
+    assert micro_sam.compute_embedding(
+        "vit_b", reference, tiled=True, tile_size=128, tile_overlap=32, context=context
+    )
+    assert not [key for key in reads if key != ".zarray"]
+    features = micro_sam.segment([[20, 20]], [1], max_tiles=1, context=context)
+    # the first 128 x 128 tile covers 2 x 2 chunks
+    assert sorted(key for key in reads if key != ".zarray") == [
+        "0.0.0",
+        "0.1.0",
+        "1.0.0",
+        "1.1.0",
+    ]
+
+    # the same tile from an in-memory image gives the same mask
+    context = user_context("b")
+    micro_sam.compute_embedding(
+        "vit_b", image, tiled=True, tile_size=128, tile_overlap=32, context=context
+    )
+    assert micro_sam.segment([[20, 20]], [1], max_tiles=1, context=context) == features
+
+
+def test_chunked_tiles_share_one_intensity_range(micro_sam, tmp_path, monkeypatch):
+    zarr = pytest.importorskip("zarr")
+
+    # a dark left and a bright right half, which per-tile scaling would equalize
+    image = np.zeros((256, 256), dtype=np.uint16)
+    image[:, :128] = np.linspace(0, 1000, 128, dtype=np.uint16)
+    image[:, 128:] = np.linspace(30000, 40000, 128, dtype=np.uint16)
+    zarr.save_array(str(tmp_path / "image.zarr"), image, chunks=(64, 64))
+    tiles = []
+    compute = micro_sam._compute_predictor_embedding
+    monkeypatch.setattr(
+        micro_sam,
+        "_compute_predictor_embedding",
+        lambda model_name, tile: tiles.append(tile) or compute(model_name, tile),
+    )
+
+    context = user_context("a")
+    reference = {"uri": str(tmp_path / "image.zarr")}
+    assert micro_sam.compute_embedding(
+        "vit_b", reference, tiled=True, tile_size=128, tile_overlap=0, context=context
+    )
+    micro_sam.segment([[64, 64]], [1], max_tiles=1, context=context)
+    micro_sam.segment([[64, 192]], [1], max_tiles=1, context=context)
+    left, right = tiles
+    assert left.dtype == right.dtype == np.uint8
+    # both tiles are scaled by the range of the whole image
+    assert left.max() <= 255 * 1000 / 40000 + 1
+    assert right.min() >= 255 * 30000 / 40000 - 1 and right.max() == 255
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ray")
+
+from hypha_rpc.utils import ObjectProxy
+
+from bioimageio.engine.ray_app_loader import add_warmup
+
+
+class ColdApp:
+    """App whose model is loaded lazily, like the Ray apps."""
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.models = {}
+        self.calls = []
+
+    def _load_model(self, name):
+        return self.models.setdefault(name, f"model:{name}")
+
+    def embed(self, image, context=None):
+        self._load_model("base")
+        self.calls.append(("embed", image.shape, image.dtype, context))
+        return image.mean() * self.scale
+
+    async def segment(self, points, context=None):
+        self.calls.append(("segment", points, context))
+        return True
+
+
+def _app_info(warmup, require_context=True):
+    return ObjectProxy.fromDict(
+        {
+            "id": "cold_app",
+            "service_config": {"require_context": require_context},
+            "warmup": warmup,
+        }
+    )
+
+
+def test_warmup_runs_in_constructor():
+    app_info = _app_info(
+        {
+            "models": ["base", "large"],
+            "calls": [
+                {"method": "embed", "kwargs": {"image": {"random": [64, 32, 3]}}},
+                {"method": "segment", "kwargs": {"points": [[1, 2]]}},
+            ],
+        }
+    )
+    app_info.app_class = ColdApp
+    warm_class = add_warmup(app_info)
+    assert warm_class.__name__ == "ColdApp"
+    assert [m for m in dir(warm_class) if not m.startswith("_")] == ["embed", "segment"]
+
+    app = warm_class(scale=2)
+    assert app.scale == 2
+    assert set(app.models) == {"base", "large"}
+    context = {"user": {"id": "warmup"}}
+    assert app.calls == [
+        ("embed", (64, 32, 3), np.dtype("uint8"), context),
+        ("segment", [[1, 2]], context),
+    ]
+    stats = app._startup_stats
+    assert stats["startup_seconds"] >= stats["init_seconds"] + stats["warmup_seconds"] - 1e-6
+    # the subclass is shipped to the replicas by value
+    import cloudpickle
+
+    assert cloudpickle.loads(cloudpickle.dumps(warm_class))().calls
+
+
+def test_warmup_without_context():
+    app_info = _app_info(
+        {"calls": [{"method": "embed", "kwargs": {"image": {"random": [8, 8], "dtype": "float32"}}}]},
+        require_context=False,
+    )
+    app_info.app_class = ColdApp
+    app = add_warmup(app_info)()
+    assert app.calls == [("embed", (8, 8), np.dtype("float32"), None)]
+
+
+def test_generator_methods_are_detected():
+    from bioimageio.engine.ray_app_loader import ray_apps
+
+    assert ray_apps["translator"].streaming_methods == ["translate_stream"]
+    assert ray_apps["cellpose"].streaming_methods == ["predict_stream", "watch_training_job"]
+
+
+def test_apps_do_not_overwrite_each_others_definitions():
+    import inspect
+
+    from conftest import load_ray_app
+
+    from bioimageio.engine import ray_app_loader
+
+    defined_by = {}
+    for app_id in ["cellpose", "micro_sam", "translator", "cellpose"]:
+        before = dict(vars(ray_app_loader))
+        for name, value in load_ray_app(app_id).items():
+            if (inspect.isclass(value) or inspect.isfunction(value)) and before.get(name) is not value:
+                owner = defined_by.setdefault(name, app_id)
+                assert owner == app_id, f"{app_id} overwrites {name} of {owner}"
+
+
+def test_init_kwargs_are_passed_to_every_shard():
+    from bioimageio.engine.ray_app_loader import create_session_shards
+
+    app_info = _app_info({})
+    app_info.app_class = ColdApp
+    app_info.init_kwargs = {"scale": 3}
+    shards = create_session_shards(app_info, {"num_replicas": 2})
+    assert [shard._bound_deployment.init_kwargs for shard in shards] == [{"scale": 3}] * 2
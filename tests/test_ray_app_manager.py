@@ -0,0 +1,936 @@
+import asyncio
+import inspect
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pytest.importorskip("ray")
+
+from hypha_rpc.utils import ObjectProxy
+
+from bioimageio.engine.ray_app_admission import (
+    PRIORITIES,
+    AdmissionController,
+    AdmissionRejected,
+)
+from bioimageio.engine.ray_app_cache import ResultCache
+from bioimageio.engine.ray_app_manager import HyphaRayAppManager
+from bioimageio.engine.ray_app_metrics import RequestMetrics
+
+
+class LocalAppManager(HyphaRayAppManager.func_or_class):
+    """App manager that creates service functions without a Hypha server."""
+
+    def _start_connection(self, workspace, token):
+        pass
+
+
+class LocalHandle:
+    """Stand-in for a deployment handle calling a local app instance."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def options(self, stream=False):
+        if not stream:
+            return self
+        self.stream_handle = LocalStreamHandle(self.app)
+        return self.stream_handle
+
+    def __getattr__(self, method_name):
+        method = getattr(self.app, method_name)
+
+        class Method:
+            async def remote(self, *args, **kwargs):
+                await asyncio.sleep(0)
+                result = method(*args, **kwargs)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                return result
+
+        return Method()
+
+
+class LocalStreamHandle:
+    """Stand-in for a deployment handle with `stream=True`."""
+
+    def __init__(self, app):
+        self.app = app
+        self.cancelled = []
+
+    def __getattr__(self, method_name):
+        method = getattr(self.app, method_name)
+        cancelled = self.cancelled
+
+        class Response:
+            def __init__(self, generator):
+                self.generator = generator
+
+            async def __aiter__(self):
+                if inspect.isasyncgen(self.generator):
+                    async for chunk in self.generator:
+                        yield chunk
+                else:
+                    for chunk in self.generator:
+                        await asyncio.sleep(0)
+                        yield chunk
+
+            def cancel(self):
+                cancelled.append(method_name)
+
+        class Method:
+            def remote(self, *args, **kwargs):
+                return Response(method(*args, **kwargs))
+
+        return Method()
+
+
+class SessionStore:
+    """Stand-in for an app that keeps per-user state in the replica."""
+
+    def __init__(self, replica_id):
+        self.replica_id = replica_id
+        self.values = {}
+
+    def put(self, value, context: dict = None):
+        self.values[context["user"]["id"]] = value
+        return self.replica_id
+
+    def get(self, context: dict = None):
+        return self.replica_id, self.values.get(context["user"]["id"])
+
+
+def create_manager(apps: dict) -> LocalAppManager:
+    for app_id, app_info in apps.items():
+        app_info.setdefault("name", app_id)
+        app_info.setdefault("description", "")
+    return LocalAppManager("http://localhost", "workspace", None, apps)
+
+
+def test_session_affinity_across_replicas():
+    replicas = [SessionStore(i) for i in range(2)]
+    manager = create_manager(
+        {
+            "session_store": {
+                "session_shards": [LocalHandle(r) for r in replicas],
+                "methods": ["get", "put"],
+            }
+        }
+    )
+    services = manager._services["session_store"]
+
+    async def run_user(user_id):
+        context = {"user": {"id": user_id}}
+        replica_id = await services["put"](user_id, context=context)
+        for _ in range(5):
+            assert await services["get"](context=context) == (replica_id, user_id)
+        return replica_id
+
+    async def run_users():
+        return await asyncio.gather(*[run_user(f"user{i}") for i in range(20)])
+
+    replica_ids = asyncio.run(run_users())
+    assert set(replica_ids) == {0, 1}
+
+
+def test_session_shards_move_few_users():
+    def assign(n_shards):
+        manager = create_manager(
+            {
+                "app": {
+                    "session_shards": list(range(n_shards)),
+                    "methods": [],
+                }
+            }
+        )
+        return [
+            manager._get_deployment("app", {"context": {"user": {"id": f"u{i}"}}})[1]
+            for i in range(300)
+        ]
+
+    before, after = assign(2), assign(3)
+    moved = sum(a != b for a, b in zip(before, after))
+    # Only users assigned to the new shard move
+    assert all(b == 2 for a, b in zip(before, after) if a != b)
+    assert moved < 150
+
+
+class FakeHyphaServer:
+    """Stand-in for an async Hypha connection that can be dropped."""
+
+    def __init__(self, registrations):
+        self.registrations = registrations
+        self.alive = True
+        self.registering = 0
+        self.max_registering = 0
+
+    async def register_service(self, service, config):
+        self.registering += 1
+        self.max_registering = max(self.max_registering, self.registering)
+        await asyncio.sleep(0.05)
+        self.registering -= 1
+        self.registrations.append(service["id"])
+        return ObjectProxy(id=f"workspace/client:{service['id']}")
+
+    async def echo(self, data):
+        if not self.alive:
+            raise ConnectionError("connection closed")
+        return data
+
+    async def disconnect(self):
+        self.alive = False
+
+
+def test_services_register_concurrently_and_reconnect():
+    apps = {
+        f"app{i}": {"session_shards": [None], "methods": ["predict"]} for i in range(4)
+    }
+    servers, registrations, attempts = [], [], []
+
+    class ConnectingManager(LocalAppManager):
+        _start_connection = HyphaRayAppManager.func_or_class._start_connection
+
+        async def _connect(self, workspace, token):
+            attempts.append(time.monotonic())
+            if len(attempts) in (2, 3):
+                raise ConnectionError("server unavailable")
+            servers.append(FakeHyphaServer(registrations))
+            return servers[-1]
+
+    async def run():
+        for app_info in apps.values():
+            app_info.update(name="App", description="")
+        manager = ConnectingManager(
+            "http://localhost",
+            "workspace",
+            None,
+            apps,
+            check_interval=0.02,
+            reconnect_delay=0.05,
+        )
+        while not manager.connection_stats["connected"]:
+            await asyncio.sleep(0.01)
+        first = manager.connection_stats["register_seconds"]
+        # all five services were registered at once
+        assert servers[0].max_registering == 5
+        assert first < 0.2
+
+        servers[0].alive = False
+        while manager.connection_stats["connects"] < 2:
+            await asyncio.sleep(0.01)
+        manager._connection_task.cancel()
+        return manager
+
+    manager = asyncio.run(run())
+    assert len(servers) == 2 and len(attempts) == 4
+    assert sorted(registrations) == sorted(2 * (list(apps) + ["ray-apps"]))
+    assert manager.connection_stats["failures"] == 3
+    # the retries back off exponentially, with up to half of the delay as jitter
+    gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+    assert gaps[1] >= 0.05 and gaps[2] >= 0.1
+
+
+class SimulatedCluster:
+    """Stand-in for a Ray cluster with a fixed number of GPUs."""
+
+    def __init__(self, total_gpus, app_gpus):
+        self.total_gpus = total_gpus
+        self.app_gpus = app_gpus
+        self.running = set()
+        self.evicted = set()
+        self.status_calls = 0
+
+    def free_gpus(self):
+        return self.total_gpus - sum(self.app_gpus[app] for app in self.running)
+
+    def running_deployments(self):
+        self.status_calls += 1
+        return set(self.running)
+
+    def scale_down(self, app_id):
+        self.running.discard(app_id)
+        self.evicted.add(app_id)
+
+    def cancel_scale_down(self, app_id):
+        self.evicted.discard(app_id)
+
+    def place(self, app_id):
+        # Serve starts a replica for the first request if the GPUs allow it
+        if app_id not in self.running:
+            if self.free_gpus() < self.app_gpus[app_id]:
+                raise RuntimeError(f"cannot place {app_id}")
+            self.running.add(app_id)
+
+
+class GPUApp:
+    def __init__(self, cluster, app_id):
+        self.cluster = cluster
+        self.app_id = app_id
+
+    async def run(self, duration=0, context=None):
+        self.cluster.place(self.app_id)
+        await asyncio.sleep(duration)
+        return self.app_id
+
+
+def create_gpu_manager(total_gpus, app_gpus):
+    cluster = SimulatedCluster(total_gpus, app_gpus)
+
+    class GPUAppManager(LocalAppManager):
+        def _create_cluster(self):
+            return cluster
+
+    apps = {
+        app_id: {
+            "name": app_id,
+            "description": "",
+            "methods": ["run"],
+            "app_bind": LocalHandle(GPUApp(cluster, app_id)),
+            "ray_serve_config": {"ray_actor_options": {"num_gpus": gpus}},
+        }
+        for app_id, gpus in app_gpus.items()
+    }
+    manager = GPUAppManager("http://localhost", "workspace", None, apps)
+    return manager, cluster
+
+
+def test_least_recently_used_idle_app_is_evicted():
+    manager, cluster = create_gpu_manager(2, {"a": 1, "b": 1, "c": 1, "cpu": 0})
+
+    async def run():
+        services = manager._services
+        await services["a"]["run"]()
+        await services["b"]["run"]()
+        await services["a"]["run"]()  # "b" is now the least recently used
+        assert cluster.running == {"a", "b"}
+        await services["c"]["run"]()
+        assert cluster.running == {"a", "c"}
+        await services["cpu"]["run"]()
+        assert cluster.running == {"a", "c", "cpu"}
+
+        # apps with requests in flight are never evicted
+        slow = asyncio.ensure_future(services["a"]["run"](0.2))
+        await asyncio.sleep(0.05)
+        await services["b"]["run"]()
+        assert cluster.running == {"a", "b", "cpu"}
+        await slow
+
+    asyncio.run(run())
+    decisions = [(d["action"], d["app"]) for d in manager._scheduler.decisions]
+    assert decisions == [
+        ("scale up", "a"),
+        ("scale up", "b"),
+        ("scale down", "b"),
+        ("scale up", "c"),
+        ("scale down", "c"),
+        ("scale up", "b"),
+    ]
+    assert "least recently used" in manager._scheduler.decisions[2]["reason"]
+    assert manager._scheduler.in_flight == {"a": 0, "b": 0, "c": 0, "cpu": 0}
+
+
+def test_eviction_makes_room_for_the_users_shard():
+    cluster = SimulatedCluster(2, {"sam_0": 1, "sam_1": 1, "other": 1})
+
+    class ShardedManager(LocalAppManager):
+        def _create_cluster(self):
+            return cluster
+
+    gpu_config = {"ray_actor_options": {"num_gpus": 1}}
+    apps = {
+        "sam": {
+            "name": "sam",
+            "description": "",
+            "methods": ["run"],
+            "session_shards": [
+                LocalHandle(GPUApp(cluster, f"sam_{i}")) for i in range(2)
+            ],
+            "ray_serve_config": gpu_config,
+        },
+        "other": {
+            "name": "other",
+            "description": "",
+            "methods": ["run"],
+            "app_bind": LocalHandle(GPUApp(cluster, "other")),
+            "ray_serve_config": gpu_config,
+        },
+    }
+    manager = ShardedManager("http://localhost", "workspace", None, apps)
+    contexts = {}
+    for i in range(20):
+        context = {"user": {"id": f"user{i}"}}
+        shard, _ = manager._get_deployment("sam", {"context": context})
+        contexts.setdefault(shard, context)
+
+    async def run():
+        await manager._services["sam"]["run"](context=contexts["sam_0"])
+        await manager._services["other"]["run"]()
+        # the app has a running shard, but not the one this user is pinned to
+        await manager._services["sam"]["run"](context=contexts["sam_1"])
+
+    asyncio.run(run())
+    assert cluster.running == {"sam_1", "other"}
+    assert cluster.evicted == {"sam_0"}
+
+
+def test_running_deployments_are_not_queried_per_request():
+    manager, cluster = create_gpu_manager(2, {"a": 1, "b": 1})
+
+    async def run():
+        await manager._services["a"]["run"]()
+        await asyncio.gather(*[manager._services["a"]["run"]() for _ in range(20)])
+
+    asyncio.run(run())
+    assert cluster.status_calls == 1
+
+
+def test_eviction_policy_scales_flagged_deployments_to_zero(monkeypatch):
+    import ray.experimental.internal_kv as internal_kv
+    import ray.serve.autoscaling_policy as autoscaling_policy
+    from bioimageio.engine.ray_app_scheduler import (
+        eviction_autoscaling_policy,
+        eviction_key,
+    )
+
+    flags = {eviction_key("app", "sam_0"): b"1"}
+    monkeypatch.setattr(internal_kv, "_internal_kv_get", flags.get)
+    monkeypatch.setattr(
+        autoscaling_policy,
+        "replica_queue_length_autoscaling_policy",
+        lambda ctx: (1, ctx.policy_state),
+    )
+
+    class Context:
+        app_name = "app"
+        policy_state = {}
+
+        def __init__(self, deployment_name, total_num_requests):
+            self.deployment_name = deployment_name
+            self.total_num_requests = total_num_requests
+
+    assert eviction_autoscaling_policy(Context("sam_0", 0))[0] == 0
+    # requests that arrive for an evicted deployment are still served
+    assert eviction_autoscaling_policy(Context("sam_0", 3))[0] == 1
+    assert eviction_autoscaling_policy(Context("sam_1", 0))[0] == 1
+
+
+def test_busy_cluster_waits_instead_of_evicting():
+    manager, cluster = create_gpu_manager(1, {"a": 1, "b": 1})
+
+    async def run():
+        services = manager._services
+        slow = asyncio.ensure_future(services["a"]["run"](0.1))
+        await asyncio.sleep(0.02)
+        with pytest.raises(RuntimeError, match="cannot place b"):
+            await services["b"]["run"]()
+        await slow
+
+    asyncio.run(run())
+    last = manager._scheduler.decisions[-1]
+    assert (last["action"], last["app"]) == ("wait", "b")
+    assert "no idle app to evict" in last["reason"]
+    assert cluster.running == {"a"}
+
+
+class Echo:
+    def echo(self, data, delay=0):
+        time.sleep(delay)
+        return data
+
+    def fail(self):
+        raise ValueError("failed")
+
+
+def test_request_metrics_are_served_for_prometheus():
+    from starlette.requests import Request
+
+    manager = create_manager(
+        {"echo": {"app_bind": LocalHandle(Echo()), "methods": ["echo", "fail"]}}
+    )
+    services = manager._services["echo"]
+
+    async def run():
+        for _ in range(10):
+            await services["echo"](np.zeros(100, dtype="uint8"))
+        await services["echo"](b"x" * 50, delay=0.2)
+        with pytest.raises(ValueError):
+            await services["fail"]()
+        request = Request(
+            {"type": "http", "method": "GET", "path": "/metrics", "headers": []}
+        )
+        return await manager(request)
+
+    response = asyncio.run(run())
+    assert response.media_type.startswith("text/plain")
+    text = response.body.decode()
+    assert 'bioengine_requests_total{app="echo",method="echo"} 11' in text
+    assert 'bioengine_request_errors_total{app="echo",method="fail"} 1' in text
+    assert 'bioengine_requests_in_flight{app="echo",method="echo"} 0' in text
+    assert 'bioengine_request_bytes_total{app="echo",method="echo"} 1050' in text
+    assert 'bioengine_response_bytes_total{app="echo",method="echo"} 1050' in text
+    assert (
+        'bioengine_request_duration_seconds_bucket{app="echo",method="echo",le="+Inf"} 11'
+        in text
+    )
+    assert "# TYPE bioengine_request_latency_seconds summary" in text
+    assert "\nbioengine_hypha_connected 0\n" in text
+
+    quantiles = manager.metrics.quantiles("echo", "echo")
+    assert quantiles[0.5] < 0.1
+    assert quantiles[0.99] >= 0.2
+
+
+class BulkApp:
+    def __init__(self):
+        self.started = []
+
+    async def embed(self, name, duration=0.1):
+        self.started.append(name)
+        await asyncio.sleep(duration)
+        return name
+
+    async def info(self):
+        self.started.append("info")
+        return "info"
+
+    async def segment(self):
+        return "segment"
+
+
+def test_admission_control_bounds_queues_and_prioritizes():
+    app = BulkApp()
+    manager = create_manager(
+        {
+            "bulk": {
+                "app_bind": LocalHandle(app),
+                "methods": ["embed", "info", "segment"],
+                "admission": {
+                    "max_concurrency": 2,
+                    "max_queue": 4,
+                    "methods": {
+                        "embed": {"max_queue": 2, "priority": "bulk"},
+                        "segment": {"priority": "interactive"},
+                    },
+                },
+            }
+        }
+    )
+    services = manager._services["bulk"]
+
+    async def run():
+        embeds = [
+            asyncio.ensure_future(services["embed"](f"e{i}")) for i in range(4)
+        ]
+        await asyncio.sleep(0.01)
+        assert app.started == ["e0", "e1"]
+
+        # the bulk queue is full, so the next call fails fast
+        start = time.monotonic()
+        with pytest.raises(AdmissionRejected, match="retry after") as excinfo:
+            await services["embed"]("e4")
+        assert time.monotonic() - start < 0.05
+        assert excinfo.value.retry_after >= 1.0
+
+        # interactive calls bypass the busy app
+        start = time.monotonic()
+        assert await services["segment"]() == "segment"
+        assert time.monotonic() - start < 0.05
+
+        # normal calls are queued ahead of bulk calls
+        info = asyncio.ensure_future(services["info"]())
+        assert await asyncio.gather(*embeds, info) == ["e0", "e1", "e2", "e3", "info"]
+
+    asyncio.run(run())
+    assert app.started.index("info") == 2
+    text = manager.render_metrics()
+    assert 'bioengine_requests_rejected_total{app="bulk",method="embed"} 1' in text
+    assert 'bioengine_requests_total{app="bulk",method="embed"} 4' in text
+    assert 'bioengine_requests_queued{app="bulk",method="embed"} 0' in text
+
+
+def test_cellpose_tiles_are_bounded_bulk_calls():
+    import yaml
+
+    from bioimageio.engine import ray_app_loader
+
+    manifest = Path(ray_app_loader.__file__).parent / "ray_apps/cellpose/manifest.yaml"
+    admission = AdmissionController(
+        "cellpose", yaml.safe_load(manifest.read_text())["admission"]
+    )
+    limits = admission._limits("predict_tile")
+    assert admission.app_limit in limits
+    assert all(limit.max_concurrency for limit in limits)
+    assert admission.priorities["predict_tile"] == PRIORITIES["bulk"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController("app", {"max_concurrency": 1, "max_queue": 1})
+
+    async def run():
+        await controller.acquire("run")
+        waiter = asyncio.ensure_future(controller.acquire("run"))
+        await asyncio.sleep(0)
+        assert controller.queued("run") == 1
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert controller.queued("run") == 0
+        controller.release("run")
+        await asyncio.wait_for(controller.acquire("run"), 1)
+
+    asyncio.run(run())
+    assert controller.app_limit.active == 1
+    assert controller.app_limit.queued == 0
+
+
+class GPUStub:
+    """Stand-in for a deployment that serves one call at a time."""
+
+    def __init__(self):
+        self.served = []
+
+    async def run(self, duration=0.01, context: dict = None):
+        self.served.append(context["user"]["id"])
+        await asyncio.sleep(duration)
+
+
+def create_fair_manager(admission):
+    app = GPUStub()
+    manager = create_manager(
+        {
+            "gpu": {
+                "app_bind": LocalHandle(app),
+                "methods": ["run"],
+                "admission": {"max_concurrency": 1, "max_queue": 100, **admission},
+            }
+        }
+    )
+    return manager, app
+
+
+def user_call(manager, user_id):
+    run = manager._services["gpu"]["run"]
+    return asyncio.ensure_future(run(context={"user": {"id": user_id}}))
+
+
+def test_fair_queueing_between_competing_users():
+    manager, app = create_fair_manager({"user_weights": {"vip": 2}})
+
+    async def run():
+        calls = [user_call(manager, "script") for _ in range(20)]
+        await asyncio.sleep(0.015)
+        calls += [user_call(manager, "alice") for _ in range(3)]
+        await asyncio.sleep(0)
+        queued, position = manager._admission["gpu"].user_queues()["alice"]
+        assert queued == 3 and position <= 1
+        text = manager.render_metrics()
+        assert 'bioengine_user_requests_queued{app="gpu",user="alice"} 3' in text
+        assert 'bioengine_user_queue_position{app="gpu",user="alice"}' in text
+        await asyncio.gather(*calls)
+        first_round = list(app.served)
+
+        # a user with twice the weight gets twice the share
+        app.served.clear()
+        blocker = user_call(manager, "blocker")
+        await asyncio.sleep(0)
+        calls = [user_call(manager, user) for user in ["other", "vip"] * 6]
+        await asyncio.gather(blocker, *calls)
+        return first_round, app.served[1:10]
+
+    first_round, second_round = asyncio.run(run())
+    # alice does not wait behind the whole backlog of the script
+    assert max(i for i, user in enumerate(first_round) if user == "alice") < 8
+    assert second_round.count("vip") == 6
+    assert "bioengine_user_requests_queued" not in manager.render_metrics()
+
+
+def test_rate_limit_per_user():
+    manager, app = create_fair_manager({"rate_limit": {"rate": 10, "burst": 3}})
+
+    async def run():
+        for _ in range(3):
+            await user_call(manager, "script")
+        with pytest.raises(AdmissionRejected, match="rate limit") as excinfo:
+            await user_call(manager, "script")
+        assert 0 < excinfo.value.retry_after <= 0.1
+        # other users have their own budget
+        await user_call(manager, "alice")
+        await asyncio.sleep(excinfo.value.retry_after)
+        await user_call(manager, "script")
+
+    asyncio.run(run())
+    assert app.served == ["script"] * 3 + ["alice", "script"]
+    text = manager.render_metrics()
+    assert "# TYPE bioengine_requests_throttled_total counter" in text
+    assert 'bioengine_requests_throttled_total{app="gpu"} 1' in text
+
+
+def test_metric_label_values_are_escaped():
+    metrics = RequestMetrics()
+    metrics.set_gauge("bioengine_user_queue_position", 1, app="gpu", user='a"b\\c\nd')
+    assert (
+        'bioengine_user_queue_position{app="gpu",user="a\\"b\\\\c\\nd"} 1'
+        in metrics.render()
+    )
+
+
+def test_user_who_ran_alone_is_not_starved_later():
+    admission = AdmissionController("gpu", {"max_concurrency": 1})
+    served = []
+
+    async def call(user_id):
+        await admission.acquire("run", user_id)
+        served.append(user_id)
+        admission.release("run")
+
+    async def run():
+        for _ in range(50):
+            await call("solo")
+        await admission.acquire("run", "blocker")
+        calls = [asyncio.ensure_future(call(u)) for u in ["solo", "newcomer"] * 3]
+        await asyncio.sleep(0)
+        assert admission._last_tags
+        admission.release("run")
+        await asyncio.gather(*calls)
+
+    asyncio.run(run())
+    assert served[50:] == ["solo", "newcomer"] * 3
+    assert admission._last_tags == {}
+
+
+def test_idle_users_rate_limit_buckets_are_dropped():
+    admission = AdmissionController(
+        "gpu", {"rate_limit": {"rate": 100, "burst": 1}}, prune_interval=0
+    )
+
+    async def run():
+        for user_id in range(10):
+            await admission.acquire("run", user_id)
+            admission.release("run")
+        await asyncio.sleep(0.02)
+        await admission.acquire("run", "alice")
+        admission.release("run")
+
+    asyncio.run(run())
+    assert list(admission._buckets) == ["alice"]
+
+
+class Deterministic:
+    def __init__(self):
+        self.calls = 0
+
+    async def translate(self, text, context: dict = None):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return text.upper()
+
+    async def predict(self, image, diameter=30):
+        self.calls += 1
+        return image * 2
+
+    async def random(self):
+        self.calls += 1
+        return self.calls
+
+
+def create_cached_manager(result_cache):
+    app = Deterministic()
+    manager = create_manager(
+        {
+            "det": {
+                "app_bind": LocalHandle(app),
+                "methods": ["predict", "random", "translate"],
+                "result_cache": result_cache,
+            }
+        }
+    )
+    return manager, app
+
+
+def test_result_cache_reuses_identical_calls():
+    manager, app = create_cached_manager(
+        {"max_bytes": 1000, "methods": {"translate": {"ttl": 0.2}, "predict": None}}
+    )
+    services = manager._services["det"]
+
+    async def run():
+        # concurrent identical calls of different users run once
+        results = await asyncio.gather(
+            *[
+                services["translate"]("hello", context={"user": {"id": f"u{i}"}})
+                for i in range(5)
+            ]
+        )
+        assert results == ["HELLO"] * 5 and app.calls == 1
+        assert await services["translate"]("hello") == "HELLO"
+        assert await services["translate"]("world") == "WORLD"
+        assert app.calls == 2
+
+        image = np.arange(100, dtype="uint8")
+        first = await services["predict"](image, diameter=30)
+        second = await services["predict"](image.copy(), diameter=30)
+        np.testing.assert_array_equal(first, second)
+        assert app.calls == 3
+        await services["predict"](image, diameter=20)
+        assert app.calls == 4
+
+        # a large result evicts the oldest entries
+        await services["predict"](np.zeros(500, dtype="uint8"))
+        await services["predict"](image, diameter=30)
+        assert app.calls == 6
+
+        # methods that are not declared are never cached
+        assert await services["random"]() != await services["random"]()
+
+        # results expire after their TTL
+        await asyncio.sleep(0.25)
+        await services["translate"]("hello")
+        assert app.calls == 9
+
+    asyncio.run(run())
+    stats = manager._result_caches["det"].stats
+    assert stats["translate"]["hits"] == 1
+    assert stats["translate"]["misses"] == 3
+    assert stats["translate"]["coalesced"] == 4
+    assert stats["predict"]["evictions"] == 2
+    text = manager.render_metrics()
+    assert 'bioengine_result_cache_hits_total{app="det",method="translate"} 1' in text
+    assert 'bioengine_result_cache_misses_total{app="det",method="predict"} 4' in text
+
+
+def test_result_cache_sizes_nested_results_by_their_pickled_length():
+    cache = ResultCache(max_bytes=10_000)
+
+    async def segment(n):
+        return [[[float(i), float(i)] for i in range(n)]]
+
+    async def run():
+        for n in range(10):
+            await cache.call("segment", segment, (100 + n,), {})
+
+    asyncio.run(run())
+    assert 0 < cache.nbytes <= cache.max_bytes
+    assert cache.stats["segment"]["evictions"] > 0
+
+
+def test_result_cache_waiters_survive_a_cancelled_first_caller():
+    cache = ResultCache(max_bytes=10_000)
+    calls = []
+
+    async def segment(n):
+        calls.append(n)
+        await asyncio.sleep(0.05)
+        return n * 2
+
+    async def run():
+        first = asyncio.ensure_future(cache.call("segment", segment, (1,), {}))
+        await asyncio.sleep(0.01)
+        second = asyncio.ensure_future(cache.call("segment", segment, (1,), {}))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 2
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await cache.call("segment", segment, (1,), {}) == 2
+
+    asyncio.run(run())
+    assert calls == [1]
+    assert cache.stats["segment"]["coalesced"] == 1
+    assert cache.stats["segment"]["hits"] == 1
+
+
+def test_result_cache_storage_survives_restart():
+    config = {
+        "storage": "memory://result-cache-test",
+        "methods": {"translate": {}},
+    }
+    manager, app = create_cached_manager(config)
+    asyncio.run(manager._services["det"]["translate"]("hello"))
+    restarted, app = create_cached_manager(config)
+    assert asyncio.run(restarted._services["det"]["translate"]("hello")) == "HELLO"
+    assert app.calls == 0
+    assert restarted._result_caches["det"].stats["translate"]["hits"] == 1
+
+
+class Streamer:
+    def count(self, n):
+        for i in range(n):
+            yield i
+
+    async def tokens(self, text, delay=0.05):
+        for token in text.split():
+            yield token
+            await asyncio.sleep(delay)
+
+
+def test_generator_methods_are_streamed():
+    handle = LocalHandle(Streamer())
+    manager = create_manager(
+        {
+            "stream": {
+                "app_bind": handle,
+                "methods": ["count", "tokens"],
+                "streaming_methods": ["count", "tokens"],
+                "admission": {"max_concurrency": 1},
+            }
+        }
+    )
+    services = manager._services["stream"]
+
+    async def run():
+        assert inspect.isasyncgenfunction(services["count"])
+        assert [i async for i in services["count"](5)] == [0, 1, 2, 3, 4]
+
+        # the first token arrives before the method has finished
+        start = time.monotonic()
+        stream = services["tokens"]("a b c d")
+        assert await stream.__anext__() == "a"
+        assert time.monotonic() - start < 0.05
+        # a consumer that stops early cancels the replica's stream
+        await stream.aclose()
+        assert handle.stream_handle.cancelled == ["tokens"]
+        # and releases its admission slot
+        assert await asyncio.wait_for(services["count"](2).__anext__(), 1) == 0
+
+        # a running stream holds its slot until it ends
+        admission = manager._admission["stream"]
+        stream = services["tokens"]("a b c d", delay=10)
+        assert await stream.__anext__() == "a"
+        assert admission.app_limit.active == 1
+        assert manager._scheduler.in_flight["stream"] == 1
+        await stream.aclose()
+        assert admission.app_limit.active == 0
+
+    asyncio.run(run())
+    text = manager.render_metrics()
+    assert 'bioengine_stream_chunks_total{app="stream",method="count"} 6' in text
+    assert 'bioengine_stream_first_chunk_seconds_count{app="stream",method="tokens"} 2' in text
+    assert 'bioengine_requests_total{app="stream",method="tokens"} 2' in text
+
+
+def test_streams_can_release_their_slot_after_the_first_chunk():
+    manager = create_manager(
+        {
+            "stream": {
+                "app_bind": LocalHandle(Streamer()),
+                "methods": ["count", "tokens"],
+                "streaming_methods": ["count", "tokens"],
+                "release_after_first_chunk": ["tokens"],
+                "admission": {"max_concurrency": 1},
+            }
+        }
+    )
+    services = manager._services["stream"]
+    admission = manager._admission["stream"]
+
+    async def run():
+        # a listed stream gives up its slot once the first chunk arrived
+        stream = services["tokens"]("a b c d", delay=10)
+        assert await stream.__anext__() == "a"
+        assert admission.app_limit.active == 0
+        assert manager._scheduler.in_flight["stream"] == 0
+        assert await asyncio.wait_for(services["count"](1).__anext__(), 1) == 0
+        await stream.aclose()
+
+    asyncio.run(run())